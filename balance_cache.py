@@ -0,0 +1,291 @@
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+import zlib
+
+from array import array
+
+#
+# Warm-start cache
+#
+
+# Header of a cache file: magic, format version, byte order marker, digest of
+# the text, length of the text, number of lines, number of line summaries,
+# number of distinct start scopes, checksum of the rest of the file.
+_HEADER = struct.Struct('=4sII20sIIIII')
+_MAGIC = b'LBHB'
+_VERSION = 3
+_BYTE_ORDER = 0x01020304
+
+_SUFFIX = '.balance'
+
+
+def default_cache_directory():
+    """Returns the directory in the user cache directory to keep files in."""
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'LispBracketHighlighter')
+
+
+class BalanceCache:
+    """An on-disk cache of the bracket balances of files.
+
+    Every file gets one entry, which is valid for one content of the file,
+    and for one context the brackets have been located in. The entries are
+    binary dumps of the line starts, the summaries of the lines, and the
+    scopes the lines begin in (i.e., whether they begin in strings or
+    comments), which is everything BracketBalance needs to skip scanning
+    the whole file. Restoring a balance from them still takes O(lines), but
+    no scopes are looked up. They are read whole and checked with a checksum,
+    entries which do not look right are removed and the balance is built as
+    usual. When the entries take more than `size_limit` bytes in total, the
+    least recently used ones are removed.
+
+    Failures of the file system are never reported, the cache simply misses.
+
+    Fields:
+        directory - the directory to keep the entries in
+
+        size_limit - the maximum total size of the entries, in bytes
+
+        hits, misses, corrupted - the number of loads which have found
+                                  a valid entry, no valid entry, or a broken
+                                  entry which has been removed
+    """
+    def __init__(self, directory, size_limit):
+        self.directory = directory
+        self.size_limit = size_limit
+
+        self.hits = 0
+        self.misses = 0
+        self.corrupted = 0
+
+    def _entry_path(self, path):
+        name = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + _SUFFIX)
+
+    def _digest(self, text, context):
+        digest = hashlib.sha1(context.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8'))
+        return digest.digest()
+
+    def load(self, path, text, context=''):
+        """Looks up the state of the balance of the file.
+
+        Args:
+            path - the path of the file
+
+            text - the current text of the file
+
+            context - a string which changes whenever the brackets of the
+                      text would be located differently: other brackets,
+                      other scopes to skip, another syntax of the file
+
+        Returns:
+            state - the state to restore a BracketBalance from, or None
+                    if there is no entry for this text of the file
+        """
+        entry_path = self._entry_path(path)
+        try:
+            entry = open(entry_path, 'rb')
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        try:
+            try:
+                state = _read_entry(entry, self._digest(text, context), len(text))
+            finally:
+                entry.close()
+        except (ValueError, struct.error, EnvironmentError):
+            self.corrupted += 1
+            _remove(entry_path)
+            return None
+
+        if state is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return state
+
+    def store(self, path, text, state, context=''):
+        """Keeps the state of the balance of the file, for this text of it.
+
+        Args:
+            path - the path of the file
+
+            text - the text the balance is of
+
+            state - the state that BracketBalance.state() has returned
+
+            context - the context of the brackets, see load
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            # Write a new file and then move it in place, so that the ones
+            # loading the entry never see it half-written.
+            handle, temporary_path = tempfile.mkstemp(dir=self.directory)
+            try:
+                entry = os.fdopen(handle, 'wb')
+                try:
+                    _write_entry(entry, self._digest(text, context), len(text), state)
+                finally:
+                    entry.close()
+
+                entry_path = self._entry_path(path)
+                if os.name == 'nt':
+                    _remove(entry_path)
+                os.rename(temporary_path, entry_path)
+            except:
+                _remove(temporary_path)
+                raise
+
+            self._evict()
+        except (IOError, OSError):
+            pass
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            entry_path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, entry_path))
+
+        # The most recently used entries are the last ones.
+        entries.sort()
+
+        total = sum([size for _, size, _ in entries])
+        for _, size, entry_path in entries:
+            if total <= self.size_limit:
+                break
+            _remove(entry_path)
+            total -= size
+
+
+def _int_array(values):
+    result = array('i', values)
+    assert result.itemsize == 4
+    return result
+
+
+# Python 3 has renamed tostring and fromstring of arrays, and 3.9 has dropped
+# the old names.
+if hasattr(array, 'tobytes'):
+    def _array_bytes(values): return values.tobytes()
+    def _extend_array(values, data): values.frombytes(data)
+else:
+    def _array_bytes(values): return values.tostring()
+    def _extend_array(values, data): values.fromstring(data)
+
+
+def _write_entry(entry, digest, text_length, state):
+    line_starts, (net, low), start_scopes = state
+
+    scope_table, scope_ids = [], []
+    scope_index = {}
+    for scope in start_scopes:
+        index = scope_index.get(scope)
+        if index is None:
+            index = scope_index[scope] = len(scope_table)
+            scope_table.append(scope)
+        scope_ids.append(index)
+
+    payload = [_array_bytes(_int_array(line_starts)),
+               _array_bytes(_int_array(net)),
+               _array_bytes(_int_array(low)),
+               _array_bytes(_int_array(scope_ids)),
+               '\n'.join(scope_table).encode('utf-8')]
+
+    checksum = 0
+    for chunk in payload:
+        checksum = zlib.crc32(chunk, checksum)
+
+    entry.write(_HEADER.pack(_MAGIC, _VERSION, _BYTE_ORDER, digest, text_length,
+        len(line_starts), len(net), len(scope_table), checksum & 0xFFFFFFFF))
+    for chunk in payload:
+        entry.write(chunk)
+
+
+def _read_entry(entry, digest, text_length):
+    """Reads the state from the entry file.
+
+    Returns:
+        state - the state, or None if the entry is for another text
+
+    Raises:
+        ValueError - if the entry is broken
+    """
+    contents = entry.read()
+    if len(contents) < _HEADER.size:
+        raise ValueError("truncated header")
+
+    magic, version, byte_order, entry_digest, entry_text_length, \
+        rows, nodes, scopes, checksum = _HEADER.unpack(contents[:_HEADER.size])
+
+    if (magic != _MAGIC) or (version != _VERSION) or (byte_order != _BYTE_ORDER):
+        raise ValueError("unknown format")
+
+    if (entry_digest != digest) or (entry_text_length != text_length):
+        return None
+
+    if zlib.crc32(contents[_HEADER.size:]) & 0xFFFFFFFF != checksum:
+        raise ValueError("checksum mismatch")
+
+    offset = [_HEADER.size]
+
+    def int_array(length):
+        begin, end = offset[0], offset[0] + 4 * length
+        if end > len(contents):
+            raise ValueError("truncated contents")
+        offset[0] = end
+
+        values = array('i')
+        _extend_array(values, contents[begin:end])
+        return values
+
+    line_starts = int_array(rows)
+    net = int_array(nodes)
+    low = int_array(nodes)
+    scope_ids = int_array(rows)
+
+    scope_table = contents[offset[0]:].decode('utf-8').split('\n')
+    if len(scope_table) != scopes:
+        raise ValueError("wrong number of scopes")
+
+    if (rows == 0) or (nodes != rows):
+        raise ValueError("wrong number of lines")
+
+    if (line_starts[0] != 0) or (line_starts[-1] > text_length):
+        raise ValueError("wrong line starts")
+
+    if max(scope_ids) >= scopes:
+        raise ValueError("wrong scope index")
+
+    start_scopes = [scope_table[index] for index in scope_ids]
+    return line_starts, (net, low), start_scopes
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,305 @@
+"""Highlights whole trees of Lisp sources outside of Sublime Text.
+
+Every file is memory-mapped and put into a text-backed view, then the
+highlighting pipeline is run for a number of cursor points spread evenly
+over the file, as if the caret has been placed at each of them in turn.
+The files, and the points within large files, are spread across a pool of
+processes. The colored regions are written out as JSON (for snapshot tests
+and for warming caches) or as static HTML. Usage:
+
+    python benchmarks/batch.py [--jobs N] [--cursors N] [--format json|html]
+                               [--output FILE] PATH...
+
+Directories are walked for the files with Lisp extensions, the files of
+the dialects are lexed in the base scopes of their syntaxes, so that their
+brackets are highlighted too. The files are not decoded: the cursors and
+the regions are byte offsets into the files, which differ from the points
+of Sublime Text past any non-ASCII character. The JSON output says so under
+'offsets'. Throughput is reported to stderr. Exits with a non-zero status
+if the pipeline has failed an assertion at any of the points.
+"""
+import bootstrap
+
+import cgi
+import json
+import mmap
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+import sublime
+import lisp_highlight
+
+from bracket_balance import BracketBalance
+from bracket_scopes import cursors_of_view, expand_cursors_to_regions, merge_adjacent_regions
+
+LISP_EXTENSIONS = ['.lisp', '.lsp', '.cl', '.el', '.scm', '.ss', '.rkt', '.clj',
+                   '.cljs', '.cljc', '.edn']
+
+# Base scopes of the syntaxes of the files with dialect brackets (see
+# dialect_brackets), keyed by their extensions. Other files are plain Lisp.
+SYNTAX_SCOPES = {
+    '.rkt':  'source.racket',
+    '.clj':  'source.clojure',
+    '.cljs': 'source.clojure',
+    '.cljc': 'source.clojure',
+    '.edn':  'source.clojure',
+}
+
+# The cursor points of a file are highlighted in tasks of this many points,
+# so that a large file keeps several processes busy.
+POINTS_PER_TASK = 16
+
+#
+# Workers
+#
+
+# The view of the file the worker has highlighted last, with the mmap of it
+# and the bracket balance of the view.
+_mapped = {}
+
+
+def mapped_view(path):
+    """Returns a view backed by the memory-mapped contents of the file.
+
+    The worker keeps only the last file mapped, the tasks of a file usually
+    come to the same worker one after another.
+
+    Returns:
+        (view, balance) - the view, and its BracketBalance when the plugin
+                          looks up the enclosing brackets (see
+                          enclosing_limit), None otherwise
+    """
+    if path in _mapped:
+        return _mapped[path][1:]
+
+    for contents, _, _ in _mapped.values():
+        if contents is not None:
+            contents.close()
+    _mapped.clear()
+
+    contents = None
+    with open(path, 'rb') as source:
+        if os.fstat(source.fileno()).st_size > 0:
+            contents = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # The view only finds, slices and measures its text, which mmap does
+    # without reading the whole file into memory.
+    base_scope = SYNTAX_SCOPES.get(os.path.splitext(path)[1], 'source.lisp')
+    view = sublime.View(sublime.Buffer(contents if contents is not None else '',
+                                       base_scope=base_scope))
+
+    balance = None
+    if lisp_highlight.enclosing_limit > 0:
+        balance = BracketBalance(lisp_highlight.brackets_of(view),
+                                 lisp_highlight.no_strings_and_comments,
+                                 lisp_highlight.scan_cache)
+        balance.refresh(view)
+
+    _mapped[path] = contents, view, balance
+    return view, balance
+
+
+def highlight_points(task):
+    """Highlights the file with the caret placed at every point in turn.
+
+    Args:
+        (path, [point]) - the file to highlight and the cursor points
+
+    Returns:
+        (path, [sample])
+            - samples of the points, dictionaries with the 'cursor',
+              the examined 'regions' and the 'colors', which are lists of
+              {'fg', 'bg', 'regions'} sorted by the colors; 'failed' tells
+              whether the pipeline has failed an assertion at the point
+    """
+    path, points = task
+    view, balance = mapped_view(path)
+
+    samples = []
+    for point in points:
+        view.set_cursors([point])
+        cursors = cursors_of_view(view)
+
+        expanded_regions = expand_cursors_to_regions(cursors,
+            lisp_highlight.scan_limit, view, balance)
+        examined_regions = merge_adjacent_regions(expanded_regions, cursors)
+
+        colored_regions = {}
+        failed = False
+        try:
+            for region, region_cursors in examined_regions:
+                for color, regions in lisp_highlight.highlight_examined_region(
+                        view, region, region_cursors, lisp_highlight.config,
+                        balance=balance).iteritems():
+                    colored_regions.setdefault(color, []).extend(regions)
+        except AssertionError:
+            colored_regions, failed = {}, True
+
+        samples.append({
+            'cursor': point,
+            'failed': failed,
+            'regions': [[region.begin, region.end] for region, _ in examined_regions],
+            'colors': [{'fg': fg, 'bg': bg,
+                        'regions': sorted([region.begin, region.end]
+                                          for region in colored_regions[(fg, bg)])}
+                       for fg, bg in sorted(colored_regions)],
+        })
+
+    return path, samples
+
+#
+# Tasks
+#
+
+def source_files(paths, extensions):
+    """Yields the files given and the ones with the extensions in the
+    directories given, in a stable order.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for directory, subdirectories, names in os.walk(path):
+            subdirectories.sort()
+            for name in sorted(names):
+                if os.path.splitext(name)[1] in extensions:
+                    yield os.path.join(directory, name)
+
+
+def sample_points(size, count):
+    """Returns `count` points spread evenly over a file of the size."""
+    if size == 0:
+        return []
+    return sorted(set((2 * index + 1) * size // (2 * count) for index in xrange(count)))
+
+
+def split_into_tasks(files, count):
+    """Returns [(path, [point])] tasks of highlighting the files."""
+    tasks = []
+    for path in files:
+        points = sample_points(os.path.getsize(path), count)
+        for begin in xrange(0, len(points), POINTS_PER_TASK):
+            tasks.append((path, points[begin:begin + POINTS_PER_TASK]))
+    return tasks
+
+#
+# Output
+#
+
+def css_color(color):
+    return '#%06X' % color
+
+
+def format_html(results):
+    """Formats the samples as HTML with the examined regions of every sample
+    shown with their colors.
+    """
+    yield '<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+    yield '<title>LispBracketHighlighter</title></head><body>\n'
+
+    for path in sorted(results):
+        yield '<h2>%s</h2>\n' % cgi.escape(path)
+
+        # Points are byte offsets, brackets never split UTF-8 sequences.
+        with open(path, 'rb') as source:
+            text = source.read()
+
+        for sample in results[path]:
+            spans = []
+            for color in sample['colors']:
+                style = []
+                if color['fg'] is not None:
+                    style.append('color: %s' % css_color(color['fg']))
+                if color['bg'] is not None:
+                    style.append('background: %s' % css_color(color['bg']))
+                for begin, end in color['regions']:
+                    spans.append((begin, end, '; '.join(style)))
+            spans.sort()
+
+            for region_begin, region_end in sample['regions']:
+                yield '<h3>cursor at byte %d</h3>\n<pre>' % sample['cursor']
+
+                point = region_begin
+                for begin, end, style in spans:
+                    if (end <= region_begin) or (begin >= region_end):
+                        continue
+                    yield cgi.escape(text[point:begin])
+                    yield '<span style="%s">%s</span>' % (style, cgi.escape(text[begin:end]))
+                    point = end
+                yield cgi.escape(text[point:region_end])
+
+                yield '</pre>\n'
+
+    yield '</body></html>\n'
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] PATH...")
+    parser.add_option('--jobs', type='int', default=multiprocessing.cpu_count(),
+                      help="number of processes (default: the number of CPUs)")
+    parser.add_option('--cursors', type='int', default=16,
+                      help="cursor points to highlight in every file")
+    parser.add_option('--format', choices=['json', 'html'], default='json',
+                      help="json or html (default: json)")
+    parser.add_option('--output', metavar='FILE',
+                      help="write the highlights into the file (default: stdout)")
+    parser.add_option('--extensions', default=','.join(LISP_EXTENSIONS),
+                      help="comma-separated extensions of the files in directories")
+    options, paths = parser.parse_args()
+
+    if not paths:
+        parser.error("no paths given")
+
+    started = time.time()
+
+    files = list(source_files(paths, options.extensions.split(',')))
+    tasks = split_into_tasks(files, max(1, options.cursors))
+
+    results = dict((path, []) for path in files)
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs)
+        try:
+            for path, samples in pool.imap_unordered(highlight_points, tasks):
+                results[path].extend(samples)
+        finally:
+            pool.terminate()
+    else:
+        for path, samples in map(highlight_points, tasks):
+            results[path].extend(samples)
+
+    for samples in results.itervalues():
+        samples.sort(key=lambda sample: sample['cursor'])
+
+    elapsed = time.time() - started
+    megabytes = sum([os.path.getsize(path) for path in files]) / (1024.0 * 1024.0)
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        if options.format == 'json':
+            json.dump({'offsets': 'bytes', 'files': results}, output,
+                      indent=1, sort_keys=True)
+            output.write('\n')
+        else:
+            for chunk in format_html(results):
+                output.write(chunk)
+    finally:
+        if options.output:
+            output.close()
+
+    sys.stderr.write("%d files, %.2f MB in %.2f s: %.1f files/s, %.2f MB/s\n" %
+                     (len(files), megabytes, elapsed,
+                      len(files) / max(elapsed, 1e-9), megabytes / max(elapsed, 1e-9)))
+
+    failed = [(path, sample['cursor']) for path in sorted(results)
+              for sample in results[path] if sample['failed']]
+    for path, point in failed:
+        sys.stderr.write("%s: failed at byte %d\n" % (path, point))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
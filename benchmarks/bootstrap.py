@@ -0,0 +1,34 @@
+"""Makes the plugin importable outside of Sublime Text.
+
+The fake sublime and sublime_plugin modules live next to this file, and the
+plugin modules are in the parent directory. One of them is called 'types',
+shadowing the standard module of the same name. Import this module before
+anything else: it loads the plugin with its own 'types' in place and then
+puts the standard one back, so that the rest of the library keeps working.
+"""
+import os
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+PLUGIN_MODULES = ['utils', 'types', 'lisp_highlight_configuration', 'bracket_matcher',
+                  'bracket_scopes', 'bracket_balance', 'bracket_coloring', 'bracket_rainbow',
+                  'bracket_structure', 'scan_cache', 'scope_colors', 'balance_cache',
+                  'region_canvas', 'region_pool', 'lisp_highlight']
+
+sys.path[0:0] = [BENCHMARKS_DIR, PLUGIN_DIR]
+
+# Standard modules that import 'types' themselves have to be loaded before
+# the plugin one takes its place, as Sublime Text has them loaded already.
+import copy
+import multiprocessing
+import tempfile
+
+_standard_types = sys.modules.pop('types')
+try:
+    for name in PLUGIN_MODULES:
+        __import__(name)
+finally:
+    plugin_types = sys.modules.get('types')
+    sys.modules['types'] = _standard_types
@@ -0,0 +1,209 @@
+"""Checks that the pipeline stages scale near-linearly on pathological input.
+
+Every stage is run on each of the pathological shapes at growing sizes,
+and the growth of its running time is compared to the growth of the work
+it is expected to do. The check fails if the time grows noticeably faster,
+or if a stage recurses deep enough to hit a small recursion limit. Usage:
+
+    python benchmarks/complexity.py [--shape NAME]... [--sizes N]
+
+Exits with a non-zero status if any of the checks fail.
+"""
+import bootstrap
+
+import gc
+import math
+import optparse
+import sys
+import time
+
+import sublime
+
+from bracket_scopes \
+    import locate_brackets, index_brackets, compute_bracket_scopes, \
+           current_lines_of_view
+from bracket_coloring import color_scopes, split_into_disjoint
+from lisp_highlight import supported_brackets, no_strings_and_comments
+from lisp_highlight_configuration \
+    import ColorMode, AdjacentMode, Configuration
+
+from pathological import SHAPES
+
+plugin_types = bootstrap.plugin_types
+
+# Everything is visible, so that no scopes are pruned early.
+config = Configuration({
+    'primary_mode': ColorMode.EXPRESSION,
+    'secondary_mode': ColorMode.EXPRESSION,
+    'offside_mode': ColorMode.EXPRESSION,
+    'offside_limit': 3,
+    'adjacent_mode': ColorMode.EXPRESSION,
+    'adjacent_side': AdjacentMode.BOTH,
+    'invalid_mode': ColorMode.NONE,
+    'inconsistent_mode': ColorMode.BRACKETS,
+    'rainbow_mode': ColorMode.NONE,
+
+    'background_color': (None, 0x000001),
+    'current_line_color': (None, 0x000002),
+
+    'primary_color': (0x000003, None),
+    'secondary_colors': [(0x000004, None), (0x000005, 0x000006)],
+    'offside_colors': [(0x000007, 0x000008), (0x000009, None)],
+    'adjacent_color': (0x00000A, 0x00000B),
+    'inconsistent_color': (0x00000C, 0x00000D),
+    'rainbow_colors': [(0x00000E, None), (0x00000F, None)]
+})
+
+# Smallest sizes of the shapes, in characters. They are doubled every step.
+BASE_SIZES = {
+    'deep_nesting': 2500,
+    'long_line': 20000,
+    'many_cursors': 2000,
+    'nested_cursors': 2000,
+    'mixed_brackets': 2500,
+    'unbalanced': 10000,
+    'bracket_strings': 20000,
+}
+
+# The time of a stage may grow at most this much faster than its work.
+# The slack covers logarithmic factors and measurement noise, while
+# quadratic behavior still stands out clearly with an exponent near 2.
+MAX_EXPONENT = 1.4
+
+# Stages must not recurse proportionally to the input.
+RECURSION_LIMIT = 100
+
+REPEATS = 3
+
+
+def run_stages(text, cursors):
+    """Runs the stages once, returning their times and amounts of work."""
+    view = sublime.View(text, cursors)
+    region = plugin_types.Region(0, view.size())
+
+    times, work = {}, {}
+
+    def stage(name, amount, function, *args):
+        # The garbage collector is off while timing, as timeit does: its
+        # passes over all live objects would distort the growth of time.
+        limit = sys.getrecursionlimit()
+        gc.collect()
+        gc.disable()
+        sys.setrecursionlimit(RECURSION_LIMIT)
+        try:
+            started = time.time()
+            result = function(*args)
+            times[name] = time.time() - started
+        finally:
+            sys.setrecursionlimit(limit)
+            gc.enable()
+        work[name] = max(1, amount)
+        return result
+
+    brackets = stage('locate', len(text), locate_brackets,
+        view, region, supported_brackets, no_strings_and_comments)
+
+    # Indices are held to the size of the input like the other stages, even
+    # though every cursor may take part in the index of every bracket: the
+    # cursors of a shape grow with it, so brackets times cursors shows up.
+    positions = plugin_types.PositionIndex(cursors, brackets)
+
+    indices = stage('index', len(text),
+        index_brackets, brackets, cursors, config, positions)
+
+    scopes = stage('scopes', len(brackets),
+        compute_bracket_scopes, brackets, indices, config)
+
+    spans = stage('color', len(scopes),
+        color_scopes, scopes, config, cursors, supported_brackets, positions)
+
+    lines = current_lines_of_view(view, cursors)
+    stage('split', len(spans) + len(lines),
+        split_into_disjoint, spans, lines)
+
+    return times, work
+
+
+def measure(shape, size):
+    """Runs the stages on a shape, keeping the best times of a few runs."""
+    text, cursors = shape(size)
+    best_times, work = run_stages(text, cursors)
+    for _ in range(REPEATS - 1):
+        times, _ = run_stages(text, cursors)
+        for name in times:
+            best_times[name] = min(best_times[name], times[name])
+    return best_times, work
+
+
+def growth_exponent(samples):
+    """Estimates the exponent of time growth relative to work growth.
+
+    Args:
+        [(time, work)] - measurements of a stage at growing sizes
+
+    Returns:
+        the slope of the least squares fit of log(time) by log(work)
+    """
+    # Times below a millisecond are mostly noise, do not trust their ratio.
+    points = [(math.log(work), math.log(max(time, 0.001)))
+              for time, work in samples]
+
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return 0.0
+
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    return covariance / variance
+
+
+def check(name, shape, steps):
+    """Checks a shape, printing the results. Returns False on failures."""
+    sizes = [BASE_SIZES[name] * 2 ** step for step in range(steps)]
+
+    try:
+        results = [measure(shape, size) for size in sizes]
+    except RuntimeError as error:
+        print("%s: FAILED, %s" % (name, error))
+        return False
+
+    passed = True
+    print("%s: sizes %s" % (name, ', '.join(map(str, sizes))))
+
+    (first_times, _), (last_times, _) = results[0], results[-1]
+    for stage in sorted(first_times):
+        exponent = growth_exponent([(times[stage], work[stage])
+                                    for times, work in results])
+        verdict = "ok" if exponent <= MAX_EXPONENT else "TOO SLOW"
+        passed = passed and (exponent <= MAX_EXPONENT)
+
+        print("    %-14s %9.2f ms -> %9.2f ms, exponent %5.2f  %s" %
+              (stage, first_times[stage] * 1000, last_times[stage] * 1000,
+               exponent, verdict))
+
+    return passed
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--shape', action='append', dest='shapes',
+                      choices=[name for name, _ in SHAPES],
+                      help="a shape to check, may be repeated (default: all)")
+    parser.add_option('--sizes', type='int', default=4,
+                      help="how many doubling sizes to check")
+    options, _ = parser.parse_args()
+
+    passed = True
+    for name, shape in SHAPES:
+        if options.shapes and name not in options.shapes:
+            continue
+        passed = check(name, shape, options.sizes) and passed
+        sys.stdout.flush()
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+"""Differential fuzzer of the highlighting pipeline.
+
+Generates random bracket texts, examined regions, cursors and configurations,
+highlights them with the frozen reference implementation (see reference.py)
+and with every engine of the plugin, and compares the colored regions. Any
+mismatch is shrunk to a minimal case which is printed as a reproducer.
+Usage:
+
+    python benchmarks/fuzz.py [--engine NAME]... [--cases N] [--seed N] [--seeds N]
+                              [--size N]
+
+The cases of every seed from --seed on, 8 seeds by default, are checked.
+Every case starts with an empty scan_cache, the 'cached' engine scans the
+region and the rest of the text from it first, so that it is highlighted
+from the cache. Exits with a non-zero status if any of the engines
+disagrees with the reference. Every fast path of the pipeline has to be added to ENGINES and
+pass the fuzzer before it is enabled in the plugin.
+"""
+import bootstrap
+
+import optparse
+import random
+import sys
+
+import sublime
+import lisp_highlight
+import reference
+
+from bracket_balance import BracketBalance
+from bracket_coloring import compute_span_color
+from lisp_highlight import all_brackets, supported_brackets, no_strings_and_comments
+from lisp_highlight_configuration \
+    import ColorMode, AdjacentMode, Configuration
+
+Region = bootstrap.plugin_types.Region
+
+# The views are Lisp ones, they are given the brackets of all the dialects so
+# that the multi-character ones are covered too.
+lisp_highlight.dialect_brackets['source.lisp'] = \
+    [pair for pair in all_brackets if pair not in supported_brackets]
+
+#
+# Engines
+#
+
+# Engines compute {color: [Region]} of (view, region, cursors, config), the
+# ones with a balance also look up enclosing_limit expressions beyond the
+# region, as the reference does.
+
+def highlight_in_batch(view, region, cursors, config, balance):
+    return lisp_highlight.highlight_examined_region(view, region, cursors, config,
+                                                    balance=balance)
+
+
+def highlight_in_stream(view, region, cursors, config, balance):
+    colored_regions = {}
+    for span in lisp_highlight.iter_region_spans(view, region, cursors, config,
+                                                 balance=balance):
+        color = compute_span_color(span, config)
+        colored_regions.setdefault(color, []).append(span.extent)
+    return colored_regions
+
+
+def highlight_from_cache(view, region, cursors, config, balance):
+    # The text up to the end of the view begins the same as the one of the
+    # region, and is cut short at the end of the view the same way.
+    for scanned in [Region(region.begin, view.size()), region]:
+        lisp_highlight.locate_region_brackets(view, scanned)
+    return highlight_in_batch(view, region, cursors, config, balance)
+
+
+# (name, function, uses the bracket balance)
+ENGINES = [
+    ('batch', highlight_in_batch, False),
+    ('cached', highlight_from_cache, False),
+    ('streaming', highlight_in_stream, False),
+    ('balance', highlight_in_batch, True),
+    ('balance_streaming', highlight_in_stream, True),
+]
+
+#
+# Cases
+#
+
+class Case:
+    """A single input of the pipeline.
+
+    Fields:
+        text - the text of the view
+
+        begin, end - the examined region
+
+        [cursors] - sorted cursors inside the region
+
+        settings - the dictionary the Configuration is made of
+
+        enclosing_limit - how many enclosing expressions the engines with
+                          a balance look up
+    """
+    def __init__(self, text, begin, end, cursors, settings, enclosing_limit):
+        self.text = text
+        self.begin = begin
+        self.end = end
+        self.cursors = cursors
+        self.settings = settings
+        self.enclosing_limit = enclosing_limit
+
+    def changed(self, **fields):
+        """Returns a copy of the case with some of the fields changed."""
+        values = dict(self.__dict__)
+        values.update(fields)
+        return Case(**values)
+
+    def valid(self):
+        """True if the pipeline can be run on the case at all.
+
+        The region must not begin in the middle of a bracket, as the bracket
+        balance never lets it, and cursors at the very end of the text are
+        not supported by the pipeline.
+        """
+        if not (0 <= self.begin < self.end <= len(self.text)):
+            return False
+        if not self.cursors:
+            return False
+        for cursor in self.cursors:
+            if not (self.begin <= cursor <= self.end) or (cursor >= len(self.text)):
+                return False
+
+        view = sublime.View(self.text)
+        for bracket in reference.locate_brackets(view, Region(0, len(self.text)),
+                                                 all_brackets, no_strings_and_comments):
+            if bracket.point < self.begin < bracket.point + len(bracket.kind):
+                return False
+        return True
+
+    def __repr__(self):
+        settings = []
+        for key in sorted(self.settings):
+            value = self.settings[key]
+            if key.endswith('_mode'):
+                value = 'ColorMode.%s' % value
+            else:
+                value = repr(value)
+            settings.append("    %r: %s," % (key, value))
+
+        return "text = %r\nregion = (%d, %d)\ncursors = %r\nenclosing_limit = %d\n" \
+               "settings = {\n%s\n}" % (self.text, self.begin, self.end, self.cursors,
+                                        self.enclosing_limit, '\n'.join(settings))
+
+
+# Bits of text the cases are made of, the brackets are the most frequent.
+FRAGMENTS = [left for left, _ in all_brackets] * 2 + \
+            [right for _, right in all_brackets] * 3 + \
+            ['a', ' ', ' ', '\n', '"', ';']
+
+MODES = [ColorMode.NONE, ColorMode.BRACKETS, ColorMode.EXPRESSION]
+
+
+def random_color(rng, foreground, transparent=True):
+    background = foreground + 1
+    if transparent and rng.random() < 0.5:
+        background = None
+    return (foreground, background)
+
+
+def random_settings(rng):
+    return {
+        'primary_mode': rng.choice(MODES),
+        'secondary_mode': rng.choice(MODES),
+        'offside_mode': rng.choice(MODES),
+        'offside_limit': rng.randint(0, 3),
+        'adjacent_mode': rng.choice(MODES),
+        'adjacent_side': rng.choice([AdjacentMode.NONE, AdjacentMode.LEFT,
+                                     AdjacentMode.RIGHT, AdjacentMode.BOTH]),
+        'inconsistent_mode': rng.choice(MODES),
+        'rainbow_mode': ColorMode.NONE,
+
+        'background_color': (None, 0x000001),
+        'current_line_color': (None, 0x000002),
+
+        'primary_color': random_color(rng, 0x000010),
+        'secondary_colors': [random_color(rng, 0x000020 + 2 * n)
+                             for n in xrange(rng.randint(1, 3))],
+        'offside_colors': [random_color(rng, 0x000030 + 2 * n)
+                           for n in xrange(rng.randint(1, 3))],
+        'adjacent_color': random_color(rng, 0x000040),
+        'inconsistent_color': random_color(rng, 0x000050),
+        'rainbow_colors': [(0x000060, None)],
+    }
+
+
+def random_case(rng, size):
+    """Generates a valid case with the text of at most `size` characters."""
+    while True:
+        text = ''
+        length = rng.randint(1, size)
+        while len(text) < length:
+            text += rng.choice(FRAGMENTS)
+
+        begin = rng.randint(0, len(text) - 1)
+        end = rng.randint(begin + 1, len(text))
+        cursors = sorted(set(rng.randint(begin, min(end, len(text) - 1))
+                             for _ in xrange(rng.randint(1, 4))))
+
+        case = Case(text, begin, end, cursors, random_settings(rng),
+                    rng.choice([0, 1, 2, 32]))
+        if case.valid():
+            return case
+
+#
+# Comparison
+#
+
+def outcome(function, *args):
+    """Runs the engine, returning sorted [(fg, bg, begin, end)] of the colored
+    regions, or the name of the exception it has failed with.
+    """
+    try:
+        colored_regions = function(*args)
+    except Exception as error:
+        return type(error).__name__
+
+    return sorted((color[0], color[1], region.begin, region.end)
+                  for color, regions in colored_regions.iteritems()
+                  for region in regions)
+
+
+def compare(case, engine):
+    """Runs the reference and the engine on the case.
+
+    Returns:
+        (expected, actual) - the outcomes, or None if they are the same
+    """
+    name, function, uses_balance = engine
+
+    view = sublime.View(case.text)
+    region = Region(case.begin, case.end)
+    config = Configuration(case.settings)
+
+    balance = None
+    enclosing_limit = 0
+    if uses_balance:
+        balance = BracketBalance(all_brackets, no_strings_and_comments)
+        balance.refresh(view)
+        enclosing_limit = case.enclosing_limit
+
+    expected = outcome(reference.highlight_examined_region, view, region, case.cursors,
+                       config, all_brackets, no_strings_and_comments, enclosing_limit)
+
+    saved_limit = lisp_highlight.enclosing_limit
+    lisp_highlight.enclosing_limit = enclosing_limit
+    lisp_highlight.scan_cache.clear()
+    try:
+        actual = outcome(function, view, region, case.cursors, config, balance)
+    finally:
+        lisp_highlight.enclosing_limit = saved_limit
+
+    if expected == actual:
+        return None
+    return expected, actual
+
+#
+# Shrinking
+#
+
+def without_text(case, begin, end):
+    """Removes the text from begin to end, moving the points after it."""
+    def moved(point):
+        if point >= end:
+            return point - (end - begin)
+        return min(point, begin)
+
+    cursors = sorted(set(moved(cursor) for cursor in case.cursors
+                         if not (begin <= cursor < end)))
+
+    return case.changed(text=case.text[:begin] + case.text[end:],
+                        begin=moved(case.begin), end=moved(case.end), cursors=cursors)
+
+
+def smaller_cases(case):
+    """Yields the cases which are simpler than the given one."""
+    for index in xrange(len(case.cursors)):
+        yield case.changed(cursors=case.cursors[:index] + case.cursors[index + 1:])
+
+    for limit in xrange(case.enclosing_limit):
+        yield case.changed(enclosing_limit=limit)
+
+    for key in sorted(case.settings):
+        value = case.settings[key]
+        simpler = []
+        if key.endswith('_mode') and (value is not ColorMode.NONE):
+            simpler = [ColorMode.NONE, ColorMode.BRACKETS]
+        elif (key in ['offside_limit', 'adjacent_side']) and (value > 0):
+            simpler = [value - 1]
+        elif isinstance(value, list) and (len(value) > 1):
+            simpler = [value[:-1]]
+        elif isinstance(value, tuple) and (value[1] is not None) and (key.endswith('_color')) \
+             and key not in ['background_color', 'current_line_color']:
+            simpler = [(value[0], None)]
+
+        for simple in simpler:
+            if simple != value:
+                settings = dict(case.settings)
+                settings[key] = simple
+                yield case.changed(settings=settings)
+
+    length = len(case.text) // 2
+    while length > 0:
+        for begin in xrange(0, len(case.text) - length + 1):
+            yield without_text(case, begin, begin + length)
+        length //= 2
+
+    yield case.changed(begin=case.begin + 1)
+    yield case.changed(end=case.end - 1)
+
+    for index, char in enumerate(case.text):
+        if char not in ' \n':
+            yield case.changed(text=case.text[:index] + ' ' + case.text[index + 1:])
+
+
+def shrink(case, engine):
+    """Shrinks the case for as long as the engine still disagrees with the
+    reference on it.
+
+    Returns:
+        (case, (expected, actual)) - the smallest case found and the outcomes
+    """
+    mismatch = compare(case, engine)
+    assert mismatch is not None
+
+    shrinking = True
+    while shrinking:
+        shrinking = False
+        for smaller in smaller_cases(case):
+            if not smaller.valid():
+                continue
+
+            smaller_mismatch = compare(smaller, engine)
+            if smaller_mismatch is not None:
+                case, mismatch = smaller, smaller_mismatch
+                shrinking = True
+                break
+
+    return case, mismatch
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--engine', action='append', dest='engines',
+                      choices=[name for name, _, _ in ENGINES],
+                      help="an engine to check, may be repeated (default: all)")
+    parser.add_option('--cases', type='int', default=2000,
+                      help="how many random cases to check")
+    parser.add_option('--seed', type='int', default=0,
+                      help="the first seed of the case generator")
+    parser.add_option('--seeds', type='int', default=8,
+                      help="how many seeds to check the cases of")
+    parser.add_option('--size', type='int', default=60,
+                      help="maximum length of the texts")
+    options, _ = parser.parse_args()
+
+    engines = [engine for engine in ENGINES
+               if (not options.engines) or (engine[0] in options.engines)]
+
+    failed = set([])
+
+    for seed in xrange(options.seed, options.seed + max(1, options.seeds)):
+        rng = random.Random(seed)
+
+        for number in xrange(options.cases):
+            case = random_case(rng, options.size)
+
+            for engine in engines:
+                if (engine[0] in failed) or (compare(case, engine) is None):
+                    continue
+
+                failed.add(engine[0])
+                shrunk, (expected, actual) = shrink(case, engine)
+
+                print("%s disagrees with the reference on case %d of seed %d, shrunk to:\n" %
+                      (engine[0], number, seed))
+                print(shrunk)
+                print("\nreference: %r\n%-10s %r\n" % (expected, engine[0] + ':', actual))
+                sys.stdout.flush()
+
+    for name, _, _ in engines:
+        print("%-18s %s" % (name, "FAILED" if name in failed else "ok"))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Generators of pathological input shapes.
+
+The worst performance problems come from the shape of the input rather than
+its size: very deep nesting, very long lines, thousands of cursors, brackets
+that do not match, strings full of brackets. Every shape here is a function
+of the desired size which returns the text and the sorted cursor points.
+The same size always produces the same input.
+"""
+import random
+
+
+def deep_nesting(size):
+    """A single expression nested size/2 levels deep, the cursor inside."""
+    depth = size // 2
+    return '(' * depth + ')' * depth, [depth]
+
+
+def long_line(size):
+    """A single line of small forms, without any newlines."""
+    unit = '(a [b {c d}] (e f)) '
+    text = unit * (size // len(unit))
+    return text, [len(text) // 2]
+
+
+def many_cursors(size):
+    """Small forms on separate lines with a cursor in every one of them."""
+    unit = '(f (g x) y)\n'
+    count = size // len(unit)
+    return unit * count, [i * len(unit) + 4 for i in range(count)]
+
+
+def nested_cursors(size):
+    """A single expression nested size/4 levels deep, with a cursor at every
+    level of it, inside and after every bracket.
+    """
+    depth = size // 4
+    text = '( ' * depth + ') ' * depth
+    return text, list(range(1, len(text), 2))
+
+
+def mixed_brackets(size):
+    """Nested brackets of random kinds, mostly inconsistent pairs."""
+    rng = random.Random(size)
+    depth = size // 2
+    lefts = [rng.choice('([{') for _ in range(depth)]
+    rights = [rng.choice(')]}') for _ in range(depth)]
+    return ''.join(lefts) + ''.join(rights), [depth]
+
+
+def unbalanced(size):
+    """Random brackets with three left brackets for every right one."""
+    rng = random.Random(size)
+    text = ''.join(rng.choice('((([[{)') for _ in range(size))
+    return text, [size // 2]
+
+
+def bracket_strings(size):
+    """Huge string literals full of brackets with a little code around."""
+    string = '"' + '(([{' * (size // 8) + '"'
+    text = '(define s1 ' + string + ')\n(define s2 ' + string + ')\n'
+    return text, [len(text) // 2]
+
+
+SHAPES = [
+    ('deep_nesting', deep_nesting),
+    ('long_line', long_line),
+    ('many_cursors', many_cursors),
+    ('nested_cursors', nested_cursors),
+    ('mixed_brackets', mixed_brackets),
+    ('unbalanced', unbalanced),
+    ('bracket_strings', bracket_strings),
+]
@@ -0,0 +1,573 @@
+"""The frozen reference implementation of the highlighting pipeline.
+
+These are the stages of the pipeline as they were when the differential
+fuzzer (see fuzz.py) was introduced, copied here and kept as they are, so
+that the optimized stages of the plugin have something to be compared to.
+Bracket location and the lookup of the enclosing brackets are replaced
+with the most straightforward scans of the whole text. Do not optimize
+anything here: the only thing that matters is that this is obviously the
+intended behavior. Fix a bug here only along with the same bug in the
+plugin, and only if the fuzzer has been unable to tell them apart.
+"""
+import bootstrap
+
+from bisect import bisect_left
+from heapq import heapify, heappop, heapreplace
+
+import sublime
+
+from lisp_highlight_configuration import ColorMode, RegionColor
+
+Region = bootstrap.plugin_types.Region
+span = bootstrap.plugin_types.span
+Bracket = bootstrap.plugin_types.Bracket
+LeftBracket = bootstrap.plugin_types.LeftBracket
+RightBracket = bootstrap.plugin_types.RightBracket
+Scope = bootstrap.plugin_types.Scope
+ColorableSpan = bootstrap.plugin_types.ColorableSpan
+
+#
+# Pipeline
+#
+
+def highlight_examined_region(view, region, cursors, config, supported_brackets,
+                              suitable_scope, enclosing_limit=0):
+    """Computes the colored regions of an examined region of the view.
+
+    This is what lisp_highlight.highlight_examined_region does.
+
+    Args:
+        view - the sublime.View to highlight
+
+        region - the Region to examine, which does not begin in the middle
+                 of a bracket
+
+        [cursors] - a sorted list of cursors inside the region
+
+        config - the Configuration to use
+
+        [supported_brackets] - a list of (left, right) pairs of strings
+
+        suitable_scope - a predicate telling whether a scope has brackets
+
+        enclosing_limit - how many enclosing expressions to look up beyond
+                          the region for each of its edges
+
+    Returns:
+        {color: [Region]} - regions to be colored, grouped by their color
+    """
+    brackets = locate_brackets(view, region, supported_brackets, suitable_scope)
+
+    if enclosing_limit > 0:
+        brackets = complete_brackets(view, brackets, region, supported_brackets,
+                                     suitable_scope, enclosing_limit)
+
+    per_cursor_indices = [index_brackets(brackets, cursor, config) for cursor in cursors]
+    merged_indices = merge_bracket_indices(per_cursor_indices)
+
+    scopes = compute_bracket_scopes(brackets, merged_indices, config)
+    spans = color_scopes(scopes, config, cursors, supported_brackets)
+
+    lines = current_lines_of_view(view, cursors)
+    spans = prepend_background(split_into_disjoint(spans, lines), lines)
+
+    colored_regions = {}
+    for span in spans:
+        color = compute_span_color(span, config)
+        colored_regions.setdefault(color, []).append(span.extent)
+    return colored_regions
+
+#
+# Brackets
+#
+
+def locate_brackets(view, region, supported_brackets, suitable_scope):
+    """Locates the brackets in the region, trying every kind of bracket at
+    every point and taking the longest one which matches there.
+    """
+    kinds = set([])
+    lefts = set([])
+    for left, right in supported_brackets:
+        kinds.add(left)
+        kinds.add(right)
+        lefts.add(left)
+    kinds = sorted(kinds, key=len, reverse=True)
+
+    text = view.substr(sublime.Region(region.begin, region.end + len(kinds[0]) - 1))
+
+    brackets = []
+    point = region.begin
+    while point < region.end:
+        for kind in kinds:
+            if text.startswith(kind, point - region.begin):
+                break
+        else:
+            point += 1
+            continue
+
+        if not suitable_scope(view.scope_name(point)):
+            point += 1
+            continue
+
+        if kind in lefts:
+            brackets.append(LeftBracket(point, kind))
+        else:
+            brackets.append(RightBracket(point, kind))
+        point += len(kind)
+
+    return brackets
+
+
+def complete_brackets(view, brackets, region, supported_brackets, suitable_scope, limit):
+    """Adds the far brackets of the expressions cut by the region, which are
+    found by matching all brackets of the view with a stack.
+
+    This is what bracket_scopes.complete_brackets does with a BracketBalance.
+    """
+    everything = locate_brackets(view, Region(0, view.size()),
+                                 supported_brackets, suitable_scope)
+
+    def enclosing_brackets(point):
+        stack = []
+        for bracket in everything:
+            if bracket.point >= point:
+                break
+            if bracket.is_left():
+                stack.append(bracket)
+            elif stack:
+                stack.pop()
+        stack.reverse()
+        return stack[:limit]
+
+    def matching_bracket(left_bracket):
+        depth = 0
+        for bracket in everything:
+            if bracket.point <= left_bracket.point:
+                continue
+            if bracket.is_left():
+                depth += 1
+            elif depth > 0:
+                depth -= 1
+            else:
+                return bracket
+        return None
+
+    far_left = enclosing_brackets(region.begin)
+    far_left.reverse()
+
+    far_right = []
+    for left in enclosing_brackets(region.end):
+        right = matching_bracket(left)
+        if right is None:
+            break
+        far_right.append(right)
+
+    return far_left + brackets + far_right
+
+#
+# Indexing and scopes
+#
+
+def current_lines_of_view(view, cursors):
+    """Frozen bracket_scopes.current_lines_of_view."""
+    if not cursors: return []
+
+    def as_region(sublime_region):
+        return Region(sublime_region.begin(), sublime_region.end())
+
+    lines = [as_region(view.line(cursor)) for cursor in cursors]
+
+    def consecutive(this, next):
+        return (this.end + 1) == next.begin
+
+    result = []
+    previous_line = lines[0]
+
+    for next_line in lines[1:]:
+        if consecutive(previous_line, next_line):
+            previous_line = span(previous_line, next_line)
+        else:
+            result.append(previous_line)
+            previous_line = next_line
+
+    result.append(previous_line)
+    return result
+
+
+def index_brackets(brackets, cursor, config):
+    """Frozen bracket_scopes.index_brackets, see the semantics there."""
+    def cursor_insertion_index(cursor, brackets):
+        """Returns the index of the bracket immediately following the cursor."""
+        # The bracket with the index returned will the first bracket that is
+        # located to the right of the cursor's point. Special arrangements
+        # need to be done for multicharacter left brackets to ensure that
+        # they are treated by bisect_left as 'located to the left' only
+        # when they are _entirely_ located to the left of the cursor.
+        return bisect_left(map(Bracket.inside_point, brackets), cursor)
+
+    cii = cursor_insertion_index(cursor, brackets)
+
+    inner_limit = config.inner_index_limit()
+    hidden_indices = {}
+
+    def make_index(outer_depth, inner_depth):
+        """Constructs an index, sharing the hidden ones."""
+        if (inner_limit is None) or (inner_depth <= inner_limit):
+            return outer_depth, inner_depth
+
+        index = hidden_indices.get(outer_depth)
+        if index is None:
+            index = hidden_indices[outer_depth] = (outer_depth, inner_limit + 1)
+        return index
+
+    def index_left(brackets, cii):
+        """Indexes brackets located to the left of the cursor."""
+        left_indices = []
+        outer_depth = -1
+        next_depth = 0
+
+        for bracket in reversed(brackets[0:cii]):
+            inner_depth = next_depth
+
+            if bracket.is_left():
+                if next_depth == 0:
+                    outer_depth += 1
+                else:
+                    next_depth -= 1
+            else:
+                next_depth += 1
+                inner_depth += 1
+
+            left_indices.append(make_index(outer_depth, inner_depth))
+
+        left_indices.reverse()
+        return left_indices
+
+    def index_right(brackets, cii):
+        """Indexes brackets located to the right of the cursor."""
+        right_indices = []
+        outer_depth = -1
+        next_idepth = 0
+
+        for bracket in brackets[cii:]:
+            inner_depth = next_idepth
+
+            if bracket.is_right():
+                if next_idepth == 0:
+                    outer_depth += 1
+                else:
+                    next_idepth -= 1
+            else:
+                next_idepth += 1
+                inner_depth += 1
+
+            right_indices.append(make_index(outer_depth, inner_depth))
+
+        return right_indices
+
+    return index_left(brackets, cii) + index_right(brackets, cii)
+
+
+def merge_bracket_indices(per_cursor_indices):
+    """Frozen bracket_scopes.merge_bracket_indices, -1 is the greatest."""
+    def outer_min(o1, o2):
+        return max(o1, o2) if (o1 == -1) or (o2 == -1) else min(o1, o2)
+
+    def index_minimum(pair):
+        (o1, i1), (o2, i2) = pair
+        return outer_min(o1, o2), min(i1, i2)
+
+    def merge_indices(current_min, next):
+        return map(index_minimum, zip(current_min, next))
+
+    return reduce(merge_indices, per_cursor_indices)
+
+
+def compute_bracket_scopes(brackets, indices, config):
+    """Frozen bracket_scopes.compute_bracket_scopes."""
+    inner_limit = config.inner_index_limit()
+
+    def may_be_visible(index):
+        outer, inner = index
+        if inner_limit is None:
+            return True
+
+        if inner > inner_limit:
+            return False
+
+        if inner == 0:
+            kind = RegionColor.PRIMARY if outer == 0 else RegionColor.SECONDARY
+            return config.mode[kind] is not ColorMode.NONE
+
+        return True
+
+    # The matching bracket of a left bracket is the nearest right bracket with
+    # the same index that follows it. Sweeping the brackets from the end, we
+    # keep track of the nearest right bracket for every index seen so far, so
+    # each left bracket finds its match at once instead of scanning for it.
+
+    nearest_right_brackets = {}
+
+    scopes = []
+
+    for index, bracket in reversed(zip(indices, brackets)):
+        if bracket.is_right():
+            nearest_right_brackets[index] = bracket
+            continue
+
+        if not may_be_visible(index): continue
+
+        right_bracket = nearest_right_brackets.get(index)
+        if right_bracket is not None:
+            scopes.append(Scope(index, bracket, right_bracket))
+
+    scopes.reverse()
+    return scopes
+
+#
+# Coloring
+#
+
+def color_scopes(scopes, config, cursors, supported_brackets):
+    """Frozen bracket_coloring.color_scopes."""
+    result = []
+    for _, spans in colorable_spans_of(scopes, config, cursors, supported_brackets):
+        result.extend(spans)
+    return result
+
+
+def colorable_spans_of(scopes, config, cursors, supported_brackets):
+    """Frozen bracket_coloring.colorable_spans_of."""
+    def color_type_of(scope):
+        if scope.is_not_consistent_with(supported_brackets):
+            return RegionColor.INCONSISTENT, None
+
+        if scope.is_primary_mainline():
+            return RegionColor.PRIMARY, None
+
+        if scope.is_secondary_mainline():
+            return RegionColor.SECONDARY, scope.outer_index
+
+        if is_adjacent_to(scope, cursors):
+            return RegionColor.ADJACENT, None
+
+        if scope.is_offside():
+            return RegionColor.OFFSIDE, scope.inner_index
+
+    def is_adjacent_to(scope, cursors):
+        for cursor in cursors:
+            if scope.left_bracket.contains(cursor) or \
+               scope.right_bracket.contains(cursor):
+                return True
+        else:
+            return False
+
+    def extents_of(scope, mode):
+        if mode is ColorMode.NONE:
+            return []
+
+        if mode is ColorMode.BRACKETS:
+            return list(scope.bracket_regions())
+
+        if mode is ColorMode.EXPRESSION:
+            return [scope.expression_region()]
+
+    def suitable(scope, region_color):
+        kind, index = region_color
+        if kind is RegionColor.OFFSIDE:
+            return index <= config.offside_limit
+
+        if kind is RegionColor.ADJACENT:
+            need_left = config.adjacent_left
+            need_right = config.adjacent_right
+
+            for cursor in cursors:
+                if (need_left and scope.left_bracket.contains(cursor)) or \
+                   (need_right and scope.right_bracket.contains(cursor)):
+                    return True
+            else:
+                return False
+
+        return True
+
+    def touching(left_scope, right_scope):
+        left_region = left_scope.expression_region()
+        right_region = right_scope.expression_region()
+        return left_region.touches(right_region)
+
+    def opaque(color_type):
+        _, background = color_of(color_type, config)
+        return background is not None
+
+    # Only the topmost opaque background of the enclosing scopes shows through,
+    # so that is all the background stacks keep. They are computed once for
+    # each enclosing scope and shared by everything nested in it, which keeps
+    # deeply nested expressions from being quadratic.
+
+    bg_scope_stack = []
+
+    for scope in scopes:
+        kind, index = fg_color_type = color_type_of(scope)
+        if not suitable(scope, fg_color_type):
+            continue
+
+        mode = config.mode[kind]
+        if mode is ColorMode.NONE:
+            continue
+
+        while bg_scope_stack and not touching(bg_scope_stack[-1][0], scope):
+            bg_scope_stack.pop()
+
+        bg_color_stack = bg_scope_stack[-1][1] if bg_scope_stack else []
+
+        spans = [ColorableSpan(extent, fg_color_type, bg_color_stack)
+                 for extent in extents_of(scope, mode)]
+
+        if mode is ColorMode.EXPRESSION:
+            if opaque(fg_color_type):
+                bg_scope_stack.append((scope, [fg_color_type]))
+            else:
+                bg_scope_stack.append((scope, bg_color_stack))
+
+        yield scope, spans
+
+
+def split_into_disjoint(spans, lines):
+    """Frozen bracket_coloring.split_into_disjoint."""
+    if not spans: return []
+
+    # Throwing in fake zero-length spans to denote the line boundaries. They
+    # will be used only for splitting and will get filtered out of the results.
+    #
+    # Lines are (begin, end) where begin is the point at the start of the line
+    # and end is the one at the newline character. The line boundaries are all
+    # the beginnings and the trailing end.
+
+    def make_linebreak(point):
+        return ColorableSpan(Region(point, point), None, None)
+
+    def linebreak(span):
+        return (span.foreground is None) and (span.background_stack is None)
+
+    linebreaks = map(make_linebreak, [L.begin for L in lines] + [lines[-1].end])
+
+    # We make use of the heap property to efficiently split the spans into
+    # disjoint parts with a sweeping line algorithm. The resulting span list
+    # also gets automagically sorted.
+    #
+    # Heap entries are keyed by (begin, end, order) where order is the place
+    # of the span among the spans sorted by their beginning, the ones which
+    # begin at the same point are kept in the given order. Of the spans with
+    # the same extent the first one keeps its colors there, and the parts of
+    # a span keep its order. This is the order iter_colored_scopes yields.
+
+    def heap_min(heap):
+        return heap[0]
+
+    def heap_min_next(heap):
+        return min(heap[1], heap[2]) if len(heap) > 2 else heap[1]
+
+    def keyed(span, order):
+        return (span.extent.begin, span.extent.end, order, span)
+
+    spans = sorted(spans, key=lambda span: span.extent.begin)
+
+    heap = [keyed(span, order) for order, span in enumerate(spans + linebreaks)]
+    heapify(heap)
+
+    def overlap(left_span, right_span):
+        return left_span.extent.overlaps(right_span.extent)
+
+    def left_touch(span1, span2):
+        return span1.extent.begin == span2.extent.begin
+
+    def trim(inner_span, outer_span):
+        extent = Region(inner_span.extent.end, outer_span.extent.end)
+        foreground = outer_span.foreground
+        background_stack = outer_span.background_stack
+
+        return ColorableSpan(extent, foreground, background_stack)
+
+    def split(outer_span, inner_span):
+        # Scopes matched over several cursors may cross each other. Then the
+        # inner span sticks out of the outer one and takes its tail entirely.
+        extent1 = Region(outer_span.extent.begin, inner_span.extent.begin)
+        extent2 = Region(min(inner_span.extent.end, outer_span.extent.end),
+                         outer_span.extent.end)
+        foreground = outer_span.foreground
+        background_stack = outer_span.background_stack
+
+        return ColorableSpan(extent1, foreground, background_stack), \
+               ColorableSpan(extent2, foreground, background_stack)
+
+    result = []
+    while len(heap) > 1:
+        (_, _, order, leftmost), (_, _, next_order, next_one) = \
+            heap_min(heap), heap_min_next(heap)
+        # Invariant: leftmost must be disjoint from all other spans
+
+        if overlap(leftmost, next_one):
+            if left_touch(leftmost, next_one):
+                # LL...... -> LL......
+                # NNNNN...    ..FFF...
+                following = trim(leftmost, next_one)
+                heappop(heap)
+                heapreplace(heap, keyed(following, next_order))
+            else:
+                # LLLLLLL. -> LL...FF.
+                # ..NNN...    ..NNN...
+                leftmost, following = split(leftmost, next_one)
+                heapreplace(heap, keyed(following, order))
+        else:
+            # LLL.....
+            # ....NNN.
+            heappop(heap)
+
+        if not linebreak(leftmost):
+            result.append(leftmost)
+
+    last_span = heap[0][3]
+    if not linebreak(last_span):
+        result.append(last_span)
+
+    return result
+
+
+def prepend_background(spans, line_extents):
+    """Frozen bracket_coloring.prepend_background."""
+    def prepend_background(span):
+        current_line_color = [(RegionColor.CURRENT_LINE, None)]
+        background_color = [(RegionColor.BACKGROUND, None)]
+
+        background_stack = span.background_stack
+
+        for line in line_extents:
+            if line.contains(span.extent):
+                background_stack = current_line_color + background_stack
+                break
+        else:
+            background_stack = background_color + background_stack
+
+        return ColorableSpan(span.extent, span.foreground, background_stack)
+
+    return map(prepend_background, spans)
+
+
+def compute_span_color(span, config):
+    """Frozen bracket_coloring.compute_span_color."""
+    foreground, background = color_of(span.foreground, config)
+
+    underlying_background = reversed(span.background_stack)
+    while background is None:
+        _, background = color_of(next(underlying_background), config)
+
+    return foreground, background
+
+
+def color_of(region_color, config):
+    """Frozen bracket_coloring.color_of."""
+    kind, index = region_color
+    color = config.color[kind]
+    if isinstance(color, list):
+        color = color[(index - 1) % len(color)]
+    return color
@@ -0,0 +1,218 @@
+"""Replays a trace of selection events recorded in the editor through the whole
+pipeline and reports latencies.
+
+Traces are recorded by the plugin when `trace_path` is set, or with the
+lisp_highlight_toggle_trace command (see event_trace.py for the format). The
+buffers are rebuilt from the texts recorded in the trace and edited along
+with the recorded edits, every view gets its recorded selection before its
+event is replayed. The events of the buffers whose texts are missing from
+the trace (recorded without snapshots) are replayed on the last text known,
+or skipped if none is known at all. Usage:
+
+    python benchmarks/replay.py [--streaming] [--rainbow] [--scan-limit N] [--budget MS]
+                                [--gaps] [--regions FILE] [--captures DIR [--capture-threshold MS]]
+                                [--json FILE] TRACE
+
+The same trace replayed with different options compares the engines on the
+very input they have been slow on, and with --regions the highlighted regions
+are written out after every event, to diff what the engines have rendered.
+With --captures the events slower than --capture-threshold are profiled and
+captured like the slow-event watchdog of the plugin does.
+"""
+import bootstrap
+
+import json
+import optparse
+import sys
+
+import sublime
+import lisp_highlight
+
+from lisp_highlight_configuration import ColorMode, RegionColor
+from run import measure, print_report
+from slow_events import SlowEventWatchdog
+
+# Pauses between the events longer than this are shortened to it when --gaps
+# are replayed, nothing in the plugin waits for longer.
+MAX_GAP_MS = 5000
+
+#
+# Traces
+#
+
+def read_trace(path):
+    """Reads the trace file.
+
+    Returns:
+        (header, [event]) - dictionaries of the lines of the trace
+    """
+    header = None
+    events = []
+    with open(path) as trace:
+        for line in trace:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'trace' in entry:
+                # Traces may be appended to, only the last recording counts.
+                header = entry
+                events = []
+            else:
+                events.append(entry)
+    return header, events
+
+
+class TraceWorkload:
+    """A workload (see workloads.py) which replays the events of a trace.
+
+    Fields:
+        [event] events - the events to replay
+
+        gaps - whether to let the recorded time pass between the events
+
+        stale, skipped - the number of events of the last replay which have
+                         been replayed on outdated texts, or skipped because
+                         their texts were unknown
+    """
+    def __init__(self, events, gaps=False):
+        self.events = events
+        self.gaps = gaps
+        self.stale = 0
+        self.skipped = 0
+
+    def __call__(self, rng):
+        self.stale = 0
+        self.skipped = 0
+
+        buffers = {} # recorded buffer id -> (sublime.Buffer, digest of its text)
+        views = {}   # recorded view id -> sublime.View
+        last_time = None
+
+        for event in self.events:
+            buffer, digest = buffers.get(event['buffer'], (None, None))
+            if 'text' in event:
+                if buffer is None:
+                    buffer = sublime.Buffer(event['text'], event.get('file'))
+                else:
+                    buffer.replace(0, len(buffer.text), event['text'])
+                digest = event['sha1']
+                buffers[event['buffer']] = buffer, digest
+            elif ('edit' in event) and (buffer is not None):
+                begin, end, text = event['edit']
+                buffer.replace(begin, end, text)
+                digest = event['sha1']
+                buffers[event['buffer']] = buffer, digest
+
+            if buffer is None:
+                self.skipped += 1
+                continue
+            if digest != event['sha1']:
+                self.stale += 1
+
+            view = views.get(event['view'])
+            if view is None:
+                view = views[event['view']] = sublime.View(buffer)
+
+            size = len(buffer.text)
+            view.selection = [sublime.Region(min(a, size), min(b, size))
+                              for a, b in event['sel']]
+
+            # The background work due right away, e.g. the captures of the
+            # slow events, runs between the events as it does in the editor.
+            if last_time is not None:
+                gap = 0
+                if self.gaps:
+                    gap = min((event['t'] - last_time) * 1000.0, MAX_GAP_MS)
+                sublime.idle(gap)
+            last_time = event['t']
+
+            yield view
+
+
+def write_regions(workload, output):
+    """Replays the workload, writing the regions of every view after its event
+    as a JSON line.
+    """
+    for view in workload(None):
+        try:
+            lisp_highlight.highlight_view(view)
+        except AssertionError:
+            output.write('"failed"\n')
+            continue
+
+        # The engines may render the same regions in different order.
+        regions = dict((key, sorted([region.a, region.b] for region in regions))
+                       for key, regions in view.regions.iteritems())
+        output.write(json.dumps(regions, sort_keys=True) + '\n')
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] TRACE")
+    parser.add_option('--scan-limit', type='int', default=lisp_highlight.scan_limit,
+                      help="radius of the examined regions around the cursors")
+    parser.add_option('--streaming', action='store_true',
+                      help="use the streaming pipeline")
+    parser.add_option('--rainbow', action='store_true',
+                      help="also color the visible brackets by depth")
+    parser.add_option('--budget', type='int', default=lisp_highlight.latency_budget,
+                      metavar='MS', help="latency budget of the events, 0 turns it off")
+    parser.add_option('--gaps', action='store_true',
+                      help="let the recorded time pass between the events")
+    parser.add_option('--regions', metavar='FILE',
+                      help="also write the highlighted regions after every event")
+    parser.add_option('--captures', metavar='DIR',
+                      help="capture the slow events into the directory (see slow_events.py)")
+    parser.add_option('--capture-threshold', type='int', default=100, metavar='MS',
+                      help="latency of the events to capture")
+    parser.add_option('--json', metavar='FILE',
+                      help="also write the report as JSON into the file")
+    options, arguments = parser.parse_args()
+    if len(arguments) != 1:
+        parser.error("expected one trace file")
+
+    lisp_highlight.scan_limit = options.scan_limit
+    lisp_highlight.streaming_pipeline = bool(options.streaming)
+    lisp_highlight.latency_budget = options.budget or None
+    lisp_highlight.slow_event_watchdog = None
+    if options.captures:
+        lisp_highlight.slow_event_watchdog = SlowEventWatchdog(options.captures,
+            options.capture_threshold, keep=1000, cooldown=0)
+    if options.rainbow:
+        lisp_highlight.config.mode[RegionColor.RAINBOW] = ColorMode.BRACKETS
+
+    header, events = read_trace(arguments[0])
+    if header is None:
+        parser.error("%s is not a trace" % arguments[0])
+    if not any('text' in event for event in events):
+        parser.error("%s has no texts to replay the events on" % arguments[0])
+
+    workload = TraceWorkload(events, bool(options.gaps))
+    report = measure(workload, 0)
+    report['stale'] = workload.stale
+    report['skipped'] = workload.skipped
+
+    print_report(arguments[0], report)
+    if workload.stale or workload.skipped:
+        print("    %d events replayed on outdated texts, %d skipped without texts" %
+              (workload.stale, workload.skipped))
+    sys.stdout.flush()
+
+    if options.regions:
+        with open(options.regions, 'w') as output:
+            write_regions(workload, output)
+
+    if options.json:
+        with open(options.json, 'w') as output:
+            json.dump({
+                'trace': arguments[0],
+                'scan_limit': options.scan_limit,
+                'streaming': bool(options.streaming),
+                'rainbow': bool(options.rainbow),
+                'gaps': bool(options.gaps),
+                'budget': options.budget,
+                'report': report,
+            }, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
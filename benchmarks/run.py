@@ -0,0 +1,175 @@
+"""Replays the workloads through the whole pipeline and reports latencies.
+
+Every workload is replayed twice: first as is, to measure the end-to-end
+latency of the selection events, and then with instrumentation enabled, to
+break the time down by the pipeline stages. Usage:
+
+    python benchmarks/run.py [--workload NAME]... [--streaming] [--rainbow] [--idle MS]
+                                [--enclosing N [--speculate]]
+                                [--processes N [--pool-cursors N]] [--json FILE]
+
+The JSON report is meant to be kept around to compare the releases. Exits
+with a non-zero status if the pipeline has failed an assertion in any event.
+"""
+import bootstrap
+
+import json
+import optparse
+import platform
+import random
+import sys
+import time
+
+import sublime
+import lisp_highlight
+
+from instrumentation import Histogram, Instrumentation
+from lisp_highlight_configuration import ColorMode, RegionColor
+from region_pool import RegionPool
+from speculation import Speculator
+from workloads import WORKLOADS
+
+
+def replay(workload, seed, idle=0):
+    """Replays a workload, letting `idle` milliseconds pass between events.
+    The background work due by then runs between the events, outside of their
+    latencies, like the bracket balances of the large files being built.
+
+    Returns:
+        ([latency], failures)
+            - latencies of the events in ms, and the number of events
+              that failed with an AssertionError in the pipeline
+    """
+    latencies = []
+    failures = 0
+    for view in workload(random.Random(seed)):
+        started = time.time()
+        try:
+            lisp_highlight.highlight_view(view)
+        except AssertionError:
+            failures += 1
+        latencies.append((time.time() - started) * 1000.0)
+        sublime.idle(idle)
+    return latencies, failures
+
+
+def measure(workload, seed, idle=0):
+    """Measures a workload, returning a report dictionary."""
+    lisp_highlight.instrumentation = Instrumentation(enabled=False)
+    latencies, failures = replay(workload, seed, idle)
+    counters = lisp_highlight.instrumentation.counters
+
+    total = Histogram(len(latencies))
+    for latency in latencies:
+        total.add(latency)
+
+    lisp_highlight.instrumentation = Instrumentation(enabled=True, window=len(latencies))
+    replay(workload, seed, idle)
+
+    histograms = lisp_highlight.instrumentation.histograms
+    stages = dict((name[len('time.'):], histogram.summary())
+                  for name, histogram in histograms.iteritems()
+                  if name.startswith('time.'))
+    counts = dict((name, histogram.summary())
+                  for name, histogram in histograms.iteritems()
+                  if not name.startswith('time.'))
+
+    return {'events': len(latencies), 'failures': failures,
+            'latency_ms': total.summary(),
+            'stages_ms': stages, 'counts': counts, 'counters': counters}
+
+
+def print_report(name, report):
+    latency = report['latency_ms']
+    print("%s: %d events (%d failed), p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms" %
+          (name, report['events'], report['failures'], latency['p50'],
+           latency['p90'], latency['p99'], latency['max']))
+
+    stages = report['stages_ms']
+    for stage in sorted(stages, key=lambda stage: -stages[stage]['mean']):
+        summary = stages[stage]
+        print("    %-14s mean %8.3f  p50 %8.3f  p90 %8.3f  p99 %8.3f" %
+              (stage, summary['mean'], summary['p50'], summary['p90'], summary['p99']))
+
+    counters = report['counters']
+    for name in sorted(counters):
+        print("    %-22s %d" % (name, counters[name]))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--workload', action='append', dest='workloads',
+                      choices=[name for name, _ in WORKLOADS],
+                      help="a workload to run, may be repeated (default: all)")
+    parser.add_option('--seed', type='int', default=0,
+                      help="seed of the workload generators")
+    parser.add_option('--scan-limit', type='int', default=lisp_highlight.scan_limit,
+                      help="radius of the examined regions around the cursors")
+    parser.add_option('--enclosing', type='int', default=lisp_highlight.enclosing_limit,
+                      metavar='N', help="look up N expressions enclosing the examined regions")
+    parser.add_option('--speculate', action='store_true',
+                      help="locate the brackets around the caret while idle")
+    parser.add_option('--streaming', action='store_true',
+                      help="use the streaming pipeline")
+    parser.add_option('--rainbow', action='store_true',
+                      help="also color the visible brackets by depth")
+    parser.add_option('--idle', type='int', default=0, metavar='MS',
+                      help="let the time pass without events between events")
+    parser.add_option('--budget', type='int', default=lisp_highlight.latency_budget,
+                      metavar='MS', help="latency budget of the events, 0 turns it off")
+    parser.add_option('--processes', type='int', default=0, metavar='N',
+                      help="color the examined regions of large events in N processes")
+    parser.add_option('--pool-cursors', type='int', default=200, metavar='N',
+                      help="cursors an event needs to be colored in the processes")
+    parser.add_option('--json', metavar='FILE',
+                      help="also write the report as JSON into the file")
+    options, _ = parser.parse_args()
+
+    lisp_highlight.scan_limit = options.scan_limit
+    lisp_highlight.enclosing_limit = options.enclosing
+    lisp_highlight.streaming_pipeline = bool(options.streaming)
+    lisp_highlight.latency_budget = options.budget or None
+    # Captures would be measured as parts of the events.
+    lisp_highlight.slow_event_watchdog = None
+    if options.rainbow:
+        lisp_highlight.config.mode[RegionColor.RAINBOW] = ColorMode.BRACKETS
+    if options.speculate:
+        lisp_highlight.speculator = Speculator(delay=300, budget=50, slice=5, radius=100,
+            queue=lisp_highlight.work_queue, set_timeout=lisp_highlight.set_timeout_background)
+    if options.processes > 0:
+        lisp_highlight.region_pool = RegionPool(options.processes, options.pool_cursors)
+
+    reports = {}
+    for name, workload in WORKLOADS:
+        if options.workloads and name not in options.workloads:
+            continue
+
+        reports[name] = measure(workload, options.seed, options.idle)
+        print_report(name, reports[name])
+        sys.stdout.flush()
+
+    if options.json:
+        with open(options.json, 'w') as output:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'seed': options.seed,
+                'scan_limit': options.scan_limit,
+                'enclosing': options.enclosing,
+                'streaming': bool(options.streaming),
+                'rainbow': bool(options.rainbow),
+                'idle': options.idle,
+                'speculate': bool(options.speculate),
+                'budget': options.budget,
+                'processes': options.processes,
+                'workloads': reports,
+            }, output, indent=2, sort_keys=True)
+
+    failed = [name for name in sorted(reports) if reports[name]['failures']]
+    for name in failed:
+        sys.stderr.write("%s: %d events failed\n" % (name, reports[name]['failures']))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
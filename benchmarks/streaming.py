@@ -0,0 +1,118 @@
+"""Compares the batch and the streaming pipelines on a single large form.
+
+Generates a file consisting of one top-level form (1 MB by default), puts
+a cursor in its middle, and highlights the whole file with both pipelines.
+Every pipeline is run in a fresh process so that the peak resident set
+sizes do not interfere. Usage:
+
+    python benchmarks/streaming.py [--size BYTES] [--repeat N]
+"""
+import bootstrap
+
+import json
+import optparse
+import resource
+import subprocess
+import sys
+import time
+
+import sublime
+import lisp_highlight
+
+from bracket_scopes \
+    import cursors_of_view, expand_cursors_to_regions, merge_adjacent_regions
+
+from workloads import single_form_source
+
+
+def highlight_in_batches(view, cursors, config):
+    expanded_regions = expand_cursors_to_regions(cursors, lisp_highlight.scan_limit, view)
+    examined_regions = merge_adjacent_regions(expanded_regions, cursors)
+
+    altogether = []
+    for region, region_cursors in examined_regions:
+        colored_regions = lisp_highlight.highlight_examined_region(
+            view, region, region_cursors, config)
+        for color, regions in colored_regions.iteritems():
+            altogether.extend(region.as_sublime_region() for region in regions)
+    return altogether
+
+
+def highlight_in_stream(view, cursors, config):
+    colored_regions = lisp_highlight.highlight_lazily(view, cursors, config)
+
+    altogether = []
+    for color, regions in colored_regions.iteritems():
+        altogether.extend(regions)
+    return altogether
+
+
+PIPELINES = {
+    'batch': highlight_in_batches,
+    'streaming': highlight_in_stream,
+}
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_child(pipeline, size):
+    text = single_form_source(size)
+    view = sublime.View(text, [len(text) // 2])
+    cursors = cursors_of_view(view)
+
+    # Examine the whole file at once.
+    lisp_highlight.scan_limit = len(text)
+
+    rss_before = peak_rss_kb()
+    started = time.time()
+    regions = PIPELINES[pipeline](view, cursors, lisp_highlight.config)
+    elapsed = time.time() - started
+    rss_after = peak_rss_kb()
+
+    json.dump({
+        'pipeline': pipeline,
+        'size': len(text),
+        'regions': len(regions),
+        'seconds': elapsed,
+        'peak_rss_kb': rss_after,
+        'peak_rss_growth_kb': rss_after - rss_before,
+    }, sys.stdout)
+
+
+def run_parent(size, repeat):
+    print("%-10s %10s %10s %14s %14s" %
+          ("pipeline", "regions", "time, s", "peak RSS, KB", "growth, KB"))
+
+    for pipeline in sorted(PIPELINES):
+        results = []
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, __file__,
+                '--child', pipeline, '--size', str(size)])
+            results.append(json.loads(output))
+
+        best = min(results, key=lambda result: result['seconds'])
+        print("%-10s %10d %10.3f %14d %14d" %
+              (pipeline, best['regions'], best['seconds'],
+               best['peak_rss_kb'], best['peak_rss_growth_kb']))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--size', type='int', default=1024 * 1024,
+                      help="size of the generated form, in bytes")
+    parser.add_option('--repeat', type='int', default=3,
+                      help="how many times to run each pipeline")
+    parser.add_option('--child', choices=sorted(PIPELINES),
+                      help=optparse.SUPPRESS_HELP)
+    options, _ = parser.parse_args()
+
+    if options.child:
+        run_child(options.child, options.size)
+    else:
+        run_parent(options.size, options.repeat)
+
+
+if __name__ == '__main__':
+    main()
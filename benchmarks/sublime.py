@@ -0,0 +1,442 @@
+"""An in-memory stand-in for the sublime module of Sublime Text.
+
+This is just enough of the sublime API to run the highlighting pipeline
+outside of the editor. Buffers hold their text in memory and derive scope
+names from a trivial Lisp lexer which knows only strings and comments.
+A buffer may be shown in several views, which have their own selections.
+Views may be put into the groups of windows, or stay out of any window.
+"""
+from bisect import bisect_right
+from heapq import heappop, heappush
+
+
+class Region(object):
+    """A companion of sublime.Region, possibly reversed."""
+
+    def __init__(self, a, b=None):
+        if b is None: b = a
+        self.a, self.b = a, b
+
+    def begin(self): return min(self.a, self.b)
+    def end(self): return max(self.a, self.b)
+    def size(self): return abs(self.b - self.a)
+    def empty(self): return self.a == self.b
+
+    def __eq__(self, other):
+        return (self.a, self.b) == (other.a, other.b)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __repr__(self):
+        return "(%d, %d)" % (self.a, self.b)
+
+
+def status_message(message):
+    pass
+
+#
+# Timeouts
+#
+
+# There is no event loop, the callbacks wait until idle() is called. Time is
+# virtual and passes only while idle, in milliseconds. The worker thread runs
+# its callbacks along with the ones of the main thread, in the same order.
+_now = [0]
+_timeouts = []
+_scheduled = [0]
+
+
+def set_timeout(callback, delay):
+    _scheduled[0] += 1
+    heappush(_timeouts, (_now[0] + delay, _scheduled[0], callback))
+
+
+def set_timeout_async(callback, delay):
+    set_timeout(callback, delay)
+
+
+def idle(duration):
+    """Lets the time pass without events, running the callbacks that come
+    due in the meantime, in order.
+    """
+    until = _now[0] + duration
+    while _timeouts and _timeouts[0][0] <= until:
+        due, _, callback = heappop(_timeouts)
+        _now[0] = max(_now[0], due)
+        callback()
+    _now[0] = until
+
+
+#
+# Windows
+#
+
+_windows = []
+_active_window = [None]
+
+
+def windows():
+    return list(_windows)
+
+
+def active_window():
+    return _active_window[0]
+
+
+class Window(object):
+    """A window with views in its groups, one of them active in every group.
+
+    The window that has been created or has focused a view the last is the
+    active one.
+
+    Args:
+        groups - the number of groups the window is split into
+    """
+    _last_id = 0
+
+    def __init__(self, groups=1):
+        Window._last_id += 1
+        self._id = Window._last_id
+
+        self._views = [[] for _ in range(groups)]
+        self._active_views = [None] * groups
+        self._active_group = 0
+
+        _windows.append(self)
+        _active_window[0] = self
+
+    def id(self):
+        return self._id
+
+    def views(self):
+        return [view for views in self._views for view in views]
+
+    def num_groups(self):
+        return len(self._views)
+
+    def active_group(self):
+        return self._active_group
+
+    def active_view_in_group(self, group):
+        return self._active_views[group]
+
+    def active_view(self):
+        return self._active_views[self._active_group]
+
+    def add_view(self, view, group=0):
+        """Opens the view in the group, in a background tab unless the group
+        has no other views.
+        """
+        view._window = self
+        self._views[group].append(view)
+        if self._active_views[group] is None:
+            self._active_views[group] = view
+
+    def focus_view(self, view):
+        """Makes the view the active one of its group, and the group and
+        the window active.
+        """
+        for group, views in enumerate(self._views):
+            if view in views:
+                self._active_views[group] = view
+                self._active_group = group
+        _active_window[0] = self
+
+    def remove_view(self, view):
+        for group, views in enumerate(self._views):
+            if view in views:
+                views.remove(view)
+                if self._active_views[group] is view:
+                    self._active_views[group] = views[-1] if views else None
+        view._window = None
+
+    def close(self):
+        for view in self.views():
+            self.remove_view(view)
+        _windows.remove(self)
+        if _active_window[0] is self:
+            _active_window[0] = _windows[-1] if _windows else None
+
+
+class Edit(object):
+    """A token of an edit, as returned by View.begin_edit."""
+
+
+class HistoricPosition(object):
+    """A point in the text as it was before a change."""
+
+    def __init__(self, pt, change_count):
+        self.pt = pt
+        self.change_count = change_count
+
+
+class TextChange(object):
+    """A change of the text, as passed to TextChangeListener."""
+
+    def __init__(self, a, b, str):
+        self.a = a
+        self.b = b
+        self.str = str
+
+
+class Settings(object):
+    """The settings of a view."""
+
+    def __init__(self, values):
+        self._values = dict(values)
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        self._values[key] = value
+
+
+class Buffer(object):
+    """The text shown by one or more views, with its scopes.
+
+    Args:
+        text - the contents of the buffer
+
+        file_name - the path of the file the buffer holds, or None
+
+        base_scope - the base scope of the syntax of the buffer, which all
+                     the scope names begin with
+    """
+    _last_id = 0
+
+    def __init__(self, text, file_name=None, base_scope="source.lisp"):
+        Buffer._last_id += 1
+        self._id = Buffer._last_id
+        self.change_count = 0
+        self.file_name = file_name
+        self.base_scope = base_scope
+
+        self.text = text
+        self._views = []
+        self._listeners = None
+        self._lex()
+
+    def id(self):
+        return self._id
+
+    def primary_view(self):
+        return self._views[0]
+
+    def replace(self, begin, end, string):
+        """Replaces the text between the points, moving the cursors of all
+        the views which are at or after the change, and tells the text change
+        listeners about it.
+        """
+        change_count = self.change_count
+        self.text = self.text[:begin] + string + self.text[end:]
+        self.change_count += 1
+        self._lex()
+
+        def moved(cursor):
+            if cursor >= end: return cursor - (end - begin) + len(string)
+            if cursor > begin: return begin
+            return cursor
+
+        for view in self._views:
+            view.selection = [Region(moved(r.a), moved(r.b)) for r in view.selection]
+
+        # The listeners are attached the first time the text changes, the
+        # plugin may not be loaded when the buffer is created.
+        if self._listeners is None:
+            import sublime_plugin
+            self._listeners = []
+            for listener_class in sublime_plugin.TextChangeListener.__subclasses__():
+                if listener_class.is_applicable(self):
+                    listener = listener_class()
+                    listener.attach(self)
+                    self._listeners.append(listener)
+
+        change = TextChange(HistoricPosition(begin, change_count),
+                            HistoricPosition(end, change_count), string)
+        for listener in self._listeners:
+            listener.on_text_changed([change])
+
+    def _lex(self):
+        # Sorted points where the lexical spans begin, along with the scope
+        # names of these spans. A scope of a point is the one of the span
+        # which begins at or right before it.
+        base = self.base_scope
+        self.boundaries = [0]
+        self.kinds = [base]
+
+        text, point, size = self.text, 0, len(self.text)
+
+        def mark(point, kind):
+            self.boundaries.append(point)
+            self.kinds.append(kind)
+
+        while point < size:
+            string_start = text.find('"', point)
+            comment_start = text.find(';', point)
+
+            if string_start < 0: string_start = size
+            if comment_start < 0: comment_start = size
+
+            if string_start == comment_start == size:
+                break
+
+            if string_start < comment_start:
+                mark(string_start, base + " string.quoted.double.lisp")
+                end = text.find('"', string_start + 1)
+                end = size if end < 0 else end + 1
+            else:
+                mark(comment_start, base + " comment.line.semicolon.lisp")
+                end = text.find('\n', comment_start)
+                end = size if end < 0 else end
+
+            mark(end, base)
+            point = end
+
+
+class Selection(object):
+    """The selection of a view, the regions are kept sorted but overlapping
+    ones are not merged.
+    """
+    def __init__(self, view):
+        self._view = view
+
+    def __len__(self):
+        return len(self._view.selection)
+
+    def __iter__(self):
+        return iter(self._view.selection)
+
+    def __getitem__(self, index):
+        return self._view.selection[index]
+
+    def clear(self):
+        self._view.selection = []
+
+    def add(self, region):
+        self._view.selection = sorted(self._view.selection + [region],
+                                      key=lambda region: region.begin())
+
+
+class View(object):
+    """A view of a text buffer, with its own selection.
+
+    Args:
+        text - the contents of the view, or the Buffer to show
+
+        [cursors] - points where the (empty) selection regions are
+
+        file_name - the path of the file the view shows, or None
+    """
+    _last_id = 0
+
+    visible_lines = 50
+
+    def __init__(self, text, cursors=(), file_name=None):
+        View._last_id += 1
+        self._id = View._last_id
+
+        if isinstance(text, Buffer):
+            self.buffer = text
+        else:
+            self.buffer = Buffer(text, file_name)
+        self.buffer._views.append(self)
+
+        self.selection = [Region(cursor) for cursor in cursors]
+        self.regions = {}
+        self._window = None
+        self._settings = Settings({'syntax': 'Packages/Lisp/Lisp.tmLanguage'})
+
+    @property
+    def text(self):
+        return self.buffer.text
+
+    def id(self):
+        return self._id
+
+    def buffer_id(self):
+        return self.buffer.id()
+
+    def clone(self):
+        """Opens another view of the buffer, with the same selection."""
+        view = View(self.buffer)
+        view.selection = list(self.selection)
+        return view
+
+    def close(self):
+        if self._window is not None:
+            self._window.remove_view(self)
+        self.buffer._views.remove(self)
+
+    def window(self):
+        return self._window
+
+    def change_count(self):
+        return self.buffer.change_count
+
+    def file_name(self):
+        return self.buffer.file_name
+
+    def settings(self):
+        return self._settings
+
+    def set_cursors(self, cursors):
+        """Replaces the selection with empty regions at the given points."""
+        self.selection = [Region(cursor) for cursor in cursors]
+
+    def begin_edit(self, *args):
+        return Edit()
+
+    def end_edit(self, edit):
+        pass
+
+    def insert(self, edit, point, string):
+        """Inserts the string, moving the cursors at or after the point."""
+        self.buffer.replace(point, point, string)
+        return len(string)
+
+    def erase(self, edit, region):
+        """Erases the region, moving the cursors after it."""
+        self.buffer.replace(region.begin(), region.end(), '')
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        if isinstance(region, Region):
+            return self.text[region.begin():region.end()]
+        return self.text[region:region + 1]
+
+    def scope_name(self, point):
+        buffer = self.buffer
+        return buffer.kinds[bisect_right(buffer.boundaries, point) - 1]
+
+    def sel(self):
+        return Selection(self)
+
+    def visible_region(self):
+        """Pretends the viewport shows some lines around the first cursor."""
+        point = self.selection[0].b if self.selection else 0
+        begin, end = point, point
+        for _ in range(self.visible_lines // 2):
+            begin = max(0, self.text.rfind('\n', 0, begin))
+            end = self.text.find('\n', end + 1)
+            if end < 0: end = len(self.text)
+        return Region(begin, end)
+
+    def line(self, point):
+        if isinstance(point, Region): point = point.begin()
+        begin = self.text.rfind('\n', 0, point) + 1
+        end = self.text.find('\n', point)
+        if end < 0: end = len(self.text)
+        return Region(begin, end)
+
+    def add_regions(self, key, regions, scope, *args):
+        self.regions[key] = list(regions)
+
+    def erase_regions(self, key):
+        self.regions.pop(key, None)
+
+    def get_regions(self, key):
+        return self.regions.get(key, [])
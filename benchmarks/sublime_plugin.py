@@ -0,0 +1,33 @@
+"""An in-memory stand-in for the sublime_plugin module of Sublime Text."""
+
+
+class EventListener(object):
+    pass
+
+
+class ViewEventListener(object):
+
+    def __init__(self, view):
+        self.view = view
+
+
+class TextChangeListener(object):
+
+    @classmethod
+    def is_applicable(cls, buffer):
+        return True
+
+    def attach(self, buffer):
+        self.buffer = buffer
+
+
+class WindowCommand(object):
+
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand(object):
+
+    def __init__(self, view):
+        self.view = view
@@ -0,0 +1,222 @@
+"""Synthetic Lisp sources and editing sessions to replay through the plugin.
+
+A workload is a function of a random generator which yields the view once
+per selection event, after updating its text and cursors the way a user
+would have done. The same seed always produces the same session.
+"""
+import random
+
+import sublime
+
+#
+# Sources
+#
+
+def lisp_source(size, seed=0):
+    """Generates about `size` characters of Lisp code of many top-level forms."""
+    rng = random.Random(seed)
+
+    def symbol():
+        return rng.choice(['x', 'y', 'acc', 'item', 'node', 'count', 'rest',
+                           'table', 'key', 'value', 'result', 'limit'])
+
+    def atom():
+        choice = rng.random()
+        if choice < 0.5: return symbol()
+        if choice < 0.8: return str(rng.randint(0, 1000))
+        if choice < 0.9: return ':' + symbol()
+        return '"%s (%s)"' % (symbol(), symbol())
+
+    def expression(depth):
+        if depth <= 0 or rng.random() < 0.3:
+            return atom()
+
+        left, right = rng.choice([('(', ')')] * 6 + [('[', ']'), ('{', '}')])
+        items = [symbol()] + [expression(depth - 1) for _ in range(rng.randint(1, 4))]
+        return left + ' '.join(items) + right
+
+    def form(index):
+        lines = [';; Definition number %d (see also [%d])' % (index, index + 1),
+                 '(defun %s-%d (%s %s)' % (symbol(), index, symbol(), symbol()),
+                 '  "Docstring with (unbalanced brackets."']
+        for _ in range(rng.randint(2, 6)):
+            lines.append('  ' + expression(rng.randint(2, 6)))
+        lines[-1] += ')'
+        return '\n'.join(lines) + '\n\n'
+
+    chunks, length, index = [], 0, 0
+    while length < size:
+        chunk = form(index)
+        chunks.append(chunk)
+        length += len(chunk)
+        index += 1
+
+    return ''.join(chunks)
+
+
+def single_form_source(size, seed=0):
+    """Generates a Lisp form of about `size` characters, like a rule table."""
+    rng = random.Random(seed)
+
+    chunks = ["(define-rule-table *rules*\n"]
+    length = len(chunks[0])
+
+    while length < size:
+        chunk = '  (rule %d (when (and (> x %d) [y z]) {:weight %d}) "(doc)" ; (note)\n' \
+            '    (then (emit (quote (a (b (c d))))) (list %d %d)))\n' \
+            % (rng.randint(0, 99999), rng.randint(0, 999), rng.randint(0, 9),
+               rng.randint(0, 99), rng.randint(0, 99))
+        chunks.append(chunk)
+        length += len(chunk)
+
+    chunks.append(")\n")
+    return "".join(chunks)
+
+#
+# Sessions
+#
+
+def caret_walk(rng):
+    """A single caret moving through a file character by character."""
+    text = lisp_source(50 * 1024, rng.randint(0, 1000))
+    view = sublime.View(text)
+
+    start = rng.randint(0, len(text) // 2)
+    for point in xrange(start, min(len(text), start + 2000)):
+        view.set_cursors([point])
+        yield view
+
+
+def line_walk(rng):
+    """A single caret moving down through a file line by line."""
+    text = lisp_source(50 * 1024, rng.randint(0, 1000))
+    view = sublime.View(text)
+
+    column = rng.randint(0, 20)
+    line_starts = [0] + [i + 1 for i, c in enumerate(text) if c == '\n']
+    for begin in line_starts[:1000]:
+        end = view.line(begin).end()
+        view.set_cursors([min(begin + column, end)])
+        yield view
+
+
+def multi_cursor_edit(rng):
+    """Typing a form with a column of cursors on consecutive lines."""
+    text = lisp_source(50 * 1024, rng.randint(0, 1000))
+    view = sublime.View(text)
+
+    line_starts = [0] + [i + 1 for i, c in enumerate(text) if c == '\n']
+    first = rng.randint(0, len(line_starts) - 50)
+    view.set_cursors(line_starts[first:first + 40])
+    yield view
+
+    edit = view.begin_edit()
+    for character in '(when (> x 0) [y z]) ':
+        for cursor in reversed([region.begin() for region in view.sel()]):
+            view.insert(edit, cursor, character)
+        yield view
+    view.end_edit(edit)
+
+
+def scattered_cursors(rng):
+    """Hundreds of cursors all over a file moving right together."""
+    text = lisp_source(200 * 1024, rng.randint(0, 1000))
+    view = sublime.View(text)
+
+    cursors = sorted(set(rng.randint(0, len(text) - 100) for _ in range(500)))
+    for shift in xrange(50):
+        view.set_cursors([cursor + shift for cursor in cursors])
+        yield view
+
+
+def cursor_column(rng):
+    """A column of cursors on every line of a large form moving right together.
+
+    The examined regions of the cursors merge into one, so that every scope
+    of it is tested for adjacency to every cursor.
+    """
+    text = single_form_source(64 * 1024, rng.randint(0, 1000))
+    view = sublime.View(text)
+
+    line_starts = [0] + [i + 1 for i, c in enumerate(text) if c == '\n']
+    first = rng.randint(1, len(line_starts) - 150)
+    cursors = line_starts[first:first + 120]
+    for shift in xrange(40):
+        view.set_cursors([cursor + shift for cursor in cursors])
+        yield view
+
+
+def large_file_jumps(rng):
+    """A caret jumping to random places of a large file."""
+    text = lisp_source(1024 * 1024, rng.randint(0, 1000))
+    view = sublime.View(text)
+
+    for _ in xrange(300):
+        view.set_cursors([rng.randint(0, len(text) - 1)])
+        yield view
+
+
+def large_form_walk(rng):
+    """A single caret moving inside of a large single form."""
+    text = single_form_source(1024 * 1024, rng.randint(0, 1000))
+    view = sublime.View(text)
+
+    start = rng.randint(0, len(text) - 1000)
+    for point in xrange(start, start + 500):
+        view.set_cursors([point])
+        yield view
+
+
+def cloned_views(rng):
+    """Carets in four views of one large buffer, typing in one of them."""
+    text = lisp_source(1024 * 1024, rng.randint(0, 1000))
+    view = sublime.View(text)
+    views = [view] + [view.clone() for _ in range(3)]
+
+    for clone in views:
+        clone.set_cursors([rng.randint(0, len(text) - 1)])
+
+    edit = view.begin_edit()
+    for character in '(let ((x 1)) x) ' * 8:
+        view.insert(edit, view.sel()[0].begin(), character)
+        for clone in views:
+            yield clone
+    view.end_edit(edit)
+
+
+
+def undo_redo(rng):
+    """Typing a form, undoing it and redoing it over and over again.
+
+    The same texts come back after every undo and redo, with new change
+    counts of the view.
+    """
+    text = lisp_source(50 * 1024, rng.randint(0, 1000))
+    view = sublime.View(text)
+
+    point = text.find('\n', rng.randint(0, len(text) // 2)) + 1
+    view.set_cursors([point])
+    typed = '(when (> x 0) [y z]) '
+
+    edit = view.begin_edit()
+    for _ in xrange(20):
+        for offset, character in enumerate(typed):
+            view.insert(edit, point + offset, character)
+            yield view
+        for offset in xrange(len(typed) - 1, -1, -1):
+            view.erase(edit, sublime.Region(point + offset, point + offset + 1))
+            yield view
+    view.end_edit(edit)
+
+
+WORKLOADS = [
+    ('caret_walk', caret_walk),
+    ('line_walk', line_walk),
+    ('multi_cursor_edit', multi_cursor_edit),
+    ('scattered_cursors', scattered_cursors),
+    ('cursor_column', cursor_column),
+    ('large_file_jumps', large_file_jumps),
+    ('large_form_walk', large_form_walk),
+    ('cloned_views', cloned_views),
+    ('undo_redo', undo_redo),
+]
@@ -0,0 +1,1199 @@
+import sublime
+import threading
+
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from random import random
+from time import time
+
+if __package__:
+    from .bracket_scopes import iter_brackets
+    from .types import Region, LeftBracket, RightBracket
+    from .utils import xrange, izip, common_prefix_length, common_suffix_length
+else:
+    from bracket_scopes import iter_brackets
+    from types import Region, LeftBracket, RightBracket
+    from utils import xrange, izip, common_prefix_length, common_suffix_length
+
+#
+# Line tree
+#
+
+class Line(object):
+    """A line of the text in a LineTree, along with the summary of it.
+
+    The other fields of the line sum up the subtree of the tree which the
+    line is the root of, they are kept up to date by the tree.
+
+    Fields:
+        text - the text of the line, with the line break if it has one
+
+        scope - the scope the line begins in, or None if not known yet
+
+        net, low - the summary of the brackets of the line, see LineTree
+
+        summarized - whether the summary and the scope are known
+
+        located - the brackets of the line as BracketBalance has located
+                  them, or None, dropped when the line is summarized again
+
+        speculative - whether the brackets have been located ahead of time
+                      and no lookup has needed them yet
+    """
+    # Large files have hundreds of thousands of lines.
+    __slots__ = ('text', 'scope', 'net', 'low', 'summarized', 'located', 'speculative',
+                 'left', 'right', 'lines', 'length', 'total_net', 'total_low',
+                 'unsummarized')
+
+    def __init__(self, text, scope=None, net=0, low=0, summarized=False):
+        self.text = text
+        self.scope = scope
+        self.net = net
+        self.low = low
+        self.summarized = summarized
+        self.located = None
+        self.speculative = False
+
+        self.left = None
+        self.right = None
+        _sum_up(self)
+
+
+class LineTree:
+    """The lines of a text, with the bracket balance of every line.
+
+    Every line is summarized by a (net, low) tuple, where net is the number
+    of left brackets in the line minus the number of right ones, and low is
+    the minimum depth reached in the line relative to its beginning (which
+    is never positive as the beginning of the line counts too). Summaries
+    of adjacent lines combine into the summary of them both.
+
+    The lines are kept in a binary tree in their order, and every line sums
+    up the lines of its subtree: how many there are, how long they are, and
+    their combined summary. So the line of a point, the beginning of a line
+    and the depth there, and the nearest line where the depth drops low
+    enough are found by walking down the tree from its root. Lines are
+    inserted and removed by cutting the tree apart and joining the pieces,
+    and the lines after them move along without being touched at all.
+
+    The tree is a randomized binary search tree: the root of two joined
+    trees is taken from either of them with a probability proportional to
+    their sizes, which keeps the shape of the tree random whatever the edits
+    are. Everything then takes expected O(log lines), and a range of lines
+    is replaced or summarized in O(log lines + lines in the range).
+
+    Args:
+        [Line] lines - the lines of the text, in order
+
+    Fields:
+        lines - the number of lines
+
+        length - the length of the text
+
+        changes - the number of times the lines have been changed
+    """
+    def __init__(self, lines=()):
+        self.changes = 0
+        self._set_root(_build(list(lines)))
+
+    def _set_root(self, root):
+        self.changes += 1
+        self._root = root
+        self.lines = root.lines if root is not None else 0
+        self.length = root.length if root is not None else 0
+
+    def find(self, point):
+        """Returns the row of the line the point is in. The points at the end
+        of the text, and past it, are in the last line.
+        """
+        row = 0
+        node = self._root
+        while True:
+            left = node.left
+            if left is not None:
+                if point < left.length:
+                    node = left
+                    continue
+                point -= left.length
+                row += left.lines
+
+            if (point < len(node.text)) or (node.right is None):
+                return row
+            point -= len(node.text)
+            row += 1
+            node = node.right
+
+    def line(self, row):
+        """Returns (Line, begin, depth) of the line of the row: the line, the
+        point where it begins, and the depth at its beginning.
+        """
+        begin, depth = 0, 0
+        node = self._root
+        while True:
+            left = node.left
+            if left is not None:
+                if row < left.lines:
+                    node = left
+                    continue
+                row -= left.lines
+                begin += left.length
+                depth += left.total_net
+
+            if row == 0:
+                return node, begin, depth
+            row -= 1
+            begin += len(node.text)
+            depth += node.net
+            node = node.right
+
+    def iter_lines(self, row):
+        """Yields the lines from the row on, in order. The tree must not be
+        changed until the iteration is over.
+        """
+        # The stack holds the lines that come next, in reverse order.
+        stack = []
+        node = self._root
+        while node is not None:
+            left_lines = node.left.lines if node.left is not None else 0
+            if row < left_lines:
+                stack.append(node)
+                node = node.left
+            elif row == left_lines:
+                stack.append(node)
+                break
+            else:
+                row -= left_lines + 1
+                node = node.right
+
+        while stack:
+            node = stack.pop()
+            yield node
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+    def replace(self, first, last, lines):
+        """Replaces the lines from the first row to the last one with the
+        given lines, which may be as many or as few as needed.
+        """
+        before, rest = _split(self._root, first)
+        _, after = _split(rest, last - first + 1)
+        self._set_root(_join(_join(before, _build(lines)), after))
+
+    def append(self, lines):
+        """Appends the lines after the last one."""
+        self._set_root(_join(self._root, _build(lines)))
+
+    def summarize(self, row, summaries):
+        """Puts the summaries into the lines from the row on.
+
+        Args:
+            row - the row of the first line to summarize
+
+            [(scope, net, low)] summaries - the scopes the lines begin in
+                                            and their summaries, in order
+        """
+        before, rest = _split(self._root, row)
+        lines, after = _split(rest, len(summaries))
+
+        for line, (scope, net, low) in izip(_in_order(lines), summaries):
+            line.scope, line.net, line.low = scope, net, low
+            line.summarized = True
+            line.located = None
+        _sum_up_all(lines)
+
+        self._set_root(_join(_join(before, lines), after))
+
+    def first_unsummarized(self):
+        """Returns the row of the first line without its summary, or None if
+        all the lines have them.
+        """
+        node = self._root
+        if (node is None) or (node.unsummarized == 0):
+            return None
+
+        row = 0
+        while True:
+            left = node.left
+            if (left is not None) and (left.unsummarized > 0):
+                node = left
+                continue
+            if left is not None:
+                row += left.lines
+            if not node.summarized:
+                return row
+            row += 1
+            node = node.right
+
+    def first_row_reaching(self, row, depth):
+        """Finds the first line at or after the row where the depth drops
+        down to the given one, returns None if there is no such line.
+        """
+        return _first(self._root, 0, row, 0, depth)
+
+    def last_row_reaching(self, row, depth):
+        """Finds the last line before the row where the depth drops down
+        to the given one, returns None if there is no such line.
+        """
+        return _last(self._root, 0, row, 0, depth)
+
+
+def _sum_up(node):
+    lines, length = 1, len(node.text)
+    net, low = node.net, node.low
+    unsummarized = 0 if node.summarized else 1
+
+    left = node.left
+    if left is not None:
+        low = min(left.total_low, left.total_net + low)
+        net += left.total_net
+        lines += left.lines
+        length += left.length
+        unsummarized += left.unsummarized
+
+    right = node.right
+    if right is not None:
+        low = min(low, net + right.total_low)
+        net += right.total_net
+        lines += right.lines
+        length += right.length
+        unsummarized += right.unsummarized
+
+    node.lines, node.length = lines, length
+    node.total_net, node.total_low = net, low
+    node.unsummarized = unsummarized
+
+
+def _sum_up_all(node):
+    if node is not None:
+        _sum_up_all(node.left)
+        _sum_up_all(node.right)
+        _sum_up(node)
+
+
+def _in_order(node):
+    if node is not None:
+        for line in _in_order(node.left):
+            yield line
+        yield node
+        for line in _in_order(node.right):
+            yield line
+
+
+def _build(lines, begin=0, end=None):
+    # A perfectly balanced tree is as good a start as a random one.
+    if end is None:
+        end = len(lines)
+    if begin >= end:
+        return None
+
+    middle = (begin + end) // 2
+    node = lines[middle]
+    node.left = _build(lines, begin, middle)
+    node.right = _build(lines, middle + 1, end)
+    _sum_up(node)
+    return node
+
+
+def _split(node, lines):
+    """Cuts the tree into the first `lines` lines and the rest."""
+    if node is None:
+        return None, None
+
+    left_lines = node.left.lines if node.left is not None else 0
+    if lines <= left_lines:
+        before, node.left = _split(node.left, lines)
+        _sum_up(node)
+        return before, node
+
+    node.right, after = _split(node.right, lines - left_lines - 1)
+    _sum_up(node)
+    return node, after
+
+
+def _join(before, after):
+    """Joins two trees, the lines of the first one go first."""
+    if before is None:
+        return after
+    if after is None:
+        return before
+
+    if random() * (before.lines + after.lines) < before.lines:
+        before.right = _join(before.right, after)
+        _sum_up(before)
+        return before
+
+    after.left = _join(before, after.left)
+    _sum_up(after)
+    return after
+
+
+def _first(node, offset, row, base, depth):
+    # `offset` is the row of the first line of the subtree, and `base` is
+    # the depth at the beginning of it.
+    if node is None:
+        return None
+    if offset + node.lines <= row:
+        return None
+    if (offset >= row) and (base + node.total_low > depth):
+        return None
+
+    left = node.left
+    found = _first(left, offset, row, base, depth)
+    if found is not None:
+        return found
+
+    if left is not None:
+        offset += left.lines
+        base += left.total_net
+    if (offset >= row) and (base + node.low <= depth):
+        return offset
+    return _first(node.right, offset + 1, row, base + node.net, depth)
+
+
+def _last(node, offset, row, base, depth):
+    if node is None:
+        return None
+    if offset >= row:
+        return None
+    if (offset + node.lines <= row) and (base + node.total_low > depth):
+        return None
+
+    left = node.left
+    node_row, node_base = offset, base
+    if left is not None:
+        node_row += left.lines
+        node_base += left.total_net
+
+    found = _last(node.right, node_row + 1, row, node_base + node.net, depth)
+    if found is not None:
+        return found
+    if (node_row < row) and (node_base + node.low <= depth):
+        return node_row
+    return _last(left, offset, row, base, depth)
+
+
+def split_lines(text, last):
+    """Splits the text after its line breaks.
+
+    Args:
+        text - the text to split
+
+        last - whether the text ends the buffer: the rest of it after the
+               last line break is then a line of its own, even if it is
+               empty, otherwise the text must end with a line break
+
+    Returns:
+        [line] - the lines, with their line breaks
+    """
+    lines = []
+    begin = 0
+    end = text.find('\n')
+    while end != -1:
+        lines.append(text[begin:end + 1])
+        begin = end + 1
+        end = text.find('\n', begin)
+
+    if last:
+        lines.append(text[begin:])
+    return lines
+
+#
+# Buffer balance
+#
+
+# The text of a buffer is read this many characters at a time while its
+# balance is being built.
+_BUILD_CHUNK = 2048
+
+# The brackets of at most this many lines are kept located, the ones located
+# first are dropped first, a quarter of them at a time.
+_LOCATED_LIMIT = 4096
+
+
+class BracketBalance:
+    """Bracket balance of a whole buffer, maintained across the edits.
+
+    Brackets are located in the same way as locate_brackets does it, so the
+    brackets in strings and comments are ignored, and all kinds of brackets
+    count the same. Only the texts and the summaries of the lines are always
+    kept, in a LineTree, the brackets of a line are located when a lookup
+    needs them. They are kept along with the line until it is edited, and
+    they are moved along when the edits before the line move it, or change
+    the depth it begins at, the next time a lookup needs them.
+
+    The balance is built a chunk of lines at a time, so that building it for
+    a large buffer may be spread over a number of slices of time (see build).
+    It must not be queried until it is complete.
+
+    The edits are applied as they are recorded (see record_edit): only the
+    lines they touch are replaced and summarized again, along with the
+    following lines that now begin in a different scope (like after an
+    opening quote has been typed). The scope of the line break before a line
+    is taken as the state that the line begins in. An edit of a few lines
+    costs O(log lines) whether it adds or removes lines or not. The texts of
+    the lines are compared with the whole text of the view, and the lines
+    that differ are replaced, only when the edits are unknown, or when an
+    edit is found to have been guessed wrong.
+
+    The brackets of the lines may also be located ahead of time, while the
+    editor is idle. These are marked until some lookup needs them, so that
+    it is known how much of the speculative work has paid off.
+
+    Fields:
+        supported_brackets - a list of (left, right) pairs of strings that
+                             denote the brackets to balance
+
+        suitable_scope - a predicate of signature (scope) that tells whether
+                         the given scope should be checked for brackets
+
+        scan_cache - the ScanCache to take the brackets of the lines from,
+                     so that the lines which come back after undo, or
+                     which have not changed at all, are not scanned again
+
+        complete - whether the balance has been built for the whole text
+
+        built - the length of the text the lines have been built for, from
+                its beginning
+
+        comparisons - the number of times the lines have been compared with
+                      the whole text of the view
+
+        speculative_rows_used - the number of lines located ahead of time
+                                which lookups have needed later
+    """
+    def __init__(self, supported_brackets, suitable_scope, scan_cache=None):
+        self.supported_brackets = supported_brackets
+        self.suitable_scope = suitable_scope
+        self.scan_cache = scan_cache
+
+        self._view = None
+        self._reset()
+        self.comparisons = 0
+
+        # The edits may be recorded from another thread than the one which
+        # applies them.
+        self._edits = []
+        self._edits_lock = threading.Lock()
+
+        self._speculating = False
+        self.speculative_rows_used = 0
+
+    def _reset(self):
+        self._lines = LineTree()
+        self._change_count = None
+        self._read_count = None
+        self.complete = False
+        self.built = 0
+
+        # line -> the serial number of its locating, of the lines which
+        # have their brackets located
+        self._located_lines = {}
+        self._locatings = 0
+
+        self._guessed = False
+        self._guessed_lines = set([])
+
+    def record_edit(self, begin, end, text, change_count, unchanged=None):
+        """Records an edit of the text of the view, which the next refresh
+        applies instead of finding what has changed on its own. This may be
+        called from any thread.
+
+        Args:
+            begin, end - the part of the text before the edit which has been
+                         replaced
+
+            text - the text it has been replaced with
+
+            change_count - the change count of the view after the edit
+
+            unchanged - (prefix, suffix) for an edit that has been guessed:
+                        the lengths of the beginning and the end of the text
+                        which are supposed to be the same as before the edit.
+                        The edit is only applied if they are, and the lines
+                        are compared with the whole text of the view later
+                        on (see verify). None for an edit known for sure.
+        """
+        with self._edits_lock:
+            self._edits.append((begin, end, text, change_count, unchanged))
+
+    def refresh(self, view):
+        """Brings the balance up to date with the text of the view, building
+        the rest of it if it is not complete.
+        """
+        self.build(view)
+
+    def build(self, view, budget=None):
+        """Brings the lines built so far up to date with the text of the view,
+        and builds more of them.
+
+        Args:
+            view - the view the balance is of
+
+            budget - for how long to build the lines, in milliseconds, or
+                     None to build all of them
+
+        Returns:
+            True if the balance is complete
+        """
+        started = time()
+        self._view = view
+
+        if not self._apply_edits(view):
+            if self.complete:
+                self._compare(view)
+            else:
+                self._reset()
+        self._summarize_edited_lines()
+
+        while not self.complete:
+            if (budget is not None) and ((time() - started) * 1000.0 >= budget):
+                break
+            self._extend(view)
+
+        return self.complete
+
+    def verify(self, view):
+        """Compares the lines with the whole text of the view if they have
+        been edited by guess since the last time, and replaces the lines that
+        have been guessed wrong.
+
+        Returns:
+            True if the guesses have been right
+        """
+        self.refresh(view)
+        if not self._guessed:
+            return True
+
+        guessed_lines, self._guessed_lines = self._guessed_lines, set([])
+        self._guessed = False
+        wrong = self._compare(view)
+
+        # The lines summarized after a wrong guess may have been summarized at
+        # wrong points, even if the guesses that followed have set the text
+        # right again, so they are all summarized again.
+        rows = [row for row, line in enumerate(self._lines.iter_lines(0))
+                if line in guessed_lines]
+        for row in rows:
+            line, _, _ = self._lines.line(row)
+            self._lines.replace(row, row, [Line(line.text)])
+        self._summarize_edited_lines()
+
+        return not wrong
+
+    def _apply_edits(self, view):
+        """Applies the edits recorded since the last time. Returns False if
+        they do not bring the lines up to date with the view.
+        """
+        with self._edits_lock:
+            edits, self._edits = self._edits, []
+
+        if self._lines.lines == 0:
+            # Nothing to apply the edits to.
+            return True
+
+        for begin, end, text, change_count, unchanged in edits:
+            # The text read from the view has the edits made before it.
+            if change_count <= self._read_count:
+                continue
+            if not self._apply_edit(begin, end, text, unchanged):
+                return False
+            self._change_count = change_count
+
+        return self._change_count == view.change_count()
+
+    def _apply_edit(self, begin, end, text, unchanged):
+        lines = self._lines
+        if begin > end:
+            return False
+        if unchanged is not None:
+            self._guessed = True
+
+        if self.complete:
+            if end > lines.length:
+                return False
+        elif begin >= self.built:
+            return True
+        elif end >= self.built:
+            # The last line built would lose its line break, the lines from
+            # the edit on are built again.
+            self._truncate(lines.find(begin))
+            return True
+
+        first, last = lines.find(begin), lines.find(end)
+        _, first_begin, _ = lines.line(first)
+        old_lines = list(islice(lines.iter_lines(first), last - first + 1))
+        old_text = ''.join([line.text for line in old_lines])
+
+        begin -= first_begin
+        end -= first_begin
+        if unchanged is not None:
+            prefix, suffix = unchanged
+            if (old_text[begin:begin + prefix] != text[:prefix]) or \
+               (old_text[end - suffix:end] != text[len(text) - suffix:]):
+                return False
+
+        new_text = old_text[:begin] + text + old_text[end:]
+        last_line = self.complete and (last == lines.lines - 1)
+        lines.replace(first, last, [Line(line) for line in split_lines(new_text, last_line)])
+        self._forget_located(old_lines)
+        self.built += len(text) - (end - begin)
+        return True
+
+    def _truncate(self, row):
+        self._forget_located(self._lines.iter_lines(row))
+        self._lines.replace(row, self._lines.lines - 1, [])
+        self.built = self._lines.length
+
+    def _compare(self, view):
+        """Compares the lines with the whole text of the view, and replaces
+        the ones that differ. Returns True if any have.
+        """
+        self.comparisons += 1
+
+        old_text = ''.join([line.text for line in self._lines.iter_lines(0)])
+        new_text = self._read(view, 0, view.size())
+
+        prefix = common_prefix_length(old_text, new_text)
+        suffix = common_suffix_length(old_text, new_text,
+            min(len(old_text), len(new_text)) - prefix)
+        if prefix == len(old_text) == len(new_text):
+            return False
+
+        self._apply_edit(prefix, len(old_text) - suffix,
+                         new_text[prefix:len(new_text) - suffix], None)
+        self._summarize_edited_lines()
+        return True
+
+    def _extend(self, view):
+        """Builds the lines of the next chunk of the text."""
+        begin, size = self.built, view.size()
+
+        # A line longer than a chunk is read in growing chunks.
+        chunk = _BUILD_CHUNK
+        while True:
+            end = min(size, begin + chunk)
+            text = self._read(view, begin, end)
+            if end == size:
+                break
+            line_end = text.rfind('\n')
+            if line_end != -1:
+                text = text[:line_end + 1]
+                break
+            chunk *= 2
+
+        last = begin + len(text) == size
+        texts = split_lines(text, last)
+        summaries = self._summarize(begin, texts)
+        self._lines.append([Line(line, scope, net, low, True)
+                            for line, (scope, net, low) in izip(texts, summaries)])
+
+        self.built += len(text)
+        self.complete = last
+
+    def _read(self, view, begin, end):
+        # The text is read again if the view is edited while it is being
+        # read, which it may be when the balance is built in the background.
+        while True:
+            change_count = view.change_count()
+            text = view.substr(sublime.Region(begin, end))
+            if view.change_count() == change_count:
+                self._change_count = self._read_count = change_count
+                return text
+
+    def _summarize(self, begin, texts):
+        """Returns [(scope, net, low)] of the lines with the texts, which begin
+        at the point: the scopes they begin in and their summaries.
+        """
+        # The first line begins in the base scope of the syntax, which tells
+        # the dialect of the brackets apart in the scan_cache like the other
+        # scopes do.
+        summaries = []
+        ends = []
+        end = begin
+        for text in texts:
+            if end > 0:
+                scope = self._view.scope_name(end - 1)
+            else:
+                scope = self._view.scope_name(0).split(' ', 1)[0]
+            summaries.append([scope, 0, 0])
+            end += len(text)
+            ends.append(end)
+
+        # Brackets never span several lines, so the lines may be scanned
+        # all at once.
+        index = 0
+        for bracket in iter_brackets(self._view, Region(begin, end),
+                                     self.supported_brackets, self.suitable_scope):
+            while bracket.point >= ends[index]:
+                index += 1
+            summary = summaries[index]
+            summary[1] += 1 if bracket.is_left() else -1
+            summary[2] = min(summary[2], summary[1])
+
+        return summaries
+
+    def _summarize_edited_lines(self):
+        """Summarizes the lines which the edits have replaced, and the lines
+        after them which now begin in other scopes than before.
+        """
+        lines = self._lines
+        while True:
+            row = lines.first_unsummarized()
+            if row is None:
+                return
+
+            _, begin, _ = lines.line(row)
+            texts = []
+            for line in lines.iter_lines(row):
+                if line.summarized:
+                    break
+                texts.append(line.text)
+
+            self._summarize_lines(row, begin, texts)
+
+            # Lines that now start in a string (or no longer do) have to be
+            # summarized again, up to the first one that starts as before.
+            row += len(texts)
+            begin += sum([len(text) for text in texts])
+            end = begin
+            texts = []
+            for line in lines.iter_lines(row):
+                if line.summarized and (self._view.scope_name(end - 1) == line.scope):
+                    break
+                texts.append(line.text)
+                end += len(line.text)
+
+            if texts:
+                self._summarize_lines(row, begin, texts)
+
+    def _summarize_lines(self, row, begin, texts):
+        # Summarizing drops the brackets located in the lines.
+        self._forget_located(islice(self._lines.iter_lines(row), len(texts)))
+        self._lines.summarize(row, self._summarize(begin, texts))
+        if self._guessed:
+            self._guessed_lines.update(islice(self._lines.iter_lines(row), len(texts)))
+
+    def state(self):
+        """Returns the state of the complete balance to restore it from later.
+
+        Returns:
+            ([line_start], ([net], [low]), [start_scope])
+                - the points where the lines begin, the summaries of the
+                  lines, and the scopes the lines begin in
+        """
+        line_starts, net, low, start_scopes = [], [], [], []
+        begin = 0
+        for line in self._lines.iter_lines(0):
+            line_starts.append(begin)
+            net.append(line.net)
+            low.append(line.low)
+            start_scopes.append(line.scope)
+            begin += len(line.text)
+        return line_starts, (net, low), start_scopes
+
+    def restore(self, view, text, state):
+        """Takes the state of the balance of the view instead of scanning it.
+
+        Args:
+            view - the view the balance is of
+
+            text - the current text of the view, the state must have been
+                   taken from a balance of exactly the same text
+
+            state - the state that state() returned back then
+        """
+        line_starts, (net, low), start_scopes = state
+        line_ends = list(islice(line_starts, 1, None)) + [len(text)]
+
+        self._reset()
+        self._view = view
+        self._change_count = self._read_count = view.change_count()
+
+        self._lines = LineTree([Line(text[begin:end], scope, line_net, line_low, True)
+                                for begin, end, scope, line_net, line_low
+                                in izip(line_starts, line_ends, start_scopes, net, low)])
+        self.built = len(text)
+        self.complete = True
+
+    def _row_begin(self, row):
+        return self._lines.line(row)[1]
+
+    def _row_of(self, point):
+        return self._lines.find(point)
+
+    def _located(self, row, deadline=None):
+        """Returns ([point], [(bracket, depth)], [low_before], [low_after])
+        of the line, see _brackets_with_depths and _depth_bounds.
+        """
+        line, begin, depth = self._lines.line(row)
+        located = line.located
+        if located is None:
+            # Nothing is kept if the deadline passes while locating the line.
+            located = self._locate_with_depths(line, begin, depth, deadline)
+            self._keep_located(line, located)
+            line.speculative = self._speculating
+        elif (located[0] != begin) or (located[1] != depth):
+            located = line.located = _moved(located, begin, depth)
+
+        if line.speculative and not self._speculating:
+            line.speculative = False
+            self.speculative_rows_used += 1
+        return located[2:]
+
+    def _keep_located(self, line, located):
+        line.located = located
+        self._locatings += 1
+        self._located_lines[line] = self._locatings
+
+        if len(self._located_lines) > _LOCATED_LIMIT:
+            by_locating = sorted(self._located_lines.items(), key=lambda item: item[1])
+            for line, _ in by_locating[:len(by_locating) // 4]:
+                line.located = None
+                del self._located_lines[line]
+
+    def _forget_located(self, lines):
+        """Drops the lines which are replaced or summarized again from the
+        located ones, so that only the lines of the text count to the limit.
+        """
+        located_lines = self._located_lines
+        for line in lines:
+            if line.located is not None:
+                line.located = None
+                located_lines.pop(line, None)
+
+    def _brackets_with_depths(self, row, deadline=None):
+        """Returns ([point], [(bracket, depth)]) of the brackets of the line,
+        with the depths before them.
+        """
+        return self._located(row, deadline)[:2]
+
+    def _depth_bounds(self, row):
+        """Returns ([low_before], [low_after]) of the line: the minimum depth
+        before each bracket and all the preceding ones, and the minimum depth
+        after each bracket and all the following ones. These tell when there
+        is no point in looking for a depth further along the line.
+        """
+        return self._located(row)[2:]
+
+    def _locate_with_depths(self, line, begin, depth, deadline=None):
+        region = Region(begin, begin + len(line.text))
+
+        def scan():
+            return iter_brackets(self._view, region,
+                self.supported_brackets, self.suitable_scope, deadline)
+
+        if self.scan_cache is None:
+            located = scan()
+        else:
+            located = self.scan_cache.brackets(line.text, line.scope, begin, scan)
+
+        points, brackets = [], []
+        depth_before = depth
+        for bracket in located:
+            points.append(bracket.point)
+            brackets.append((bracket, depth_before))
+            depth_before += 1 if bracket.is_left() else -1
+
+        low_before, low = [], depth_before
+        for _, bracket_depth in brackets:
+            low = min(low, bracket_depth)
+            low_before.append(low)
+
+        low_after, low = [], depth_before
+        for bracket, bracket_depth in reversed(brackets):
+            low = min(low, bracket_depth + (1 if bracket.is_left() else -1))
+            low_after.append(low)
+        low_after.reverse()
+
+        return begin, depth, points, brackets, low_before, low_after
+
+    def depth_at(self, point):
+        """Returns the depth at the point, i.e., the number of left brackets
+        before it minus the number of right brackets before it.
+        """
+        row = self._row_of(point)
+        points, brackets = self._brackets_with_depths(row)
+
+        index = bisect_left(points, point)
+        if index < len(brackets):
+            return brackets[index][1]
+        if brackets:
+            bracket, depth_before = brackets[-1]
+            return depth_before + (1 if bracket.is_left() else -1)
+        return self._lines.line(row)[2]
+
+    def min_depth(self, begin, end):
+        """Returns the minimum depth at the points from begin to end."""
+        depth = self.depth_at(begin)
+        row = self._row_of(begin)
+        points, brackets = self._brackets_with_depths(row)
+        index = bisect_left(points, begin)
+        while True:
+            for bracket, depth_before in islice(brackets, index, None):
+                if bracket.point >= end:
+                    return depth
+                if bracket.is_right():
+                    depth = min(depth, depth_before - 1)
+
+            row += 1
+            if (row >= self._lines.lines) or (self._row_begin(row) >= end):
+                return depth
+            points, brackets = self._brackets_with_depths(row)
+            index = 0
+
+    def bracket_start(self, point):
+        """Moves the point to the beginning of the bracket it is inside of."""
+        points, brackets = self._brackets_with_depths(self._row_of(point))
+        index = bisect_left(points, point) - 1
+        if index >= 0:
+            bracket, _ = brackets[index]
+            if point < bracket.point + len(bracket.kind):
+                return bracket.point
+        return point
+
+    def iter_depths(self, region, deadline=None):
+        """Yields (bracket, depth) of the brackets in the region, in order.
+
+        The depth of a bracket is the depth of the expression it delimits,
+        so matching brackets have the same depth. It is the depth before a
+        left bracket and the depth after a right one. The deadline is checked
+        while the lines are being located, if there is one.
+        """
+        row = self._row_of(region.begin)
+        points, brackets = self._brackets_with_depths(row, deadline)
+        index = bisect_left(points, region.begin)
+        while True:
+            for bracket, depth_before in islice(brackets, index, None):
+                if bracket.point >= region.end:
+                    return
+                if bracket.is_left():
+                    yield bracket, depth_before
+                else:
+                    yield bracket, depth_before - 1
+
+            row += 1
+            if (row >= self._lines.lines) or (self._row_begin(row) >= region.end):
+                return
+            points, brackets = self._brackets_with_depths(row, deadline)
+            index = 0
+
+    def iter_lines(self, region):
+        """Yields (line, begin, depth) of the lines the region is in, in
+        order: the Line, the point where it begins and the depth there.
+        A Line stays the same object until it is edited, though the scope
+        it begins in may change when the lines before it are edited.
+        """
+        row = self._row_of(region.begin)
+        _, begin, depth = self._lines.line(row)
+        for line in self._lines.iter_lines(row):
+            yield line, begin, depth
+            begin += len(line.text)
+            depth += line.net
+            if begin >= region.end:
+                return
+
+    def iter_brackets(self, region, deadline=None):
+        """Yields the brackets in the region, like iter_brackets of the view
+        does, but from the lines located before when they are.
+        """
+        for bracket, _ in self.iter_depths(region, deadline):
+            yield bracket
+
+    def top_level_form(self, point):
+        """Returns the Region of the outermost expression enclosing the point,
+        or None if the point is at the top level. Unterminated expressions
+        extend to the end of the buffer.
+        """
+        outermost = None
+        for outermost in self.enclosing_brackets(point):
+            pass
+        if outermost is None:
+            return None
+
+        right = self.matching_bracket(outermost)
+        if right is None:
+            return Region(outermost.point, self._lines.length)
+        return Region(outermost.point, right.point + len(right.kind))
+
+    def speculate(self, point, radius):
+        """Locates the brackets of the lines around the point ahead of time.
+
+        The lines of the top-level expression around the point go first,
+        nearest ones first, and then the lines around that expression, where
+        its neighbours are, up to `radius` lines away from it. The lines
+        stop being located once the balance changes, when it is refreshed
+        between the rows.
+
+        Yields:
+            row - the lines, right after they have been located
+        """
+        self._speculating = True
+        try:
+            form = self.top_level_form(point)
+        finally:
+            self._speculating = False
+
+        caret = self._row_of(point)
+        first, last = caret, caret
+        if form is not None:
+            first, last = self._row_of(form.begin), self._row_of(form.end)
+
+        def rows():
+            for distance in xrange(max(caret - first, last - caret) + 1):
+                if caret - distance >= first:
+                    yield caret - distance
+                if (distance > 0) and (caret + distance <= last):
+                    yield caret + distance
+
+            for distance in xrange(1, radius + 1):
+                if first - distance >= 0:
+                    yield first - distance
+                if last + distance < self._lines.lines:
+                    yield last + distance
+
+        lines, changes = self._lines, self._lines.changes
+        for row in rows():
+            if (self._lines is not lines) or (lines.changes != changes):
+                return
+            if lines.line(row)[0].located is not None:
+                continue
+
+            self._speculating = True
+            try:
+                self._located(row)
+            finally:
+                self._speculating = False
+            yield row
+
+    def enclosing_brackets(self, point):
+        """Yields the left brackets enclosing the point, innermost first.
+
+        A left bracket encloses the point if it is located before the point
+        and its matching bracket is not.
+        """
+        row = self._row_of(point)
+        points, brackets = self._brackets_with_depths(row)
+        index = bisect_left(points, point)
+
+        depth = self.depth_at(point) - 1
+        while True:
+            low_before, _ = self._depth_bounds(row)
+            for index in xrange(index - 1, -1, -1):
+                if low_before[index] > depth:
+                    break
+                bracket, depth_before = brackets[index]
+                if bracket.is_left() and (depth_before == depth):
+                    yield bracket
+                    depth -= 1
+
+            row = self._lines.last_row_reaching(row, depth)
+            if row is None:
+                return
+            points, brackets = self._brackets_with_depths(row)
+            index = len(brackets)
+
+    def matching_bracket(self, left_bracket, before=None):
+        """Finds the right bracket matching the left one.
+
+        Args:
+            left_bracket - the left bracket to find the match of
+
+            before - the point to stop looking at, or None to look as far
+                     as needed
+
+        Returns:
+            bracket - the matching right bracket, or None if there is none
+                      (before the given point)
+        """
+        row = self._row_of(left_bracket.point)
+        points, brackets = self._brackets_with_depths(row)
+        index = bisect_right(points, left_bracket.point)
+
+        depth = self.depth_at(left_bracket.point) + 1
+        while True:
+            _, low_after = self._depth_bounds(row)
+            for index in xrange(index, len(brackets)):
+                if low_after[index] >= depth:
+                    break
+                bracket, depth_before = brackets[index]
+                if (before is not None) and (bracket.point >= before):
+                    return None
+                if bracket.is_right() and (depth_before == depth):
+                    return bracket
+
+            row = self._lines.first_row_reaching(row + 1, depth - 1)
+            if row is None:
+                return None
+            if (before is not None) and (self._row_begin(row) >= before):
+                return None
+            points, brackets = self._brackets_with_depths(row)
+            index = 0
+
+    def first_bracket_within(self, point, depth):
+        """Finds the first bracket at or after the point whose depth (as
+        iter_depths tells it) is at most the given one.
+
+        Only the lines where the depth drops low enough are looked at, the
+        ones in between are skipped with the tree.
+
+        Returns:
+            (bracket, depth) - the bracket found and its depth, or None
+        """
+        row = self._row_of(point)
+        points, brackets = self._brackets_with_depths(row)
+        index = bisect_left(points, point)
+        while True:
+            for bracket, depth_before in islice(brackets, index, None):
+                bracket_depth = depth_before if bracket.is_left() else depth_before - 1
+                if bracket_depth <= depth:
+                    return bracket, bracket_depth
+
+            row = self._lines.first_row_reaching(row + 1, depth)
+            if row is None:
+                return None
+            points, brackets = self._brackets_with_depths(row)
+            index = 0
+
+    def last_bracket_within(self, point, depth):
+        """Finds the last bracket before the point whose depth (as
+        iter_depths tells it) is at most the given one.
+
+        Returns:
+            (bracket, depth) - the bracket found and its depth, or None
+        """
+        row = self._row_of(point)
+        points, brackets = self._brackets_with_depths(row)
+        index = bisect_left(points, point)
+        while True:
+            for index in xrange(index - 1, -1, -1):
+                bracket, depth_before = brackets[index]
+                bracket_depth = depth_before if bracket.is_left() else depth_before - 1
+                if bracket_depth <= depth:
+                    return bracket, bracket_depth
+
+            row = self._lines.last_row_reaching(row, depth)
+            if row is None:
+                return None
+            points, brackets = self._brackets_with_depths(row)
+            index = len(brackets)
+
+
+def _moved(located, begin, depth):
+    """Moves the brackets located in a line to where the line begins now,
+    and to the depth it begins at now.
+    """
+    old_begin, old_depth, points, brackets, low_before, low_after = located
+    offset, change = begin - old_begin, depth - old_depth
+
+    moved_brackets = []
+    for bracket, bracket_depth in brackets:
+        if bracket.is_left():
+            bracket = LeftBracket(bracket.point + offset, bracket.kind)
+        else:
+            bracket = RightBracket(bracket.point + offset, bracket.kind)
+        moved_brackets.append((bracket, bracket_depth + change))
+
+    return (begin, depth, [point + offset for point in points], moved_brackets,
+            [low + change for low in low_before], [low + change for low in low_after])
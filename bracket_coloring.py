@@ -1,14 +1,23 @@
 import sublime
 
-from heapq import heapify, heappop, heapreplace
+from heapq import heappop, heappush, heapreplace, merge
+from itertools import count
 
-from lisp_highlight_configuration \
-    import ColorMode, RegionColor, Configuration
+if __package__:
+    from .lisp_highlight_configuration \
+        import ColorMode, RegionColor, Configuration
 
-from types import Region, Scope, ColorableSpan
+    from .types import Region, Scope, ColorableSpan, PositionIndex
+    from .utils import imap
+else:
+    from lisp_highlight_configuration \
+        import ColorMode, RegionColor, Configuration
 
+    from types import Region, Scope, ColorableSpan, PositionIndex
+    from utils import imap
 
-def color_scopes(scopes, config, cursors, supported_brackets):
+
+def color_scopes(scopes, config, cursors, supported_brackets, positions=None):
     """Splits and transforms the scopes into colorable regions.
 
     The result of this transform is a list of _visible_ regions,
@@ -25,9 +34,86 @@ def color_scopes(scopes, config, cursors, supported_brackets):
             - a list of (left, right) pairs of strings that denote
               the valid kinds of brackets
 
+        positions - the PositionIndex of the cursors, or None to build one
+
     Returns:
         [colorable_regions] - a list of resulting colorable regions
     """
+    result = []
+    for _, spans in colorable_spans_of(scopes, config, cursors, supported_brackets,
+                                       positions):
+        result.extend(spans)
+    return result
+
+
+def iter_colored_scopes(scopes, config, cursors, supported_brackets, positions=None):
+    """Lazily splits and transforms the scopes into colorable regions.
+
+    This is a streaming version of color_scopes. The regions are yielded
+    sorted by their beginning, as iter_disjoint_spans expects them to be.
+    Only the right bracket regions of the enclosing scopes are held back
+    until the scan gets past them, so at most one region per nesting level
+    is kept in memory.
+
+    Args:
+        (scopes) - an iterable of scopes to get transformed, sorted
+
+        config - the Configuration to use
+
+        [cursors] - a list of current cursors
+
+        [supported_brackets]
+            - a list of (left, right) pairs of strings that denote
+              the valid kinds of brackets
+
+        positions - the PositionIndex of the cursors, or None to build one
+
+    Yields:
+        colorable_region - resulting colorable regions, sorted
+    """
+    pending = []
+    serial_numbers = count()
+
+    for scope, spans in colorable_spans_of(scopes, config, cursors, supported_brackets,
+                                           positions):
+        for span in spans:
+            heappush(pending, (span.extent.begin, next(serial_numbers), span))
+
+        # Scopes are sorted by their left brackets, so nothing that begins
+        # before this one can come after it.
+        scope_begin = scope.left_bracket.point
+        while pending and (pending[0][0] <= scope_begin):
+            yield heappop(pending)[2]
+
+    while pending:
+        yield heappop(pending)[2]
+
+
+def colorable_spans_of(scopes, config, cursors, supported_brackets, positions=None):
+    """Generates colorable regions of the scopes, scope by scope.
+
+    This is the common part of color_scopes and iter_colored_scopes.
+
+    Args:
+        (scopes) - an iterable of scopes to get transformed, sorted
+
+        config - the Configuration to use
+
+        [cursors] - a list of current cursors
+
+        [supported_brackets]
+            - a list of (left, right) pairs of strings that denote
+              the valid kinds of brackets
+
+        positions - the PositionIndex of the cursors, or None to build one
+
+    Yields:
+        (scope, [colorable_regions])
+            - the visible scopes and their colorable regions
+    """
+    if positions is None:
+        positions = PositionIndex(cursors)
+
     def color_type_of(scope):
         if scope.is_not_consistent_with(supported_brackets):
             return RegionColor.INCONSISTENT, None
@@ -38,7 +124,7 @@ def color_scopes(scopes, config, cursors, supported_brackets):
         if scope.is_secondary_mainline():
             return RegionColor.SECONDARY, scope.outer_index
 
-        if scope.is_adjacent_to(cursors):
+        if scope.is_adjacent_to(positions):
             return RegionColor.ADJACENT, None
 
         if scope.is_offside():
@@ -54,20 +140,16 @@ def color_scopes(scopes, config, cursors, supported_brackets):
         if mode is ColorMode.EXPRESSION:
             return [scope.expression_region()]
 
-    def suitable(scope, (kind, index)):
+    def suitable(scope, color_type):
+        kind, index = color_type
         if kind is RegionColor.OFFSIDE:
             return index <= config.offside_limit
 
         if kind is RegionColor.ADJACENT:
-            need_left = config.adjacent_left
-            need_right = config.adjacent_right
-
-            for cursor in cursors:
-                if (need_left and scope.left_bracket.contains(cursor)) or \
-                   (need_right and scope.right_bracket.contains(cursor)):
-                    return True
-            else:
-                return False
+            return (config.adjacent_left and
+                    positions.has_cursor_inside(scope.left_bracket)) or \
+                   (config.adjacent_right and
+                    positions.has_cursor_inside(scope.right_bracket))
 
         return True
 
@@ -76,7 +158,15 @@ def color_scopes(scopes, config, cursors, supported_brackets):
         right_region = right_scope.expression_region()
         return left_region.touches(right_region)
 
-    result = []
+    def opaque(color_type):
+        _, background = color_of(color_type, config)
+        return background is not None
+
+    # Only the topmost opaque background of the enclosing scopes shows through,
+    # so that is all the background stacks keep. They are computed once for
+    # each enclosing scope and shared by everything nested in it, which keeps
+    # deeply nested expressions from being quadratic.
+
     bg_scope_stack = []
 
     for scope in scopes:
@@ -88,19 +178,21 @@ def color_scopes(scopes, config, cursors, supported_brackets):
         if mode is ColorMode.NONE:
             continue
 
-        while bg_scope_stack and not touching(bg_scope_stack[-1], scope):
+        while bg_scope_stack and not touching(bg_scope_stack[-1][0], scope):
             bg_scope_stack.pop()
 
-        bg_color_stack = map(color_type_of, bg_scope_stack)
+        bg_color_stack = bg_scope_stack[-1][1] if bg_scope_stack else []
 
-        for extent in extents_of(scope, mode):
-            region = ColorableSpan(extent, fg_color_type, bg_color_stack)
-            result.append(region)
+        spans = [ColorableSpan(extent, fg_color_type, bg_color_stack)
+                 for extent in extents_of(scope, mode)]
 
         if mode is ColorMode.EXPRESSION:
-            bg_scope_stack.append(scope)
+            if opaque(fg_color_type):
+                bg_scope_stack.append((scope, [fg_color_type]))
+            else:
+                bg_scope_stack.append((scope, bg_color_stack))
 
-    return result
+        yield scope, spans
 
 
 def split_into_disjoint(spans, lines):
@@ -119,89 +211,148 @@ def split_into_disjoint(spans, lines):
     Returns:
         [spans] - a sorted list of disjoint colorable spans
     """
-    if not spans: return []
+    # The spans which begin at the same point are kept in the given order.
+    spans = sorted(spans, key=lambda span: span.extent.begin)
+    return list(iter_disjoint_spans(spans, lines))
 
-    # Throwing in fake zero-length spans to denote the line boundaries. They
-    # will be used only for splitting and will get filtered out of the results.
-    #
-    # Lines are (begin, end) where begin is the point at the start of the line
-    # and end is the one at the newline character. The line boundaries are all
-    # the beginnings and the trailing end.
 
-    def make_linebreak(point):
-        return ColorableSpan(Region(point, point), None, None)
+# Fake zero-length spans denote the line boundaries. They are used only for
+# splitting and get filtered out of the results.
+#
+# Lines are (begin, end) where begin is the point at the start of the line
+# and end is the one at the newline character. The line boundaries are all
+# the beginnings and the trailing end.
 
-    def linebreak(span):
-        return (span.foreground is None) and (span.background_stack is None)
+def _make_linebreak(point):
+    return ColorableSpan(Region(point, point), None, None)
 
-    linebreaks = map(make_linebreak, [L.begin for L in lines] + [lines[-1].end])
 
-    # We make use of the heap property to efficiently split the spans into
-    # disjoint parts with a sweeping line algorithm. The resulting span list
-    # also gets automagically sorted.
+def _is_linebreak(span):
+    return (span.foreground is None) and (span.background_stack is None)
 
-    def heap_min(heap):
-        return heap[0]
 
-    def heap_min_next(heap):
-        return min(heap[1], heap[2]) if len(heap) > 2 else heap[1]
+def _linebreaks(lines):
+    return [_make_linebreak(point) for point in [L.begin for L in lines] + [lines[-1].end]]
 
-    spans = spans[:]
-    spans.extend(linebreaks)
-    heapify(spans)
 
-    def overlap(left_span, right_span):
-        return left_span.extent.overlaps(right_span.extent)
+def _overlap(left_span, right_span):
+    return left_span.extent.overlaps(right_span.extent)
 
-    def left_touch(span1, span2):
-        return span1.extent.begin == span2.extent.begin
 
-    def trim(inner_span, outer_span):
-        extent = Region(inner_span.extent.end, outer_span.extent.end)
-        foreground = outer_span.foreground
-        background_stack = outer_span.background_stack
+def _left_touch(span1, span2):
+    return span1.extent.begin == span2.extent.begin
 
-        return ColorableSpan(extent, foreground, background_stack)
 
-    def split(outer_span, inner_span):
-        extent1 = Region(outer_span.extent.begin, inner_span.extent.begin)
-        extent2 = Region(inner_span.extent.end, outer_span.extent.end)
-        foreground = outer_span.foreground
-        background_stack = outer_span.background_stack
+def _trim(inner_span, outer_span):
+    extent = Region(inner_span.extent.end, outer_span.extent.end)
+    foreground = outer_span.foreground
+    background_stack = outer_span.background_stack
 
-        return ColorableSpan(extent1, foreground, background_stack), \
-               ColorableSpan(extent2, foreground, background_stack)
+    return ColorableSpan(extent, foreground, background_stack)
+
+
+def _split(outer_span, inner_span):
+    # Scopes matched over several cursors may cross each other. Then the
+    # inner span sticks out of the outer one and takes its tail entirely.
+    extent1 = Region(outer_span.extent.begin, inner_span.extent.begin)
+    extent2 = Region(min(inner_span.extent.end, outer_span.extent.end),
+                     outer_span.extent.end)
+    foreground = outer_span.foreground
+    background_stack = outer_span.background_stack
+
+    return ColorableSpan(extent1, foreground, background_stack), \
+           ColorableSpan(extent2, foreground, background_stack)
+
+
+def iter_disjoint_spans(spans, lines):
+    """Lazily splits colorable spans into disjoint colorable spans.
+
+    This is a streaming version of split_into_disjoint. The spans must come
+    sorted by their beginning (as iter_colored_scopes yields them), so only
+    the spans enclosing the current point of the sweeping line need to be
+    kept on the heap, and their amount is bounded by the nesting depth.
+
+    Spans that begin at the same point are handled shorter first, so that
+    a line boundary is always split off before the spans starting at it.
+
+    Args:
+        (spans) - an iterable of colorable spans to be split, sorted
+
+        [lines] - a list of regions denoting the lines
+
+    Yields:
+        span - disjoint colorable spans, in sorted order
+    """
+    spans = iter(spans)
+
+    for first_span in spans:
+        break
+    else:
+        return
+
+    # We make use of the heap property to efficiently split the spans into
+    # disjoint parts with a sweeping line algorithm. The resulting spans also
+    # get automagically sorted.
+    #
+    # Heap entries are keyed explicitly by (begin, end) with a serial number
+    # to break the ties, so the spans themselves are never compared. Serial
+    # numbers follow the order of the incoming spans, and the parts of a span
+    # keep its number. Of the spans with the same extent the first one keeps
+    # its colors there. This is the order iter_colored_scopes yields.
+
+    serial_numbers = count()
+
+    def keyed(span, serial=None):
+        if serial is None:
+            serial = next(serial_numbers)
+        return (span.extent.begin, span.extent.end, serial, span)
+
+    incoming = merge([keyed(first_span)], imap(keyed, spans), imap(keyed, _linebreaks(lines)))
+
+    heap = []
+    next_entry = next(incoming, None)
+
+    while True:
+        # Invariant: every span that begins within the leftmost one is on the
+        # heap, so the heap holds the real leftmost and next spans.
+        while (next_entry is not None) and \
+              ((not heap) or (next_entry[0] <= heap[0][1])):
+            heappush(heap, next_entry)
+            next_entry = next(incoming, None)
+
+        if (len(heap) == 1) and (next_entry is None):
+            break
+
+        _, _, serial, leftmost = heap[0]
+        next_serial, next_one = None, None
+        if len(heap) > 1:
+            _, _, next_serial, next_one = min(heap[1:3])
 
-    result = []
-    while len(spans) > 1:
-        leftmost, next_one = heap_min(spans), heap_min_next(spans)
         # Invariant: leftmost must be disjoint from all other spans
 
-        if overlap(leftmost, next_one):
-            if left_touch(leftmost, next_one):
+        if (next_one is not None) and _overlap(leftmost, next_one):
+            if _left_touch(leftmost, next_one):
                 # LL...... -> LL......
                 # NNNNN...    ..FFF...
-                following = trim(leftmost, next_one)
-                heappop(spans)
-                heapreplace(spans, following)
+                following = _trim(leftmost, next_one)
+                heappop(heap)
+                heapreplace(heap, keyed(following, next_serial))
             else:
                 # LLLLLLL. -> LL...FF.
                 # ..NNN...    ..NNN...
-                leftmost, following = split(leftmost, next_one)
-                heapreplace(spans, following)
+                leftmost, following = _split(leftmost, next_one)
+                heapreplace(heap, keyed(following, serial))
         else:
             # LLL.....
             # ....NNN.
-            heappop(spans)
-
-        if not linebreak(leftmost):
-            result.append(leftmost)
+            heappop(heap)
 
-    last_span = spans[0]
-    if not linebreak(last_span):
-        result.append(last_span)
+        if not _is_linebreak(leftmost):
+            yield leftmost
 
-    return result
+    last_span = heap[0][3]
+    if not _is_linebreak(last_span):
+        yield last_span
 
 
 def prepend_background(spans, line_extents):
@@ -220,6 +371,22 @@ def prepend_background(spans, line_extents):
     Returns:
         [spans] - a list of updated colorable spans
     """
+    return list(iter_with_background(spans, line_extents))
+
+
+def iter_with_background(spans, line_extents):
+    """Lazily prepends proper terminating background to colorable spans.
+
+    This is a streaming version of prepend_background.
+
+    Args:
+        (spans) - an iterable of colorable spans to update
+
+        [line_extents] - a list of regions denoting the cursors' lines
+
+    Yields:
+        span - updated colorable spans, in the same order
+    """
     def prepend_background(span):
         current_line_color = [(RegionColor.CURRENT_LINE, None)]
         background_color = [(RegionColor.BACKGROUND, None)]
@@ -235,7 +402,7 @@ def prepend_background(spans, line_extents):
 
         return ColorableSpan(span.extent, span.foreground, background_stack)
 
-    return map(prepend_background, spans)
+    return imap(prepend_background, spans)
 
 
 def compute_span_color(span, config):
@@ -249,16 +416,28 @@ def compute_span_color(span, config):
     Returns:
         (fg, bg) - a tuple of resulting merged color
     """
-    def color_of((kind, index)):
-        color = config.color[kind]
-        if isinstance(color, list):
-            color = color[(index - 1) % len(color)]
-        return color
-
-    foreground, background = color_of(span.foreground)
+    foreground, background = color_of(span.foreground, config)
 
     underlying_background = reversed(span.background_stack)
     while background is None:
-        _, background = color_of(next(underlying_background))
+        _, background = color_of(next(underlying_background), config)
 
     return foreground, background
+
+
+def color_of(color_type, config):
+    """Looks up the color of a color tuple in the configuration.
+
+    Args:
+        color_type - a (kind, index) color tuple of a span
+
+        config - the Configuration to use for picking colors
+
+    Returns:
+        (fg, bg) - a tuple of the color, transparent parts are None
+    """
+    kind, index = color_type
+    color = config.color[kind]
+    if isinstance(color, list):
+        color = color[(index - 1) % len(color)]
+    return color
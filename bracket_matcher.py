@@ -0,0 +1,80 @@
+import re
+
+
+class BracketMatcher:
+    """A compiled matcher of all kinds of brackets at once.
+
+    The textual representations of the brackets are stored in a trie, so
+    the brackets are matched in a single pass over the text regardless of
+    how many kinds of them are supported. The longest bracket is matched
+    at every point, so brackets may be prefixes of other brackets, like
+    '(' and '#(' or '#?(' are. If a left and a right bracket are textually
+    equal then the one of the pair listed first wins, left one first.
+
+    Fields:
+        longest - length of the longest bracket
+    """
+    _BRACKET = None # trie key of the bracket that ends at a node
+
+    def __init__(self, supported_brackets):
+        """Compiles a matcher.
+
+        Args:
+            [supported_brackets]
+                - a list of (left_bracket, right_bracket) tuples of strings
+                  that specify textual representation of the brackets
+        """
+        self._trie = {}
+        self.longest = 0
+
+        for left, right in supported_brackets:
+            self._add(left, True)
+            self._add(right, False)
+
+        # Candidate points are located by their first character, leaving
+        # most of the text to the regular expression engine.
+        first_characters = ''.join(sorted(self._trie))
+        self._candidates = re.compile('[%s]' % re.escape(first_characters)) \
+            if first_characters else None
+
+    def _add(self, bracket, is_left):
+        assert bracket
+        node = self._trie
+        for character in bracket:
+            node = node.setdefault(character, {})
+        node.setdefault(BracketMatcher._BRACKET, (bracket, is_left))
+        self.longest = max(self.longest, len(bracket))
+
+    def match_at(self, text, index):
+        """Matches the longest bracket at the given index of the text.
+
+        Returns:
+            (bracket, is_left) - the matched bracket and its type,
+                                 or None if there is no bracket there
+        """
+        node = self._trie
+        match = None
+        while index < len(text):
+            node = node.get(text[index])
+            if node is None:
+                break
+            match = node.get(BracketMatcher._BRACKET, match)
+            index += 1
+        return match
+
+    def candidates(self, text, begin, end):
+        """Yields the indices in [begin, end) where brackets may start."""
+        if self._candidates is None:
+            return iter(())
+        return (match.start() for match in self._candidates.finditer(text, begin, end))
+
+
+_compiled_matchers = {}
+
+def compiled_matcher(supported_brackets):
+    """Returns a BracketMatcher for the brackets, compiling it only once."""
+    key = tuple(supported_brackets)
+    matcher = _compiled_matchers.get(key)
+    if matcher is None:
+        matcher = _compiled_matchers[key] = BracketMatcher(supported_brackets)
+    return matcher
@@ -0,0 +1,263 @@
+from itertools import islice
+
+if __package__:
+    from .bracket_coloring import compute_span_color
+    from .lisp_highlight_configuration import RegionColor
+
+    from .types import Region, LeftBracket, RightBracket, ColorableSpan
+    from .utils import izip
+else:
+    from bracket_coloring import compute_span_color
+    from lisp_highlight_configuration import RegionColor
+
+    from types import Region, LeftBracket, RightBracket, ColorableSpan
+    from utils import izip
+
+#
+# Rainbow brackets
+#
+
+class ColoredLine:
+    """The brackets of a line of the bracket balance colored by their depth,
+    as far as the line alone tells, kept for the next time the line is
+    colored (see color_brackets_by_depth).
+
+    Fields:
+        key - (scope, depth, first, last): the scope and the depth the line
+              has begun at, and the part of it that has been colored,
+              relative to its beginning
+
+        brackets - [(bracket, depth)] of the brackets of that part, with
+                   their points relative to the beginning of the line
+
+        foregrounds - the foreground color tuples of the brackets, or None
+                      for the ones that are not matched within the line
+
+        rights, lefts - indices of the right and the left brackets that are
+                        not matched within the line, in order
+
+        begin - the point the line has begun at when the regions were made
+
+        regions - [Region] of the brackets, where the line has begun then
+
+        groups - [(foreground, [Region])] of the brackets grouped by their
+                 foregrounds, in order, or None if some of the brackets are
+                 matched across the lines
+    """
+    def __init__(self, key, brackets, foregrounds, rights, lefts):
+        self.key = key
+        self.brackets = brackets
+        self.foregrounds = foregrounds
+        self.rights = rights
+        self.lefts = lefts
+        self.begin = None
+        self.regions = None
+        self.groups = None
+
+    def move_to(self, begin):
+        """Makes the regions of the brackets for the line beginning at the
+        point, unless it has begun there before.
+        """
+        if begin != self.begin:
+            self.begin = begin
+            self.regions = [Region(begin + bracket.point,
+                                   begin + bracket.point + len(bracket.kind))
+                            for bracket, _ in self.brackets]
+
+            if not (self.rights or self.lefts):
+                groups = {}
+                for foreground, region in izip(self.foregrounds, self.regions):
+                    groups.setdefault(foreground, []).append(region)
+                self.groups = list(groups.items())
+
+    def bracket(self, index):
+        """Returns the bracket with the index where the line begins now."""
+        bracket, _ = self.brackets[index]
+        if bracket.is_left():
+            return LeftBracket(self.begin + bracket.point, bracket.kind)
+        else:
+            return RightBracket(self.begin + bracket.point, bracket.kind)
+
+
+def depth_foreground(depth, consistent):
+    """Returns the foreground color tuple of a bracket at the depth."""
+    # Brackets below the top level close more than there was opened.
+    if consistent and (depth >= 0):
+        return RegionColor.RAINBOW, depth + 1
+    else:
+        return RegionColor.INCONSISTENT, None
+
+
+def color_line(balance, begin, key, valid_pairs):
+    """Colors the brackets of the line of the balance which begins at the
+    point, see ColoredLine for the key.
+    """
+    _, _, first, last = key
+
+    brackets = []
+    for bracket, depth in balance.iter_depths(Region(begin + first, begin + last)):
+        if bracket.is_left():
+            bracket = LeftBracket(bracket.point - begin, bracket.kind)
+        else:
+            bracket = RightBracket(bracket.point - begin, bracket.kind)
+        brackets.append((bracket, depth))
+
+    foregrounds = [None] * len(brackets)
+    rights, lefts = [], []
+    for index, (bracket, depth) in enumerate(brackets):
+        if bracket.is_left():
+            lefts.append(index)
+        elif lefts:
+            left = lefts.pop()
+            left_bracket, left_depth = brackets[left]
+            consistent = (left_bracket.kind, bracket.kind) in valid_pairs
+            foregrounds[left] = depth_foreground(left_depth, consistent)
+            foregrounds[index] = depth_foreground(depth, consistent)
+        else:
+            rights.append(index)
+
+    return ColoredLine(key, brackets, foregrounds, rights, lefts)
+
+
+def color_brackets_by_depth(balance, region, config, supported_brackets, limit,
+                            colored_lines=None):
+    """Colors the brackets of the region by their depth in the whole buffer.
+
+    Matching brackets get the same color, cycling through the rainbow colors
+    of the `config` as the depth grows. Brackets that do not match, match the
+    brackets of a different kind, or are located at a negative depth get the
+    inconsistent color instead.
+
+    Brackets are paired within the region, the ones that match something
+    outside of it are paired with the bracket balance of the view. Only the
+    `limit` innermost of them are looked up on each side, the outer ones are
+    colored by their depth alone.
+
+    The brackets matched within a line are colored along with the line, and
+    the lines are kept in `colored_lines` for the next time. Only the lines
+    which have been edited since, begin at another depth or in another scope,
+    or have come into the region are colored again. The brackets matched
+    across the lines are paired every time.
+
+    Args:
+        balance - the BracketBalance of the view
+
+        region - the region where the brackets should be colored
+
+        config - the Configuration to use for picking colors
+
+        [supported_brackets]
+            - a list of (left, right) pairs of strings that denote
+              the valid kinds of brackets
+
+        limit - the maximum number of brackets to pair outside of the region
+                on each side of it
+
+        colored_lines - {Line: ColoredLine} of the lines of the balance
+                        colored the last time, which is left with the lines
+                        of the region, or None to keep nothing
+
+    Returns:
+        {color: [Region]} - regions of the brackets grouped by their color
+    """
+    valid_pairs = set(supported_brackets)
+    if colored_lines is None:
+        colored_lines = {}
+
+    lines = []
+    for line, begin, depth in balance.iter_lines(region):
+        key = (line.scope, depth, max(region.begin - begin, 0),
+               min(region.end - begin, len(line.text)))
+        colored = colored_lines.get(line)
+        if (colored is None) or (colored.key != key):
+            colored = color_line(balance, begin, key, valid_pairs)
+        colored.move_to(begin)
+        lines.append((line, colored))
+
+    colored_lines.clear()
+    colored_lines.update(lines)
+
+    # The brackets not matched within their lines are (row, index) pairs.
+
+    crossing = {}
+
+    def pair(left, right):
+        left_bracket, left_depth = lines[left[0]][1].brackets[left[1]]
+        right_bracket, right_depth = lines[right[0]][1].brackets[right[1]]
+        consistent = (left_bracket.kind, right_bracket.kind) in valid_pairs
+        crossing[left] = depth_foreground(left_depth, consistent)
+        crossing[right] = depth_foreground(right_depth, consistent)
+
+    unmatched_left = []
+    unmatched_right = []
+
+    for row, (_, colored) in enumerate(lines):
+        for index in colored.rights:
+            if unmatched_left:
+                pair(unmatched_left.pop(), (row, index))
+            else:
+                unmatched_right.append((row, index))
+        unmatched_left.extend((row, index) for index in colored.lefts)
+
+    # The unmatched right brackets are enclosed by each other, the innermost
+    # one is the last. And it is the other way around for the left ones.
+
+    for row, index in islice(reversed(unmatched_right), limit):
+        colored = lines[row][1]
+        right = colored.bracket(index)
+        left = next(balance.enclosing_brackets(right.point), None)
+        consistent = (left is not None) and ((left.kind, right.kind) in valid_pairs)
+        crossing[row, index] = depth_foreground(colored.brackets[index][1], consistent)
+
+    for row, index in islice(reversed(unmatched_left), limit):
+        colored = lines[row][1]
+        left = colored.bracket(index)
+        right = balance.matching_bracket(left)
+        consistent = (right is not None) and ((left.kind, right.kind) in valid_pairs)
+        crossing[row, index] = depth_foreground(colored.brackets[index][1], consistent)
+
+    # There are only a few distinct colors, each of them is resolved only
+    # once. The brackets come in order, so the regions of every color do.
+
+    background = [(RegionColor.BACKGROUND, None)]
+    colors = {}
+
+    def color_of(foreground):
+        color = colors.get(foreground)
+        if color is None:
+            color = colors[foreground] = compute_span_color(
+                ColorableSpan(None, foreground, background), config)
+        return color
+
+    colored_regions = {}
+    for row, (_, colored) in enumerate(lines):
+        if colored.groups is not None:
+            for foreground, regions in colored.groups:
+                colored_regions.setdefault(color_of(foreground), []).extend(regions)
+            continue
+
+        for index, foreground in enumerate(colored.foregrounds):
+            if foreground is None:
+                foreground = crossing.get((row, index))
+                if foreground is None:
+                    foreground = depth_foreground(colored.brackets[index][1], True)
+
+            colored_regions.setdefault(color_of(foreground), []).append(colored.regions[index])
+
+    return colored_regions
+
+
+def rainbow_palette(config):
+    """Returns [(fg, bg)] colors that rainbow brackets may be colored with."""
+    background = [(RegionColor.BACKGROUND, None)]
+
+    foregrounds = [(RegionColor.RAINBOW, index + 1)
+                   for index in range(len(config.color[RegionColor.RAINBOW]))]
+    foregrounds.append((RegionColor.INCONSISTENT, None))
+
+    palette = []
+    for foreground in foregrounds:
+        color = compute_span_color(ColorableSpan(None, foreground, background), config)
+        if color not in palette:
+            palette.append(color)
+    return palette
@@ -1,8 +1,19 @@
 import sublime
 
-from bisect import bisect_left
+from itertools import islice
 
-from types import Region, span, Bracket, LeftBracket, RightBracket, Scope
+if __package__:
+    from .bracket_matcher import compiled_matcher
+    from .lisp_highlight_configuration import ColorMode, RegionColor
+
+    from .types import Region, span, LeftBracket, RightBracket, Scope, PositionIndex
+    from .utils import izip, xrange
+else:
+    from bracket_matcher import compiled_matcher
+    from lisp_highlight_configuration import ColorMode, RegionColor
+
+    from types import Region, span, LeftBracket, RightBracket, Scope, PositionIndex
+    from utils import izip, xrange
 
 #
 # Cursors and regions
@@ -57,7 +68,7 @@ def current_lines_of_view(view, cursors):
     return result
 
 
-def expand_cursors_to_regions(cursors, amount, view):
+def expand_cursors_to_regions(cursors, amount, view, balance=None):
     """Computes the vicinities of the cursors.
 
     Args:
@@ -67,19 +78,77 @@ def expand_cursors_to_regions(cursors, amount, view):
 
         view - the sublime.View the cursors are from
 
+        balance - the BracketBalance of the view, if the regions should be
+                  widened over the expressions they cut (see below)
+
     Returns:
         [regions] - a list of regions corresponding to the cursors
     """
+    return list(iter_expanded_regions(cursors, amount, view, balance))
+
+
+def iter_expanded_regions(cursors, amount, view, balance=None):
+    """Lazily computes the vicinities of the cursors.
+
+    This is a streaming version of expand_cursors_to_regions.
+
+    If the bracket balance of the view is given, the regions are widened by
+    up to `amount` points more so that they do not cut the expressions that
+    do not enclose the cursor, and do not begin in the middle of a bracket.
+    Such regions contain every such expression near the cursor as a whole.
+    The regions are kept sorted for merge_adjacent_regions, so a region is
+    not widened to begin before the one of the previous cursor.
+
+    Args:
+        (cursors) - an iterable of cursors that will be centers of the regions
+
+        amount - radius (in points) of desired regions
+
+        view - the sublime.View the cursors are from
+
+        balance - the BracketBalance of the view, or None
+
+    Yields:
+        region - regions corresponding to the cursors, in the same order
+    """
     assert (amount >= 0)
     view_begin, view_end = 0, view.size() - 1
 
-    def clamp_expand(cursor):
+    # Expressions that enclose an edge of the region but not the cursor are
+    # the ones that the region cuts, there are as many of them as the depth
+    # drops between the edge and the cursor.
+
+    def widened_begin(begin, cursor):
+        begin = balance.bracket_start(begin)
+        cut = max(0, balance.depth_at(begin) - balance.min_depth(begin, cursor))
+        for left in islice(balance.enclosing_brackets(begin), cut):
+            if left.point < cursor - 2 * amount:
+                break
+            begin = left.point
+        return begin
+
+    def widened_end(end, cursor):
+        cut = max(0, balance.depth_at(end) - balance.min_depth(cursor, end))
+        for left in islice(balance.enclosing_brackets(end), cut):
+            right = balance.matching_bracket(left, cursor + 2 * amount)
+            if right is None:
+                break
+            end = right.point + 1
+        return min(end, view_end)
+
+    previous_begin, previous_end = view_begin, view_begin
+
+    for cursor in cursors:
         begin, end = cursor - amount, cursor + amount
         if begin < view_begin: begin = view_begin
         if end > view_end: end = view_end
-        return Region(begin, end)
 
-    return map(clamp_expand, cursors)
+        if balance is not None:
+            begin = max(widened_begin(begin, cursor), previous_begin)
+            end = max(widened_end(end, cursor), previous_end)
+            previous_begin, previous_end = begin, end
+
+        yield Region(begin, end)
 
 
 def merge_adjacent_regions(regions, cursors):
@@ -98,28 +167,53 @@ def merge_adjacent_regions(regions, cursors):
     if not regions: return []
     assert len(regions) == len(cursors)
 
-    current_region = regions[0]
-    current_cursors = set([cursors[0]])
+    return list(iter_merged_regions(regions, cursors))
 
-    result = []
 
-    for next_region, next_cursor in zip(regions[1:], cursors[1:]):
-        if current_region.touches(next_region):
+def iter_merged_regions(regions, cursors):
+    """Lazily merges overlapping regions and computes the contained cursors.
+
+    This is a streaming version of merge_adjacent_regions. A merged region is
+    yielded as soon as a region that does not touch it comes along.
+
+    Args:
+        (regions) - an iterable of regions obtained by expanding the cursors
+
+        (cursors) - an iterable of cursors that are the centers of the regions
+
+    Yields:
+        (Region, [cursors])
+            - disjoint regions and the cursors they contain, in sorted
+              order, the cursors are also sorted
+    """
+    current_region = None
+    current_cursors = None
+
+    for next_region, next_cursor in izip(regions, cursors):
+        if current_region is None:
+            current_region = next_region
+            current_cursors = set([next_cursor])
+
+        elif current_region.touches(next_region):
             current_region = span(current_region, next_region)
             current_cursors.add(next_cursor)
+
         else:
-            result.append((current_region, sorted(current_cursors)))
+            yield current_region, sorted(current_cursors)
             current_region = next_region
             current_cursors = set([next_cursor])
 
-    result.append((current_region, sorted(current_cursors)))
-    return result
+    if current_region is not None:
+        yield current_region, sorted(current_cursors)
 
 #
 # Brackets
 #
 
-def locate_brackets(view, region, supported_brackets, suitable_scope):
+# Amount of text read from the view at once while scanning for brackets.
+scan_chunk_size = 4096
+
+def locate_brackets(view, region, supported_brackets, suitable_scope, deadline=None):
     """Locates all brackets in the specified region of the view.
 
     Args:
@@ -134,45 +228,115 @@ def locate_brackets(view, region, supported_brackets, suitable_scope):
         suitable_scope
             - a predicate of signature (scope) that tells whether
               the given scope should be checked for brackets
+
+        deadline - the Deadline to check while scanning, or None
     Returns:
         [bracket] - a list of brackets that were found
     """
-    def substring_matches_at(point, haystack, needle):
-        region = sublime.Region(point, point + len(needle))
-        return haystack.substr(region) == needle
+    return list(iter_brackets(view, region, supported_brackets, suitable_scope, deadline))
+
+
+def iter_brackets(view, region, supported_brackets, suitable_scope, deadline=None):
+    """Lazily locates brackets in the specified region of the view.
+
+    This is a streaming version of locate_brackets. The view is scanned only
+    as far as the brackets are consumed, a chunk of text at a time.
+
+    Args:
+        view - a sublime.View to scan for brackets
+
+        region - the exact region in the view to scan through
+
+        [supported_brackets]
+            - a list of (left_bracket, right_bracket) tuples of strings
+              that specify textual representation of the brackets
+
+        suitable_scope
+            - a predicate of signature (scope) that tells whether
+              the given scope should be checked for brackets
+
+        deadline - the Deadline to check before every chunk, or None
+    Yields:
+        bracket - brackets that were found, in the order of appearance
+    """
+    # All kinds of brackets are matched at once, preferring the longest one
+    # when a bracket is a prefix of some other bracket (like '(' and '#(').
+    # Scopes are checked only at the points where some bracket matches.
+    matcher = compiled_matcher(supported_brackets)
+
+    # Brackets that start at the end of a chunk may extend past it.
+    overlap = matcher.longest - 1
+
+    resume = region.begin
+    for chunk_begin in xrange(region.begin, region.end, scan_chunk_size):
+        if deadline is not None:
+            deadline.check()
+
+        chunk_end = min(chunk_begin + scan_chunk_size, region.end)
+        text = view.substr(sublime.Region(chunk_begin, chunk_end + overlap))
+
+        for index in matcher.candidates(text, max(0, resume - chunk_begin),
+                                        chunk_end - chunk_begin):
+            point = chunk_begin + index
+            if point < resume:
+                continue
+
+            match = matcher.match_at(text, index)
+            if match is None:
+                continue
+
+            if not suitable_scope(view.scope_name(point)):
+                continue
+
+            bracket, is_left = match
+            if is_left:
+                yield LeftBracket(point, bracket)
+            else:
+                yield RightBracket(point, bracket)
 
-    # We assume that brackets match unambiguously: i.e., a bracket must not be
-    # a prefix of some other bracket (though, they may be textually equal).
+            resume = point + len(bracket)
 
-    brackets = []
+def complete_brackets(brackets, region, balance, limit):
+    """Adds the far brackets of the expressions cut by the region.
 
-    point = region.begin
-    while point < region.end:
+    Left brackets of the expressions enclosing the beginning of the region
+    and right brackets of the ones enclosing its end are looked up in the
+    bracket balance of the view, however far they are. Only these brackets
+    are added: the expressions in between them are always balanced and do
+    not change the indices of the brackets around them. The innermost ones
+    are taken, so the brackets that get left out have no match anyway.
 
-        if suitable_scope(view.scope_name(point)):
+    Args:
+        [brackets] - a list of brackets located in the region
+
+        region - the examined region where the brackets were located
 
-            for left, right in supported_brackets:
+        balance - the BracketBalance of the view
 
-                if substring_matches_at(point, view, left):
-                    brackets.append(LeftBracket(point, left))
-                    point += len(left) - 1
-                    break
+        limit - the maximum number of enclosing expressions to look up
+                for each edge of the region
 
-                if substring_matches_at(point, view, right):
-                    brackets.append(RightBracket(point, right))
-                    point += len(right) - 1
-                    break
+    Returns:
+        [bracket] - a list of the brackets with the far ones added, sorted
+    """
+    far_left = list(islice(balance.enclosing_brackets(region.begin), limit))
+    far_left.reverse()
 
-        point += 1
+    far_right = []
+    for left in islice(balance.enclosing_brackets(region.end), limit):
+        right = balance.matching_bracket(left)
+        if right is None:
+            break
+        far_right.append(right)
 
-    return brackets
+    return far_left + brackets + far_right
 
 #
 # Indexing
 #
 
-def index_brackets(brackets, cursor):
-    """Assigns nesting indices to brackets relative to the given cursor.
+def index_brackets(brackets, cursors, config, positions=None):
+    """Assigns nesting indices to brackets relative to the given cursors.
 
     Nesting index is a tuple of (outer_nesting_level, inner_nesting_level)
     which are integers that describe how deeply the given bracket is nested
@@ -232,109 +396,163 @@ def index_brackets(brackets, cursor):
       - outer index tells how many mainline bracket pairs should be crossed
         from outside the expression to get to the nesting level of the cursor
 
+    With several cursors, every bracket gets the minimum of its indices
+    relative to each of them; because index of a bracket is the amount of
+    nesting levels that need to be crossed to get from the bracket to the
+    cursor. Therefore, it's pretty logical to take the shortest available
+    path. The only peculiarity is the outer index -1 that should not be
+    considered lesser than index 0. Conversely, -1 should be treated as
+    +Infinity because it marks brackets that are unreachable along the
+    shortest path between the cursor and the outside of the bracket
+    expression.
+
+    Inner indices of brackets nested deeper than the `config` allows to show
+    are saturated to the same 'hidden' value. Such brackets are still counted
+    to keep the indices of the enclosing ones correct, but their exact depth
+    does not matter, so the hidden indices are shared and not built anew.
+
+    The brackets need not be contiguous. The far brackets of the expressions
+    enclosing the examined region (see complete_brackets) get their outer
+    indices just as if the whole text in between was there.
+
     Args:
         [brackets] - a list of brackets to index
 
-        cursor - the cursor which is used as a kernel
+        [cursors] - a sorted list of cursors which are used as kernels
+
+        config - the Configuration which limits the visible nesting depth
+
+        positions - the PositionIndex of the cursors and the brackets,
+                    or None to build one
 
     Returns:
         [indices] - a list of indices assigned to brackets
     """
-    def cursor_insertion_index(cursor, brackets):
-        """Returns the index of the bracket immediately following the cursor."""
-        # The bracket with the index returned will the first bracket that is
-        # located to the right of the cursor's point. Special arrangements
-        # need to be done for multicharacter left brackets to ensure that
-        # they are treated by bisect_left as 'located to the left' only
-        # when they are _entirely_ located to the left of the cursor.
-        return bisect_left(map(Bracket.inside_point, brackets), cursor)
-
-    cii = cursor_insertion_index(cursor, brackets)
-
-    def index_left(brackets, cii):
-        """Indexes brackets located to the left of the cursor."""
-        left_indices = []
-        outer_depth = -1
-        next_depth = 0
-
-        for bracket in reversed(brackets[0:cii]):
-            inner_depth = next_depth
-
-            if bracket.is_left():
-                if next_depth == 0:
-                    outer_depth += 1
+    if positions is None:
+        positions = PositionIndex(cursors, brackets)
+
+    # Both indices are differences of the nesting depth. Let the depth of
+    # a gap between the brackets be the number of left brackets minus the
+    # number of right ones before it, and the inside depth of a bracket be
+    # the greater depth of the two gaps around it. Relative to a cursor in
+    # some gap, the inner index of a bracket is its inside depth less the
+    # lowest depth from the cursor to the near gap of the bracket, and its
+    # outer index is the depth of the cursor less the lowest depth from the
+    # cursor to the far gap of the bracket, less one.
+    #
+    # So the nearest cursor on either side gives the least inner index. The
+    # least outer index takes all the cursors on a side into account, and
+    # they are swept from both ends at once: the cursors behind the sweep
+    # are grouped by the lowest depth seen since them, which only goes down,
+    # so that the groups are merged like a stack. Every group knows the least
+    # positive difference of its cursors, and the least one of the groups
+    # below it. Either way every bracket is visited twice at most.
+
+    count = len(brackets)
+
+    depths = [0] * (count + 1)
+    depth = 0
+    for index, bracket in enumerate(brackets):
+        depth += 1 if bracket.is_left() else -1
+        depths[index + 1] = depth
+
+    # Inner indices never exceed the number of brackets.
+    visible_limit = config.inner_index_limit()
+    if visible_limit is None:
+        visible_limit = count
+    hidden_indices = {}
+
+    indices = [None] * count
+
+    def least_of(a, b):
+        """Returns the lesser of the values, either of which may be None."""
+        if a is None: return b
+        if b is None: return a
+        return min(a, b)
+
+    def sweep(gaps, step):
+        """Indexes the brackets relative to the cursors in the gaps which come
+        before them in the direction of the step.
+        """
+        # Groups of cursors, as (lowest depth since the cursors, lowest depth
+        # of the cursors, least positive difference of the two, least one of
+        # the group and the ones below). The lowest depths grow to the top.
+        groups = []
+        floor = least = None
+
+        gaps = iter(gaps)
+        next_gap = next(gaps)
+        end, offset = (count + 1, -1) if step > 0 else (-1, 0)
+
+        previous_depth = lowest_since_nearest = None
+
+        for gap in xrange(next_gap, end, step):
+            depth = depths[gap]
+
+            if previous_depth is not None:
+                if depth > previous_depth:
+                    inner_depth = depth - lowest_since_nearest
                 else:
-                    next_depth -= 1
-            else:
-                next_depth += 1
-                inner_depth += 1
-
-            left_indices.append((outer_depth, inner_depth))
-
-        left_indices.reverse()
-        return left_indices
-
-    def index_right(brackets, cii):
-        """Indexes brackets located to the right of the cursor."""
-        right_indices = []
-        outer_depth = -1
-        next_idepth = 0
-
-        for bracket in brackets[cii:]:
-            inner_depth = next_idepth
-
-            if bracket.is_right():
-                if next_idepth == 0:
-                    outer_depth += 1
+                    inner_depth = previous_depth - lowest_since_nearest
+                    if depth < lowest_since_nearest:
+                        lowest_since_nearest = depth
+
+                if depth < floor:
+                    lowest = difference = None
+                    while groups and (groups[-1][0] >= depth):
+                        group_floor, group_lowest, group_difference, _ = groups.pop()
+                        if group_floor > depth:
+                            group_difference = group_lowest - depth
+                        lowest = least_of(lowest, group_lowest)
+                        difference = least_of(difference, group_difference)
+
+                    least = least_of(groups[-1][3] if groups else None, difference)
+                    floor = depth
+                    groups.append((floor, lowest, difference, least))
+
+                outer_depth = -1 if least is None else least - 1
+
+                index = gap + offset
+                current = indices[index]
+                if current is not None:
+                    current_outer, current_inner = current
+                    if current_inner < inner_depth:
+                        inner_depth = current_inner
+                    if (current_outer != -1) and \
+                       ((outer_depth == -1) or (current_outer < outer_depth)):
+                        outer_depth = current_outer
+
+                if inner_depth <= visible_limit:
+                    indices[index] = outer_depth, inner_depth
                 else:
-                    next_idepth -= 1
-            else:
-                next_idepth += 1
-                inner_depth += 1
-
-            right_indices.append((outer_depth, inner_depth))
-
-        return right_indices
-
-    return index_left(brackets, cii) + index_right(brackets, cii)
-
-
-def merge_bracket_indices(per_cursor_indices):
-    """Merges indices assigned to brackets from several cursors.
-
-    The reasonable way to combine indices from two different cursors is
-    to take a minimum; because index of a bracket is the amount of nesting
-    levels that need to be crossed to get from the bracket to the cursor.
-    Therefore, it's pretty logical to take the shortest available path.
-
-    The only peculiarity is the outer index -1 that should not be considered
-    lesser than index 0. Conversely, -1 should be treated as +Infinity because
-    it marks brackets that are unreachable along the shortest path between the
-    cursor and the outside of the bracket expression.
-
-    Args:
-        [per_cursor_indices]
-            - a list of index lists assigned to the same bracket set
-              over a set of cursors
-    Returns:
-        [indices] - the resulting flattened index list for the brackets
-    """
-    def outer_min(o1, o2):
-        return max(o1, o2) if (o1 == -1) or (o2 == -1) else min(o1, o2)
-
-    def index_minimum(((o1, i1), (o2, i2))):
-        return outer_min(o1, o2), min(i1, i2)
+                    hidden_index = hidden_indices.get(outer_depth)
+                    if hidden_index is None:
+                        hidden_index = (outer_depth, visible_limit + 1)
+                        hidden_indices[outer_depth] = hidden_index
+                    indices[index] = hidden_index
+
+            if gap == next_gap:
+                if floor == depth:
+                    floor, lowest, difference, least = groups.pop()
+                    lowest = depth
+                else:
+                    floor, lowest, difference = depth, depth, None
+                groups.append((floor, lowest, difference, least))
+                lowest_since_nearest = depth
+                next_gap = next(gaps, None)
 
-    def merge_indices(current_min, next):
-        return map(index_minimum, zip(current_min, next))
+            previous_depth = depth
 
-    return reduce(merge_indices, per_cursor_indices)
+    gaps = positions.insertion_indices()
+    sweep(gaps, 1)
+    sweep(reversed(gaps), -1)
+    return indices
 
 #
 # Scopes
 #
 
-def compute_bracket_scopes(brackets, indices):
+def compute_bracket_scopes(brackets, indices, config):
     """Computes bracket scopes from brackets and their indices.
 
     A pair of 'matching' brackets form a scope. Brackets match when they are
@@ -342,30 +560,54 @@ def compute_bracket_scopes(brackets, indices):
     to at most one scope. A bracket can belong to no scope if the region does
     not include the corresponding matching bracket.
 
+    Scopes that cannot be colored with the given `config` are not computed.
+
     Args:
         [brackets] - a list of brackets where the scopes are to be found
 
         [indices] - a list of indices of the corresponding brackets
 
+        config - the Configuration which determines the visible scopes
+
     Returns:
         [scopes] - the resulting list of bracket scopes
     """
-    def indices_equal((o1, i1), (o2, i2)):
-        return (o1 == o2) and (i1 == i2)
+    inner_limit = config.inner_index_limit()
 
-    scopes = []
+    def may_be_visible(index):
+        if inner_limit is None:
+            return True
 
-    indexed_brackets = zip(indices, brackets)
+        outer, inner = index
 
-    for i, (left_index, left_bracket) in enumerate(indexed_brackets):
-        if left_bracket.is_right(): continue
+        if inner > inner_limit:
+            return False
 
-        remaining_brackets = enumerate(indexed_brackets[i+1:], i+1)
-        for j, (right_index, right_bracket) in remaining_brackets:
-            if right_bracket.is_left(): continue
+        if inner == 0:
+            kind = RegionColor.PRIMARY if outer == 0 else RegionColor.SECONDARY
+            return config.mode[kind] is not ColorMode.NONE
 
-            if indices_equal(left_index, right_index):
-                scopes.append(Scope(left_index, left_bracket, right_bracket))
-                break
+        return True
+
+    # The matching bracket of a left bracket is the nearest right bracket with
+    # the same index that follows it. Sweeping the brackets from the end, we
+    # keep track of the nearest right bracket for every index seen so far, so
+    # each left bracket finds its match at once instead of scanning for it.
+
+    nearest_right_brackets = {}
+
+    scopes = []
+
+    for index, bracket in reversed(list(zip(indices, brackets))):
+        if bracket.is_right():
+            nearest_right_brackets[index] = bracket
+            continue
+
+        if not may_be_visible(index): continue
+
+        right_bracket = nearest_right_brackets.get(index)
+        if right_bracket is not None:
+            scopes.append(Scope(index, bracket, right_bracket))
 
+    scopes.reverse()
     return scopes
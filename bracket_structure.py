@@ -0,0 +1,162 @@
+if __package__:
+    from .types import Region, Scope
+else:
+    from types import Region, Scope
+
+#
+# Structural queries
+#
+
+# Queries about the expressions of a buffer, answered from its BracketBalance
+# instead of scanning the text. Every query walks the balance tree in
+# O(log lines) and locates only the lines it stops at, which are kept by the
+# balance until the next edit, so the queries are cheap around the cursors
+# the highlighting has been done for.
+#
+# The scopes are indexed relative to the point the way index_brackets does
+# it: the scopes enclosing the point are mainline ones, (0, 0) for the
+# innermost one, (1, 0) for the one enclosing it, and so on, while the
+# expressions alongside the point get (-1, 1). Points inside of brackets
+# count as the beginnings of the brackets.
+
+def depth_at(balance, point):
+    """Returns the number of the expressions enclosing the point.
+
+    Args:
+        balance - the up-to-date BracketBalance of the view
+
+        point - the point to look at
+
+    Returns:
+        depth - zero at the top level, may be negative after unmatched right
+                brackets
+    """
+    return balance.depth_at(balance.bracket_start(point))
+
+
+def bracket_at(balance, point):
+    """Finds the bracket at the point: the one the point is at or inside of,
+    or else the one which ends right before the point.
+
+    Returns:
+        bracket - the Bracket found, or None
+    """
+    start = balance.bracket_start(point)
+    for bracket in balance.iter_brackets(Region(start, start + 1)):
+        return bracket
+
+    longest = max(len(kind) for pair in balance.supported_brackets for kind in pair)
+    before = None
+    for bracket in balance.iter_brackets(Region(max(0, point - longest), point)):
+        if bracket.point + len(bracket.kind) == point:
+            before = bracket
+    return before
+
+
+def matching_bracket(balance, bracket):
+    """Finds the bracket matching the given one, in either direction.
+
+    Returns:
+        bracket - the matching Bracket, or None if the bracket is unmatched
+    """
+    if bracket.is_left():
+        return balance.matching_bracket(bracket)
+
+    depth = balance.depth_at(bracket.point) - 1
+    found = balance.last_bracket_within(bracket.point, depth)
+    if found is None:
+        return None
+
+    left_bracket, left_depth = found
+    if left_bracket.is_left() and (left_depth == depth):
+        return left_bracket
+    return None
+
+
+def enclosing_scopes(balance, point):
+    """Yields the scopes enclosing the point, innermost first.
+
+    The scopes stop at the first unterminated expression, as it has no right
+    bracket to make a Scope with.
+
+    Yields:
+        scope - the Scope of an enclosing expression, with (n, 0) index
+    """
+    point = balance.bracket_start(point)
+    for outer_index, left_bracket in enumerate(balance.enclosing_brackets(point)):
+        right_bracket = balance.matching_bracket(left_bracket)
+        if right_bracket is None:
+            return
+        yield Scope((outer_index, 0), left_bracket, right_bracket)
+
+
+def enclosing_scope(balance, point):
+    """Returns the Scope of the innermost expression enclosing the point, or
+    None if the point is at the top level or the expression is unterminated.
+    """
+    for scope in enclosing_scopes(balance, point):
+        return scope
+    return None
+
+
+def next_sibling(balance, point):
+    """Finds the first expression which begins at or after the point in the
+    same enclosing expression.
+
+    Returns:
+        scope - the Scope of the expression with (-1, 1) index, or None if
+                there is no terminated expression before the end of the
+                enclosing one
+    """
+    point = balance.bracket_start(point)
+    found = balance.first_bracket_within(point, balance.depth_at(point))
+    if (found is None) or not found[0].is_left():
+        return None
+
+    left_bracket = found[0]
+    right_bracket = balance.matching_bracket(left_bracket)
+    if right_bracket is None:
+        return None
+    return Scope((-1, 1), left_bracket, right_bracket)
+
+
+def previous_sibling(balance, point):
+    """Finds the last expression which ends at or before the point in the
+    same enclosing expression.
+
+    Returns:
+        scope - the Scope of the expression with (-1, 1) index, or None if
+                there is none after the beginning of the enclosing one
+    """
+    point = balance.bracket_start(point)
+    found = balance.last_bracket_within(point, balance.depth_at(point))
+    if (found is None) or not found[0].is_right():
+        return None
+
+    right_bracket = found[0]
+    left_bracket = matching_bracket(balance, right_bracket)
+    if left_bracket is None:
+        return None
+    return Scope((-1, 1), left_bracket, right_bracket)
+
+
+def sibling_scopes(balance, point):
+    """Yields the scopes of all expressions alongside the point, in order.
+
+    These are the expressions of the innermost expression enclosing the
+    point which are not nested in others, or the top-level expressions.
+
+    Yields:
+        scope - the Scope of an expression, with (-1, 1) index
+    """
+    begin = 0
+    for left_bracket in balance.enclosing_brackets(balance.bracket_start(point)):
+        begin = left_bracket.point + len(left_bracket.kind)
+        break
+
+    while True:
+        scope = next_sibling(balance, begin)
+        if scope is None:
+            return
+        yield scope
+        begin = scope.right_bracket.point + len(scope.right_bracket.kind)
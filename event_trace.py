@@ -0,0 +1,143 @@
+import sublime
+
+import hashlib
+import json
+import os
+import tempfile
+
+from time import time
+
+if __package__:
+    from .utils import common_prefix_length, common_suffix_length
+else:
+    from utils import common_prefix_length, common_suffix_length
+
+#
+# Event traces
+#
+
+# Every line of a trace is a JSON object describing one selection event:
+#
+#     t       - seconds since the recording has started
+#     view    - id of the view
+#     buffer  - id of the buffer the view shows
+#     change  - change count of the buffer
+#     sel     - [[a, b]] of the selection regions
+#     size    - length of the text
+#     sha1    - hex digest of the text (in UTF-8)
+#     file    - path of the file the buffer holds, or null
+#
+# When snapshots are on and the buffer has been changed since its text was
+# recorded last time, one of these records the text as well:
+#
+#     text    - the whole text, for the first recorded text of the buffer and
+#               then for every `full_snapshot_every`-th one
+#     edit    - [begin, end, text] for the others: the last recorded text with
+#               the part from begin to end replaced by the text
+#
+# The first line is a header {"trace": _VERSION, "started": time}.
+_VERSION = 2
+
+
+def default_trace_path():
+    """Returns a fresh path in the temporary directory to record a trace into."""
+    return os.path.join(tempfile.gettempdir(),
+                        'LispBracketHighlighter-%d.trace' % int(time()))
+
+
+class TraceRecorder:
+    """Records the selection events into a JSON-lines file, so that they can
+    be replayed headlessly with benchmarks/replay.py.
+
+    The texts are hashed only once per change of their buffers, and written
+    out only when their digests differ from the last written ones, so that
+    moving the caret around costs a short line per event. A changed text is
+    written as the part that differs from the last written one, so that
+    typing into a large file does not write the whole file per keystroke;
+    the whole text is written again every `full_snapshot_every` times, for
+    the trace to be readable from there on.
+
+    Fields:
+        path - the file the trace is appended to
+
+        snapshots - whether the texts are recorded along with their digests
+
+        full_snapshot_every - how often a changed text is written whole
+
+        events - the number of events recorded so far
+    """
+    def __init__(self, path, snapshots=True, full_snapshot_every=100):
+        self.path = path
+        self.snapshots = snapshots
+        self.full_snapshot_every = full_snapshot_every
+        self.events = 0
+
+        self._file = open(path, 'a')
+        self._started = time()
+        self._write({'trace': _VERSION, 'started': self._started})
+
+        # buffer id -> (change count, digest) of the last hashed text
+        self._digests = {}
+        # buffer id -> (digest, text, texts written since the whole one) of
+        # the last written text
+        self._snapshots = {}
+
+    def record(self, view):
+        """Appends the current state of the view to the trace."""
+        buffer_id = view.buffer_id()
+        change_count = view.change_count()
+
+        text = None
+        digest = None
+        last_change_count, last_digest = self._digests.get(buffer_id, (None, None))
+        if last_change_count == change_count:
+            digest = last_digest
+        else:
+            text = view.substr(sublime.Region(0, view.size()))
+            digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            self._digests[buffer_id] = change_count, digest
+
+        event = {
+            't': round(time() - self._started, 4),
+            'view': view.id(),
+            'buffer': buffer_id,
+            'change': change_count,
+            'sel': [[region.a, region.b] for region in view.sel()],
+            'size': view.size(),
+            'sha1': digest,
+            'file': view.file_name(),
+        }
+
+        last_digest, last_text, written = self._snapshots.get(buffer_id, (None, None, 0))
+        if self.snapshots and (last_digest != digest):
+            if text is None:
+                text = view.substr(sublime.Region(0, view.size()))
+
+            if (last_text is None) or (written + 1 >= self.full_snapshot_every):
+                event['text'] = text
+                written = 0
+            else:
+                event['edit'] = changed_part(last_text, text)
+                written += 1
+            self._snapshots[buffer_id] = digest, text, written
+
+        self._write(event)
+        self.events += 1
+
+    def close(self):
+        self._file.close()
+
+    def _write(self, entry):
+        # Flushed right away, the interesting sessions tend to end abruptly.
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._file.flush()
+
+
+def changed_part(old_text, new_text):
+    """Returns [begin, end, text]: the part of the old text from begin to end
+    replaced by the text gives the new text.
+    """
+    prefix = common_prefix_length(old_text, new_text)
+    suffix = common_suffix_length(old_text, new_text,
+        min(len(old_text), len(new_text)) - prefix)
+    return [prefix, len(old_text) - suffix, new_text[prefix:len(new_text) - suffix]]
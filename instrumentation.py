@@ -0,0 +1,230 @@
+import json
+
+from collections import deque
+from time import time
+
+#
+# Histograms
+#
+
+class Histogram:
+    """A rolling histogram of recent samples.
+
+    Only the last `size` samples are kept, so the statistics follow the
+    current behavior of the plugin rather than its whole history.
+
+    Fields:
+        samples - a deque of the most recent samples
+    """
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+
+    def add(self, value):
+        """Adds a sample to the histogram, evicting the oldest one if full."""
+        self.samples.append(value)
+
+    def summary(self):
+        """Summarizes the samples into a JSON-serializable dictionary.
+
+        Besides the usual statistics, the samples are counted in buckets
+        with power-of-two upper bounds, which suits both the times (in
+        milliseconds) and the item counts that are recorded.
+        """
+        if not self.samples:
+            return {'count': 0}
+
+        ordered = sorted(self.samples)
+
+        def percentile(p):
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+        buckets = {}
+        for value in ordered:
+            bound = 1
+            while bound < value:
+                bound *= 2
+            buckets[bound] = buckets.get(bound, 0) + 1
+
+        return {
+            'count': len(ordered),
+            'min': ordered[0],
+            'max': ordered[-1],
+            'mean': sum(ordered) / float(len(ordered)),
+            'p50': percentile(0.50),
+            'p90': percentile(0.90),
+            'p99': percentile(0.99),
+            'buckets': sorted(buckets.items()),
+        }
+
+#
+# Probes
+#
+
+class EventProbe:
+    """Measures the stages of the pipeline for a single event.
+
+    Stages may nest: a lazy stage pulls the items through the stages before
+    it, and a stage may be invoked several times per event. The time of a
+    stage is its self time, with the time of the nested stages subtracted.
+
+    Fields:
+        times - a dictionary of total self times of the stages, in seconds
+
+        counts - a dictionary of item counts produced by the stages
+
+        api_calls - a dictionary of counts of the Sublime API calls
+    """
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self.api_calls = {}
+        self._nested_times = []
+
+    def _measure(self, stage, function):
+        self._nested_times.append(0.0)
+        started = time()
+        try:
+            return function()
+        finally:
+            elapsed = time() - started
+            nested = self._nested_times.pop()
+            if self._nested_times:
+                self._nested_times[-1] += elapsed
+
+            self.times[stage] = self.times.get(stage, 0.0) + elapsed - nested
+
+    def _count(self, stage, amount):
+        self.counts[stage] = self.counts.get(stage, 0) + amount
+
+    def call(self, stage, function, *args):
+        """Calls the function as a stage, counting the items it returns."""
+        result = self._measure(stage, lambda: function(*args))
+        self._count(stage, len(result) if hasattr(result, '__len__') else 1)
+        return result
+
+    def iterate(self, stage, iterable):
+        """Iterates over a lazy stage, counting the items it yields."""
+        iterator = self._measure(stage, lambda: iter(iterable))
+        self._count(stage, 0)
+        while True:
+            try:
+                item = self._measure(stage, lambda: next(iterator))
+            except StopIteration:
+                return
+            self._count(stage, 1)
+            yield item
+
+    def wrap_view(self, view):
+        """Wraps the view to count the calls of its API."""
+        return CountingView(view, self.api_calls)
+
+
+class NullProbe:
+    """A probe that measures nothing, used when instrumentation is off."""
+
+    def call(self, stage, function, *args):
+        return function(*args)
+
+    def iterate(self, stage, iterable):
+        return iterable
+
+    def wrap_view(self, view):
+        return view
+
+
+class CountingView:
+    """A proxy of sublime.View which counts the calls of the API used by
+    the pipeline. All other attributes are passed through to the view.
+    """
+    def __init__(self, view, calls):
+        self._view = view
+        self._calls = calls
+
+    def _count(self, name):
+        self._calls[name] = self._calls.get(name, 0) + 1
+
+    def __getattr__(self, name):
+        return getattr(self._view, name)
+
+    def scope_name(self, point):
+        self._count('scope_name')
+        return self._view.scope_name(point)
+
+    def substr(self, region):
+        self._count('substr')
+        return self._view.substr(region)
+
+    def line(self, point):
+        self._count('line')
+        return self._view.line(point)
+
+    def add_regions(self, *args):
+        self._count('add_regions')
+        return self._view.add_regions(*args)
+
+#
+# Statistics
+#
+
+class Instrumentation:
+    """Aggregates the measurements of the events into rolling histograms.
+
+    Fields:
+        enabled - whether the events should be measured at all
+
+        histograms - a dictionary of Histograms keyed by measurement names,
+                     which are 'time.<stage>', 'count.<stage>', 'api.<call>'
+
+        counters - a dictionary of the numbers of the occurrences of things
+                   that happen outside of the events or only sometimes, they
+                   are counted even if the instrumentation is disabled
+    """
+    def __init__(self, enabled=False, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self.histograms = {}
+        self.counters = {}
+
+    def probe(self):
+        """Returns a new probe for an event, a null one if disabled."""
+        return EventProbe() if self.enabled else NullProbe()
+
+    def _add(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(self.window)
+        histogram.add(value)
+
+    def record(self, probe, elapsed):
+        """Records the measurements of an event that took `elapsed` seconds."""
+        if not isinstance(probe, EventProbe):
+            return
+
+        self._add('time.total', elapsed * 1000.0)
+
+        for stage, seconds in probe.times.items():
+            self._add('time.' + stage, seconds * 1000.0)
+
+        for stage, amount in probe.counts.items():
+            self._add('count.' + stage, amount)
+
+        for call, amount in probe.api_calls.items():
+            self._add('api.' + call, amount)
+
+    def count(self, name, amount=1):
+        """Adds the amount to the counter of the name."""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self):
+        """Forgets all the recorded measurements."""
+        self.histograms = {}
+        self.counters = {}
+
+    def as_json(self):
+        """Dumps the summaries of the histograms and the counters as a JSON
+        string, the counters are under the 'counters' key.
+        """
+        summaries = dict((name, histogram.summary())
+                         for name, histogram in self.histograms.items())
+        summaries['counters'] = self.counters
+        return json.dumps(summaries, indent=2, sort_keys=True)
@@ -0,0 +1,72 @@
+from time import time
+
+#
+# Deadlines
+#
+
+class OverBudget(Exception):
+    """Raised when an event has run out of its latency budget."""
+
+
+class Deadline:
+    """The point in time when an event runs out of its latency budget.
+
+    Args:
+        budget - the time the event may take, in milliseconds
+    """
+    def __init__(self, budget):
+        self.end = time() + budget / 1000.0
+
+    def check(self):
+        """Raises OverBudget if the deadline has passed."""
+        if time() >= self.end:
+            raise OverBudget()
+
+
+class NoDeadline:
+    """A deadline which never passes."""
+
+    def check(self):
+        pass
+
+#
+# Degradation
+#
+
+class Degradation:
+    """The degradation level of a view.
+
+    Events start one level higher after running out of their budget, and
+    one level lower after `relax_after` fast events in a row.
+
+    Fields:
+        level - the current level, from 0 (full highlighting) to `levels`
+
+        levels - the highest level
+
+        relax_after - how many fast events in a row relax the level
+    """
+    def __init__(self, levels, relax_after):
+        self.level = 0
+        self.levels = levels
+        self.relax_after = relax_after
+
+        self._fast_events = 0
+
+    def over_budget(self):
+        """Counts an event which has run out of its budget."""
+        self.level = min(self.level + 1, self.levels)
+        self._fast_events = 0
+
+    def within_budget(self, fast):
+        """Counts an event which has fit into its budget, and whether it has
+        been fast enough to relax the level.
+        """
+        if not fast:
+            self._fast_events = 0
+            return
+
+        self._fast_events += 1
+        if self._fast_events >= self.relax_after:
+            self.level = max(self.level - 1, 0)
+            self._fast_events = 0
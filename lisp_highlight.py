@@ -1,109 +1,1421 @@
 import sublime
 import sublime_plugin
+import threading
 
-from bracket_scopes \
-    import cursors_of_view, expand_cursors_to_regions, merge_adjacent_regions, \
-           index_brackets, locate_brackets, merge_bracket_indices, \
-           compute_bracket_scopes, current_lines_of_view
+from itertools import chain
+from time import time
 
-from bracket_coloring import * # fix
-from lisp_highlight_configuration import * # fix too
-from types import * # and this
-from scope_colors import * # and this as well
+# Sublime Text 3 loads the plugin as a package, whose modules are imported
+# relatively. Our 'types' would not shadow the standard one otherwise.
+if __package__:
+    from .bracket_scopes \
+        import cursors_of_view, expand_cursors_to_regions, merge_adjacent_regions, \
+               index_brackets, compute_bracket_scopes, current_lines_of_view, \
+               iter_expanded_regions, iter_merged_regions, iter_brackets, \
+               complete_brackets
+
+    from .bracket_balance import BracketBalance
+    from .scan_cache import ScanCache
+    from .balance_cache import BalanceCache, default_cache_directory
+    from .bracket_rainbow import color_brackets_by_depth, rainbow_palette
+    from .bracket_structure \
+        import depth_at, bracket_at, matching_bracket, enclosing_scopes, \
+               next_sibling, previous_sibling
+
+    from .bracket_coloring import * # fix
+    from .lisp_highlight_configuration import * # fix too
+    from .types import * # and this
+    from .scope_colors import * # and this as well
+
+    from .instrumentation import Instrumentation, NullProbe
+    from .speculation import Speculator
+    from .work_queue import WorkQueue, Priority, priority_of
+    from .latency_budget import Deadline, NoDeadline, OverBudget, Degradation
+    from .event_trace import TraceRecorder, default_trace_path
+    from .slow_events import SlowEventWatchdog, ScratchView, default_capture_directory
+    from .region_canvas import RegionCanvas
+    from .region_pool import RegionPool
+    from .utils import imap
+else:
+    from bracket_scopes \
+        import cursors_of_view, expand_cursors_to_regions, merge_adjacent_regions, \
+               index_brackets, compute_bracket_scopes, current_lines_of_view, \
+               iter_expanded_regions, iter_merged_regions, iter_brackets, \
+               complete_brackets
+
+    from bracket_balance import BracketBalance
+    from scan_cache import ScanCache
+    from balance_cache import BalanceCache, default_cache_directory
+    from bracket_rainbow import color_brackets_by_depth, rainbow_palette
+    from bracket_structure \
+        import depth_at, bracket_at, matching_bracket, enclosing_scopes, \
+               next_sibling, previous_sibling
+
+    from bracket_coloring import * # fix
+    from lisp_highlight_configuration import * # fix too
+    from types import * # and this
+    from scope_colors import * # and this as well
+
+    from instrumentation import Instrumentation, NullProbe
+    from speculation import Speculator
+    from work_queue import WorkQueue, Priority, priority_of
+    from latency_budget import Deadline, NoDeadline, OverBudget, Degradation
+    from event_trace import TraceRecorder, default_trace_path
+    from slow_events import SlowEventWatchdog, ScratchView, default_capture_directory
+    from region_canvas import RegionCanvas
+    from region_pool import RegionPool
+    from utils import imap
+
+# Sublime Text 3 and later run the plugin under Python 3 and deliver the events
+# to ViewEventListeners on a worker thread as well. There the whole pipeline
+# runs on the worker thread, the background work included, and only the changes
+# of the regions are passed to the main thread (see region_canvas.py). Sublime
+# Text 2 runs everything on the main thread.
+async_events = hasattr(sublime_plugin, 'ViewEventListener')
+
+# Sublime Text 4 tells the plugins what the edits of the buffers are.
+exact_edits = hasattr(sublime_plugin, 'TextChangeListener')
+
+# Held by everything that touches the balances and the other state of the
+# views. The commands and the closing of the views queue their work onto the
+# thread of the pipeline (see with_balance) instead of waiting for it on the
+# main thread.
+pipeline_lock = threading.RLock()
+
+
+def set_timeout_background(callback, delay):
+    """Runs the callback after the delay in milliseconds, holding the
+    pipeline_lock, on the thread the pipeline runs on.
+    """
+    def run():
+        with pipeline_lock:
+            callback()
+
+    if async_events:
+        sublime.set_timeout_async(run, delay)
+    else:
+        sublime.set_timeout(run, delay)
 
 scan_limit = 100
 
+# Brackets matched in all the views.
 supported_brackets = [('(', ')'), ('[', ']'), ('{', '}'),]
 
+# More brackets of the dialects, matched along with the supported ones in the
+# views of their syntaxes, keyed by the base scopes of the syntaxes. Brackets
+# may be prefixes of each other, the longest one is matched.
+dialect_brackets = {
+    'source.clojure': [('#(', ')'), ('#{', '}'), ('#?(', ')')],
+    'source.racket':  [('#hash(', ')')],
+    'text.html.ruby': [('<%', '%>')], # templates
+}
+
+# All the brackets any view may have.
+all_brackets = supported_brackets + \
+    [pair for scope in sorted(dialect_brackets) for pair in dialect_brackets[scope]]
+
+longest_bracket = max(len(kind) for pair in all_brackets for kind in pair)
+
+# Brackets in the scopes which have any of these in their names are skipped.
+excluded_scopes = ['comment', 'string']
+
+# Brackets located in the examined regions and in the lines of the bracket
+# balances, keyed by their text and the scopes they begin in, so that undo,
+# redo and edits elsewhere in the buffer do not make the same text scanned
+# again. The cache takes about 4 MB at most. Set to None to turn it off.
+scan_cache = ScanCache(all_brackets, 4 * 1024 * 1024)
+
+# How many expressions enclosing every examined region are looked up beyond
+# it in the bracket balance of the view, e.g. 32. The regions are then also
+# widened over the expressions they cut. With many cursors this takes about
+# as long as the rest of the event, so zero turns the lookups off and is the
+# default. The events make no lookups while the balance of a large buffer is
+# being built in the background, for at most `balance_build_slice`
+# milliseconds at a time.
+enclosing_limit = 0
+balance_build_slice = 10
+
+# Where the edits of the buffers are not passed to the plugin (before Sublime
+# Text 4), they are guessed from where the selections were before the edits.
+# Edits which span more than this many characters are not guessed, the lines
+# of the balance are compared with the whole text instead. The guesses are
+# checked against the whole text after `edit_check_delay` milliseconds
+# without edits.
+guessed_edit_limit = 64 * 1024
+edit_check_delay = 1000
+
+# Files at least this large may keep their bracket balance on disk between
+# the sessions, so that it is not built from scratch when they are opened
+# again, e.g. BalanceCache(default_cache_directory(), 64 * 1024 * 1024) keeps
+# at most 64 MB of the balances in the user cache directory. The balances are
+# kept for the texts, brackets, excluded scopes and syntaxes they have been
+# built for. The cache writes out a file for every large file opened, so it
+# is off by default.
+warm_start_size = 256 * 1024
+balance_cache = None
+
+# Pass the items lazily from scanning to rendering instead of building
+# complete lists at every stage of the pipeline. The brackets of every
+# examined region are still gathered whole, so this bounds the memory by
+# the largest examined region rather than by the nesting depth.
+streaming_pipeline = False
+
+# Color the examined regions of the events with thousands of cursors in a pool
+# of processes, e.g. RegionPool(processes=4, min_cursors=500). The processes
+# are forked from the editor, so this is off by default. Smaller events, and
+# the streaming pipeline, stay in-process.
+region_pool = None
+
+# Measure the stages of the pipeline and the Sublime API calls they make.
+# Toggled with lisp_highlight_toggle_instrumentation command.
+instrumentation = Instrumentation(enabled=False)
+
+# Background work of all the views: speculation, completion of degraded
+# events, and highlighting of the views out of focus. At most `limit` tasks
+# run at once, the ones for the active view first, then the ones for the
+# other visible views, then the ones for the hidden views.
+work_queue = WorkQueue(limit=2, set_timeout=set_timeout_background)
+
+# Locate the brackets around the caret ahead of time while the editor is idle,
+# e.g. Speculator(delay=300, budget=50, slice=5, radius=100, queue=work_queue,
+# set_timeout=set_timeout_background): after 300 ms without events, for at
+# most 50 ms in slices of 5 ms, in the top-level expression and 100 lines
+# around it, in the balance of the view. Only the events which look up the
+# enclosing expressions read the brackets from the balance, the others take
+# them from the scan_cache, so this is a part of the enclosing mode and is
+# off along with `enclosing_limit` by default.
+speculator = None
+
+# The time a selection event may take after bringing the bracket balance up
+# to date, in milliseconds, before it is cut short and degraded (see
+# degraded_config), None turns the budget off. The events of a view start
+# one degradation level higher after running out of the budget, and one
+# level lower after `degradation_relax_after` events in a row that have
+# taken less than half of the budget.
+latency_budget = 30
+degradation_levels = 3
+degradation_relax_after = 10
+
+# Degradations of the views, keyed by view ids.
+degradations = {}
+
+# Record the selection events into this file, to replay them headlessly with
+# benchmarks/replay.py, None turns the recording off. The texts of the views
+# are recorded along when they change, unless `trace_snapshots` is False.
+# Toggled with lisp_highlight_toggle_trace command, which records into
+# a fresh file in the temporary directory unless the path is set here.
+trace_path = None
+trace_snapshots = True
+
+# The TraceRecorder of the trace_path, opened with the first event.
+trace_recorder = None
+
+# Keep the evidence of slow selection events, e.g. with
+# SlowEventWatchdog(default_capture_directory(), threshold=200, keep=20,
+# cooldown=60, sample=0.0): the events which take at least 200 ms are run
+# again in the background under cProfile, and the profile is written along
+# with the cursors, the scanned text and the configuration into a directory
+# in the user cache directory. At most one event a minute is captured, and
+# the last 20 captures are kept. Set `sample` to also capture a fraction of
+# the other events. The captures hold the text of the files, so this is off
+# by default.
+slow_event_watchdog = None
+
+config = Configuration({
+    'primary_mode': ColorMode.EXPRESSION,
+    'secondary_mode': ColorMode.EXPRESSION,
+    'offside_mode': ColorMode.BRACKETS,
+    'offside_limit': 2,
+    'adjacent_mode': ColorMode.EXPRESSION,
+    'adjacent_side': AdjacentMode.BOTH,
+    'invalid_mode': ColorMode.NONE,
+    'inconsistent_mode': ColorMode.NONE,
+    'rainbow_mode': ColorMode.NONE,
+
+    'background_color': (None, 0x123456),
+    'current_line_color': (None, 0x789ABC),
+
+    'primary_color': (0x110000, None),
+    'secondary_colors': [(0x220000, None), (0x330000, None)],
+    'offside_colors': [(0x440000, 0x004400), (0x550000, 0x005500), (0x660000, 0x006600)],
+    'adjacent_color': (0x770000, 0x007700),
+    'inconsistent_color': (0x880000, 0x008800),
+    'rainbow_colors': [(0x990000, None), (0xAA0000, None), (0xBB0000, None),
+                       (0xCC0000, None), (0xDD0000, None)]
+})
+
+
+def no_strings_and_comments(scope):
+    for excluded in excluded_scopes:
+        if excluded in scope:
+            return False
+    return True
+
+def brackets_of(view):
+    """Returns the brackets of the view: the supported ones, and the ones of
+    the dialect of its syntax.
+    """
+    base_scope = view.scope_name(0).split(' ', 1)[0]
+    return supported_brackets + dialect_brackets.get(base_scope, [])
+
+def locate_region_brackets(view, region, deadline=NoDeadline()):
+    """Locates the brackets of the examined region, through the scan_cache."""
+    def scan():
+        return iter_brackets(view, region, brackets_of(view), no_strings_and_comments,
+                             deadline)
+
+    if scan_cache is None:
+        return list(scan())
+
+    # Brackets at the end of the region may extend past it, and the scopes
+    # around its beginning tell whether it begins in a string or comment.
+    text = view.substr(sublime.Region(region.begin, region.end + longest_bracket - 1))
+    start_scope = view.scope_name(region.begin)
+    if region.begin > 0:
+        start_scope = view.scope_name(region.begin - 1) + '|' + start_scope
+    return scan_cache.brackets(text, start_scope, region.begin, scan,
+                               region.end - region.begin)
+
+# BracketBalances of the buffers, keyed by buffer ids. Clones of a view show
+# the same buffer and share everything derived from its text, only the state
+# that depends on the cursors or the viewport is kept per view.
+balances = {}
+
+# Ids of the open views of the buffers that have balances, keyed by buffer ids.
+buffer_views = {}
+
+def balance_of(view, complete=False):
+    """Returns the up-to-date BracketBalance of the buffer of the view.
+
+    The balance of a small buffer is built right away. The one of a large
+    buffer is built in the background (see build_balance), or restored from
+    the balance_cache, and None is returned until then, unless `complete`
+    tells to build the rest of it right away.
+
+    The balances are shared with the pipeline, so this must be called
+    holding the pipeline_lock, on the thread the pipeline runs on. Commands
+    and other plugins should use with_balance instead.
+    """
+    buffer_views.setdefault(view.buffer_id(), set([])).add(view.id())
+
+    # A balance is made again when the syntax of the view brings other brackets.
+    brackets = brackets_of(view)
+    balance = balances.get(view.buffer_id())
+    if (balance is None) or (balance.supported_brackets != brackets):
+        balance = balances[view.buffer_id()] = \
+            BracketBalance(brackets, no_strings_and_comments, scan_cache)
+        remember_selection(view)
+        if not warm_start_allowed(view):
+            advance_balance(view, balance, balance_build_slice)
+
+    if not (balance.complete or complete):
+        return None
+    advance_balance(view, balance)
+    return balance
+
+
+def advance_balance(view, balance, budget=None):
+    """Brings the balance up to date and builds more of it, for at most the
+    budget in milliseconds. A balance which has not been built at all is
+    restored from the cache instead, if it is there.
+
+    Returns:
+        True if the balance is complete
+    """
+    if balance.complete:
+        return balance.build(view)
+
+    if (balance.built == 0) and restore_balance(view, balance):
+        return True
+
+    if not balance.build(view, budget):
+        return False
+    save_balance(view, balance)
+    return True
+
+
+def build_balance(view):
+    """Builds the balance of the buffer of the view in the background, a
+    slice at a time, and highlights the view again once it is complete.
+    """
+    balance = balances.get(view.buffer_id())
+
+    def build():
+        if balances.get(view.buffer_id()) is not balance:
+            return
+        if advance_balance(view, balance, balance_build_slice):
+            highlight_view(view)
+        else:
+            work_queue.submit(view, 'balance', build, instrumentation)
+
+    work_queue.submit(view, 'balance', build, instrumentation)
+
+# The selections the buffers have had after their last selection events and
+# edits, for guessing the next edits, keyed by buffer ids. The values are
+# (change count, size, regions) tuples, where the regions are the (begin, end)
+# pairs of the selection.
+last_selections = {}
+
+
+def remember_selection(view):
+    if exact_edits or (view.buffer_id() not in balances):
+        return
+
+    last_selections[view.buffer_id()] = view.change_count(), view.size(), \
+        [(region.begin(), region.end()) for region in view.sel()]
+
+
+def guess_edit(view):
+    """Records the edit which has just been made in the view into the
+    balance, guessed from where the selection was before it and where it is
+    now: the text is supposed to have changed from the first selection region
+    to the last one, which covers typing, deleting and pasting at any number
+    of cursors. The guess is extended to whole lines, and the parts of the
+    lines outside of the selections are checked to be the same as before.
+    """
+    before = last_selections.get(view.buffer_id())
+    remember_selection(view)
+
+    balance = balances.get(view.buffer_id())
+    if (before is None) or (balance is None):
+        return
+    change_count, size, regions = before
+    if (view.change_count() != change_count + 1) or not regions or (len(view.sel()) == 0):
+        return
+
+    delta = view.size() - size
+    selection = view.sel()
+    begin = min(regions[0][0], selection[0].begin())
+    end = max(regions[-1][1], selection[len(selection) - 1].end() - delta)
+    new_end = end + delta
+    if (begin > end) or (begin > new_end) or (end > size) or \
+       (new_end - begin > guessed_edit_limit):
+        return
+
+    line_begin = view.line(begin).begin()
+    line_end = view.line(new_end).end()
+    balance.record_edit(line_begin, line_end - delta,
+        view.substr(sublime.Region(line_begin, line_end)), view.change_count(),
+        (begin - line_begin, line_end - new_end))
+
+    def check():
+        if (balances.get(view.buffer_id()) is balance) and balance.complete and \
+           (view.change_count() == change_count + 1):
+            if not balance.verify(view):
+                instrumentation.count('balance.guessed_wrong')
+
+    set_timeout_background(check, edit_check_delay)
+
+
+def warm_start_allowed(view):
+    return (balance_cache is not None) and (view.file_name() is not None) and \
+           (view.size() >= warm_start_size)
+
+
+def balance_context(view):
+    """Returns what the brackets of the view are located with, to tell apart
+    the cached balances which no longer apply to the view.
+    """
+    return repr((brackets_of(view), excluded_scopes, view.settings().get('syntax')))
+
+
+def restore_balance(view, balance):
+    """Restores the balance of the view from the cache, if it is there.
+
+    Returns:
+        True if the balance has been restored, False if it is to be built
+    """
+    if not warm_start_allowed(view):
+        return False
+
+    text = view.substr(sublime.Region(0, view.size()))
+    state = balance_cache.load(view.file_name(), text, balance_context(view))
+    if state is None:
+        return False
+
+    balance.restore(view, text, state)
+    return True
+
+
+def save_balance(view, balance):
+    """Puts the up-to-date balance of the view into the cache."""
+    if not warm_start_allowed(view):
+        return
+
+    text = view.substr(sublime.Region(0, view.size()))
+    balance_cache.store(view.file_name(), text, balance.state(), balance_context(view))
+
+# What was colored by depth last time in the views, keyed by view ids.
+# The values are ((change count, visible region), colored lines) pairs, see
+# color_brackets_by_depth for the lines.
+rainbows = {}
+
+# Scrolling makes no selection events, so the visible regions of the views
+# are polled every `rainbow_poll_interval` milliseconds while the rainbow
+# mode is on. The polls which find neither the text nor the viewport changed
+# color nothing. Ids of the polled views.
+rainbow_poll_interval = 100
+rainbow_polls = set([])
+
+
+def highlight_examined_region(view, region, cursors, config, probe=NullProbe(),
+                              balance=None, deadline=NoDeadline()):
+    """Computes colored regions for one examined region of the view.
+
+    Args:
+        view - the sublime.View to highlight
+
+        region - the examined region to scan
+
+        [cursors] - a sorted list of cursors inside the region
+
+        config - the Configuration to use
+
+        probe - the probe to measure the stages with
+
+        balance - the BracketBalance of the view to take the brackets of
+                  the region from and to look up the enclosing brackets
+                  beyond the region with, or None
+
+        deadline - the Deadline to check between the stages and while
+                   locating the brackets
+
+    Returns:
+        {color: [Region]} - regions to be colored, grouped by their color
+    """
+    brackets, lines = gather_examined_region(view, region, cursors, probe, balance,
+                                             deadline)
+    return color_examined_region(brackets, cursors, lines, config, brackets_of(view), probe,
+                                 deadline)
+
+
+def gather_examined_region(view, region, cursors, probe=NullProbe(), balance=None,
+                           deadline=NoDeadline()):
+    """Takes from the view everything needed to color the examined region.
+
+    Args:
+        see highlight_examined_region
+
+    Returns:
+        ([bracket], [Region]) - the brackets of the region along with the far
+                                ones, and the current lines of the cursors
+    """
+    if balance is not None:
+        brackets = probe.call('locate', list, balance.iter_brackets(region, deadline))
+    else:
+        brackets = probe.call('locate', locate_region_brackets, view, region, deadline)
+
+    if balance is not None:
+        brackets = probe.call('enclosing', complete_brackets,
+            brackets, region, balance, enclosing_limit)
+    deadline.check()
+
+    lines = current_lines_of_view(view, cursors)
+
+    return brackets, lines
+
+
+def color_examined_region(brackets, cursors, lines, config, supported_brackets,
+                          probe=NullProbe(), deadline=NoDeadline()):
+    """Colors one examined region, without looking at the view.
+
+    Args:
+        [brackets] - the brackets of the region, as gather_examined_region
+                     returns them
+
+        [cursors] - a sorted list of cursors inside the region
+
+        [lines] - the current lines of the cursors
+
+        config - the Configuration to use
+
+        [supported_brackets]
+            - a list of (left, right) pairs of strings that denote
+              the valid kinds of brackets, see brackets_of
+
+        probe - the probe to measure the stages with
+
+        deadline - the Deadline to check between the stages
+
+    Returns:
+        {color: [Region]} - regions to be colored, grouped by their color
+    """
+    positions = PositionIndex(cursors, brackets)
+
+    indices = probe.call('index', index_brackets, brackets, cursors, config, positions)
+    deadline.check()
+
+    indexed_bracket_scopes = probe.call('scopes', compute_bracket_scopes,
+        brackets, indices, config)
+    deadline.check()
+
+    rgc = probe.call('color', color_scopes,
+        indexed_bracket_scopes, config, cursors, supported_brackets, positions)
+    deadline.check()
+
+    dj = probe.call('split', split_into_disjoint, rgc, lines)
+    deadline.check()
+
+    fu = probe.call('background', prepend_background, dj, lines)
+
+    colored_regions = {}
+    for region in fu:
+        color = compute_span_color(region, config)
+
+        regions = colored_regions.get(color, [])
+        regions.append(region.extent)
+
+        colored_regions[color] = regions
+
+    return colored_regions
+
+
+def highlight_in_pool(view, examined_regions, config, probe=NullProbe(), balance=None,
+                      deadline=NoDeadline()):
+    """Colors the examined regions of the view in the region_pool.
+
+    The brackets and the lines of the regions are gathered in-process, the
+    coloring is done by the processes, which the deadline does not reach.
+
+    Args:
+        view - the sublime.View to highlight
+
+        [(region, [cursors])] - the examined regions with their cursors
+
+        config - the Configuration to use
+
+        probe - the probe to measure the stages with
+
+        balance - the BracketBalance of the view, or None
+
+        deadline - the Deadline to check while gathering the regions
+
+    Returns:
+        [sublime.Region] - the regions to be colored, in the order of the
+                           examined regions
+    """
+    batch = []
+    for region, region_cursors in examined_regions:
+        brackets, lines = gather_examined_region(view, region, region_cursors, probe,
+                                                 balance, deadline)
+        batch.append((region_cursors,
+                      [(bracket.point, bracket.kind, bracket.is_left()) for bracket in brackets],
+                      [(line.begin, line.end) for line in lines]))
+    deadline.check()
+
+    altogether = []
+    for colored_regions in region_pool.map(color_region_batch,
+                                           (config.as_settings(), brackets_of(view)), batch):
+        for color, regions in colored_regions:
+            altogether.extend(sublime.Region(begin, end) for begin, end in regions)
+    return altogether
+
+
+def color_region_batch(common, batch):
+    """Colors a batch of examined regions in a process of the region_pool.
+
+    Args:
+        (settings, [supported_brackets]) common
+            - the Configuration to use, as its as_settings gives it, and
+              the brackets of the view
+
+        [(cursors, brackets, lines)] batch
+            - the examined regions, with the brackets as (point, kind,
+              is_left) tuples and the lines as (begin, end) tuples
+
+    Returns:
+        [[(color, [(begin, end)])]] - the colored regions of every examined
+                                      region, in order
+    """
+    settings, supported_brackets = common
+    config = configuration_from_settings(settings)
+
+    results = []
+    for cursors, brackets, lines in batch:
+        brackets = [LeftBracket(point, kind) if is_left else RightBracket(point, kind)
+                    for point, kind, is_left in brackets]
+        lines = [Region(begin, end) for begin, end in lines]
+
+        colored_regions = color_examined_region(brackets, cursors, lines, config,
+                                                supported_brackets)
+        results.append([(color, [(region.begin, region.end) for region in regions])
+                        for color, regions in colored_regions.items()])
+    return results
+
+
+def highlight_lazily(view, cursors, config, probe=NullProbe(), balance=None,
+                     radius=None, deadline=NoDeadline()):
+    """Computes colored regions for the whole view in streaming fashion.
+
+    Every stage passes its items to the next one as soon as they are ready.
+    Brackets are still gathered per examined region, as indexing them needs
+    to look at both sides of the cursors, but the colorable spans are never
+    collected into lists and are converted into sublime.Regions right away.
+
+    Args:
+        view - the sublime.View to highlight
+
+        [cursors] - a sorted list of cursors of the view
+
+        config - the Configuration to use
+
+        probe - the probe to measure the stages with
+
+        balance - the BracketBalance of the view, or None
+
+        radius - the radius of the examined regions, or None for `scan_limit`
+
+        deadline - the Deadline to check between the examined regions and
+                   while locating the brackets
+
+    Returns:
+        {color: [sublime.Region]} - regions to be colored, grouped by color
+    """
+    if radius is None:
+        radius = scan_limit
+
+    expanded_regions = probe.iterate('expansion',
+        iter_expanded_regions(cursors, radius, view, balance))
+    examined_regions = probe.iterate('merge',
+        iter_merged_regions(expanded_regions, cursors))
+
+    def disjoint_spans_of(examined_region):
+        region, cursors = examined_region
+        return iter_region_spans(view, region, cursors, config, probe, balance, deadline)
+
+    colored_regions = {}
+    for span in chain.from_iterable(imap(disjoint_spans_of, examined_regions)):
+        color = compute_span_color(span, config)
+        colored_regions.setdefault(color, []).append(span.extent.as_sublime_region())
+
+    return colored_regions
+
+
+def iter_region_spans(view, region, cursors, config, probe=NullProbe(), balance=None,
+                      deadline=NoDeadline()):
+    """Lazily computes the colorable spans of a single examined region.
+
+    This is the streaming counterpart of highlight_examined_region, used by
+    highlight_lazily for every examined region.
+
+    Args:
+        view - the sublime.View to highlight
+
+        region - the Region to examine
+
+        [cursors] - a sorted list of cursors inside the region
+
+        config - the Configuration to use
+
+        probe - the probe to measure the stages with
+
+        balance - the BracketBalance of the view, or None
+
+        deadline - the Deadline to check while locating the brackets
+
+    Returns:
+        (spans) - an iterator over the disjoint colorable spans with their
+                  backgrounds, sorted
+    """
+    deadline.check()
+    if balance is not None:
+        brackets = list(probe.iterate('locate', balance.iter_brackets(region, deadline)))
+    else:
+        brackets = probe.call('locate', locate_region_brackets, view, region, deadline)
+
+    if balance is not None:
+        brackets = probe.call('enclosing', complete_brackets,
+            brackets, region, balance, enclosing_limit)
+
+    positions = PositionIndex(cursors, brackets)
+
+    indices = probe.call('index', index_brackets, brackets, cursors, config, positions)
+
+    scopes = probe.call('scopes', compute_bracket_scopes, brackets, indices, config)
+    lines = current_lines_of_view(view, cursors)
+
+    spans = probe.iterate('color',
+        iter_colored_scopes(scopes, config, cursors, brackets_of(view), positions))
+    spans = probe.iterate('split', iter_disjoint_spans(spans, lines))
+    return probe.iterate('background', iter_with_background(spans, lines))
+
+
+def render_rainbow(view, balance, config):
+    """Colors the visible brackets of the view by their depth.
+
+    Every color gets its own key of regions, so that the brackets can have
+    different colors. The keys of the colors which are not used anymore are
+    cleared. Nothing is done if neither the text nor the viewport have changed
+    since the last time, otherwise only the lines which have changed or come
+    into view are colored again.
+
+    Args:
+        view - the sublime.View to highlight
+
+        balance - the up-to-date BracketBalance of the view
+
+        config - the Configuration to use
+    """
+    visible = view.visible_region()
+    region = Region(visible.begin(), visible.end())
+
+    state = view.change_count(), (region.begin, region.end)
+    last_state, colored_lines = rainbows.get(view.id(), (None, {}))
+    if last_state == state:
+        return
+    rainbows[view.id()] = state, colored_lines
+
+    colored_regions = color_brackets_by_depth(balance, region, config,
+                                              balance.supported_brackets, enclosing_limit,
+                                              colored_lines)
+
+    for color in rainbow_palette(config):
+        key = 'rainbow.' + scope_name_for_color(*color)
+        regions = colored_regions.get(color)
+        if regions:
+            view.add_regions(key, [region.as_sublime_region() for region in regions],
+                             scope_name_for_color(*color))
+        else:
+            view.erase_regions(key)
+
+
+def poll_rainbow(view, canvas):
+    """Starts polling the visible region of the view for the rainbow, unless
+    it is polled already. The polling stops when the view is closed or the
+    rainbow mode is turned off, the hidden views are not colored meanwhile.
+
+    Args:
+        view - the sublime.View to poll
+
+        canvas - the view to render the regions on, see selection_modified
+    """
+    if view.id() in rainbow_polls:
+        return
+    rainbow_polls.add(view.id())
+
+    def poll():
+        if view.id() not in rainbow_polls:
+            return
+        if config.mode[RegionColor.RAINBOW] is ColorMode.NONE:
+            rainbow_polls.discard(view.id())
+            return
+
+        if priority_of(view) != Priority.HIDDEN:
+            balance = balance_of(view)
+            if balance is not None:
+                render_rainbow(canvas, balance, config)
+
+        set_timeout_background(poll, rainbow_poll_interval)
+
+    set_timeout_background(poll, rainbow_poll_interval)
+
+
+def degraded_config(config, level):
+    """Returns the configuration to highlight with at the degradation level.
+
+    Level 1 keeps the configuration (only the scan radius shrinks), level 2
+    colors only the brackets of secondary and offside scopes instead of
+    their whole expressions, and level 3 colors only the primary scope.
+    """
+    if level >= 3:
+        return config.with_modes({RegionColor.SECONDARY: ColorMode.NONE,
+                                  RegionColor.OFFSIDE: ColorMode.NONE,
+                                  RegionColor.ADJACENT: ColorMode.NONE,
+                                  RegionColor.INCONSISTENT: ColorMode.NONE})
+    if level >= 2:
+        modes = {}
+        for color in [RegionColor.SECONDARY, RegionColor.OFFSIDE]:
+            if config.mode[color] is ColorMode.EXPRESSION:
+                modes[color] = ColorMode.BRACKETS
+        return config.with_modes(modes)
+    return config
+
+
+def scan_radius(level):
+    """Returns the radius of the examined regions at the degradation level."""
+    return scan_limit if level == 0 else scan_limit // 4
+
+
+def render_highlights(view, cursors, level, probe=NullProbe(), balance=None,
+                      deadline=NoDeadline()):
+    """Highlights the brackets around the cursors at the degradation level.
+
+    Nothing is rendered if the deadline passes, OverBudget is raised then.
+
+    Args:
+        view - the sublime.View to highlight
+
+        [cursors] - a sorted list of cursors of the view
+
+        level - the degradation level, from 0 (none) to `degradation_levels`
+
+        probe - the probe to measure the stages with
+
+        balance - the BracketBalance of the view, or None
+
+        deadline - the Deadline of the event
+    """
+    level_config = degraded_config(config, level)
+    radius = scan_radius(level)
+
+    if streaming_pipeline:
+        colored_regions = highlight_lazily(view, cursors, level_config, probe, balance,
+                                           radius, deadline)
+
+        altogether = []
+        for color, regions in colored_regions.items():
+            altogether.extend(regions)
+
+    else:
+        expanded_regions = probe.call('expansion', expand_cursors_to_regions,
+            cursors, radius, view, balance)
+
+        examined_regions = probe.call('merge', merge_adjacent_regions,
+            expanded_regions, cursors)
+        deadline.check()
+
+        if (region_pool is not None) and region_pool.wants(examined_regions):
+            altogether = probe.call('pool', highlight_in_pool, view, examined_regions,
+                                    level_config, probe, balance, deadline)
+        else:
+            altogether = []
+            for region, region_cursors in examined_regions:
+
+                colored_regions = highlight_examined_region(view, region, region_cursors,
+                                                            level_config, probe, balance,
+                                                            deadline)
+
+                for color, regions in colored_regions.items():
+                    altogether.extend(region.as_sublime_region() for region in regions)
+
+    scope_name = scope_name_for_color(0xEE8888, 0x88EE88)
+
+    def render(regions):
+        view.erase_regions(scope_name)
+        view.add_regions(scope_name, regions, scope_name)
+        return regions
+
+    probe.call('render', render, altogether)
+
+
+def highlight_view(view, probe=None, started=None):
+    """Highlights the brackets around the cursors of the view.
+
+    This is the whole pipeline run on every selection event, from locating
+    the cursors to rendering the colored regions.
+
+    If the event runs out of its latency budget, the view is highlighted at
+    the last degradation level right away, and the next events of the view
+    start one level higher. The full highlighting is then completed in the
+    background unless another event of the view comes first.
+
+    Args:
+        view - the sublime.View to highlight
+
+        probe - the probe the event is measured with, a new one if None
+
+        started - when the event has started, as time() gives it, now if None
+    """
+    if started is None:
+        started = time()
+    if probe is None:
+        probe = instrumentation.probe()
+    unwrapped_view, view = view, probe.wrap_view(view)
+
+    degradation = None
+    if latency_budget is not None:
+        degradation = degradations.get(view.id())
+        if degradation is None:
+            degradation = degradations[view.id()] = \
+                Degradation(degradation_levels, degradation_relax_after)
+
+    if speculator is not None:
+        speculator.preempt()
+
+    if scan_cache is not None:
+        scan_hits, scan_misses = scan_cache.hits, scan_cache.misses
+
+    if work_queue.discard(view, 'completion'):
+        instrumentation.count('degradation.preempted')
+
+    if work_queue.discard(view, 'capture'):
+        instrumentation.count('watchdog.dropped')
+
+    cursors = probe.call('cursors', cursors_of_view, view)
+
+    rainbow = config.mode[RegionColor.RAINBOW] is not ColorMode.NONE
+
+    balance = None
+    if (enclosing_limit > 0) or rainbow:
+        balance = probe.call('balance', balance_of, view)
+        if balance is None:
+            build_balance(unwrapped_view)
+
+    if rainbow and (balance is not None):
+        probe.call('rainbow', render_rainbow, view, balance, config)
+
+    if enclosing_limit <= 0:
+        balance = None
+
+    speculate = (speculator is not None) and (balance is not None) and cursors
+    if speculate:
+        caret = cursors[0]
+        speculative_rows_used = balance.speculative_rows_used
+
+    # The budget starts after the balance is up to date: refreshing it cannot
+    # be cut short, and the degradation levels do not make it any faster.
+    deadline = NoDeadline()
+    budget_started = time()
+    if degradation is not None:
+        deadline = Deadline(latency_budget)
+
+    level = 0
+    if degradation is not None:
+        level = degradation.level
+
+    try:
+        if level == degradation_levels:
+            deadline = NoDeadline()
+        render_highlights(view, cursors, level, probe, balance, deadline)
+    except OverBudget:
+        instrumentation.count('degradation.over_budget')
+        degradation.over_budget()
+
+        level = degradation_levels
+        render_highlights(view, cursors, level, probe, balance)
+    else:
+        if degradation is not None:
+            degradation.within_budget((time() - budget_started) * 1000.0 < latency_budget / 2.0)
+
+    if level > 0:
+        instrumentation.count('degradation.level.%d' % level)
+
+        def complete():
+            instrumentation.count('degradation.completed')
+            render_highlights(unwrapped_view, cursors, 0, NullProbe(), balance)
+
+        work_queue.submit(unwrapped_view, 'completion', complete, instrumentation)
+
+    if speculate:
+        speculator.record(balance, speculative_rows_used, instrumentation)
+        speculator.schedule(unwrapped_view, balance, caret, instrumentation)
+
+    if scan_cache is not None:
+        instrumentation.count('scan_cache.hits', scan_cache.hits - scan_hits)
+        instrumentation.count('scan_cache.misses', scan_cache.misses - scan_misses)
+
+    elapsed = time() - started
+    instrumentation.record(probe, elapsed)
+
+    if (slow_event_watchdog is not None) and cursors:
+        reason = slow_event_watchdog.wants(elapsed * 1000.0)
+        if reason is not None:
+            instrumentation.count('watchdog.' + reason)
+            capture_event(unwrapped_view, cursors, level, balance, elapsed * 1000.0, reason)
+
+
+def capture_event(view, cursors, level, balance, elapsed, reason):
+    """Queues the event to be run again for the slow_event_watchdog to
+    capture it. The capture is dropped if the view changes or another event
+    of the view comes before it runs. The event is run again on a ScratchView,
+    the view keeps the highlights of its current cursors.
+
+    Args:
+        view - the sublime.View of the event
+
+        [cursors] - the cursors of the event
+
+        level - the degradation level the event has run at
+
+        balance - the BracketBalance the event has used, or None
+
+        elapsed - how long the event has taken, in milliseconds
+
+        reason - why the event is captured, see SlowEventWatchdog.wants
+    """
+    change_count = view.change_count()
+
+    def capture():
+        if (slow_event_watchdog is None) or (view.change_count() != change_count):
+            instrumentation.count('watchdog.dropped')
+            return
+
+        examined_regions = merge_adjacent_regions(
+            expand_cursors_to_regions(cursors, scan_radius(level), view, balance), cursors)
+        scratch_view = ScratchView(view)
+
+        path = slow_event_watchdog.capture(view, cursors,
+            [region for region, _ in examined_regions], degraded_config(config, level),
+            lambda: render_highlights(scratch_view, cursors, level, NullProbe(), balance),
+            {'reason': reason, 'elapsed_ms': elapsed, 'level': level,
+             'scan_limit': scan_limit, 'enclosing_limit': enclosing_limit,
+             'streaming': streaming_pipeline, 'brackets': brackets_of(view)})
+
+        if path is not None:
+            sublime.status_message("LispBracketHighlighter captured a %s event (%.0f ms) into %s" %
+                (reason, elapsed, path))
+
+    work_queue.submit(view, 'capture', capture, instrumentation)
+
+
+def record_event(view):
+    """Records the selection event of the view into the trace, if it is on."""
+    global trace_recorder
+    if trace_path is None:
+        return
+
+    if (trace_recorder is None) or (trace_recorder.path != trace_path):
+        if trace_recorder is not None:
+            trace_recorder.close()
+        trace_recorder = TraceRecorder(trace_path, trace_snapshots)
+
+    trace_recorder.record(view)
+
+
+# The colors put into the color schemes, keyed by the paths of their files.
+colored_schemes = {}
+
+
+def update_color_scheme(view):
+    """Puts the scopes of the colors into the color scheme of the view.
+
+    The file is written only when the scheme of the view or the colors have
+    changed since the last time, and on the main thread.
+    """
+    theme_filename = current_sublime_theme_file(view)
+
+    colors = [(0xEE8888, 0x88EE88)]
+    if config.mode[RegionColor.RAINBOW] is not ColorMode.NONE:
+        colors.extend(rainbow_palette(config))
+
+    if colored_schemes.get(theme_filename) == colors:
+        return
+    colored_schemes[theme_filename] = colors
+
+    def write():
+        # Sublime Text 3 keeps the bundled color schemes in zipped packages,
+        # these are not colored.
+        try:
+            add_or_replace_colored_scopes(
+                theme_filename,
+                format_sublime_color_scopes(colors)
+            )
+        except EnvironmentError:
+            pass
+
+    if async_events:
+        sublime.set_timeout(write, 0)
+    else:
+        write()
+
+
+def selection_modified(view, canvas):
+    """Handles the selection event of the view.
+
+    Args:
+        view - the sublime.View of the event
+
+        canvas - the view to render the regions on: the view itself, or its
+                 RegionCanvas off the main thread
+    """
+    started = time()
+    probe = instrumentation.probe()
+
+    probe.call('color_scheme', update_color_scheme, view)
+
+    probe.call('trace', record_event, view)
+
+    # Selections of the views out of focus change too, when they show
+    # the buffer being edited or when other plugins move their cursors.
+    # These are highlighted in the background, after the active view,
+    # and the time they wait there is not counted.
+    if priority_of(view) == Priority.ACTIVE:
+        highlight_view(canvas, probe, started)
+    else:
+        work_queue.submit(view, 'highlight', lambda: highlight_view(canvas, probe),
+                          instrumentation)
+
+    if config.mode[RegionColor.RAINBOW] is not ColorMode.NONE:
+        poll_rainbow(view, canvas)
+
+
+def view_saved(view):
+    if view.buffer_id() in balances:
+        balance = balance_of(view)
+        if balance is not None:
+            save_balance(view, balance)
+
+
+def view_closed(view_id, buffer_id):
+    """Forgets the state of the closed view with the id, and the one of its
+    buffer if no other view shows it.
+    """
+    work_queue.cancel(view_id)
+    balance_waiters.pop(view_id, None)
+    rainbows.pop(view_id, None)
+    rainbow_polls.discard(view_id)
+    degradations.pop(view_id, None)
+
+    views = buffer_views.get(buffer_id, set([]))
+    views.discard(view_id)
+    if not views:
+        buffer_views.pop(buffer_id, None)
+        balances.pop(buffer_id, None)
+        last_selections.pop(buffer_id, None)
+
+
 class LispSelectionListener(sublime_plugin.EventListener):
+    """Handles the events on the main thread, unless LispViewListener does."""
 
     def on_selection_modified(self, view):
+        remember_selection(view)
+        if not async_events:
+            selection_modified(view, view)
 
-        theme_filename = current_sublime_theme_file(view)
+    def on_modified(self, view):
+        if not exact_edits:
+            guess_edit(view)
 
-        add_or_replace_colored_scopes(
-            theme_filename,
-            format_sublime_color_scopes([(0xEE8888, 0x88EE88)])
-        )
+    def on_post_save(self, view):
+        if not async_events:
+            view_saved(view)
 
-        try:
-            print(parse_essential_colors(theme_filename))
-        except ValueError:
-            print("Fucked up: ")
+    def on_close(self, view):
+        if not async_events:
+            view_closed(view.id(), view.buffer_id())
 
-        cursors = cursors_of_view(view)
-        #print("c: ", cursors)
 
-        expanded_regions = expand_cursors_to_regions(cursors, scan_limit, view)
-        #print("xr: ", expanded_regions)
+if async_events:
 
-        examined_regions = merge_adjacent_regions(expanded_regions, cursors)
-        #print("er: ", examined_regions)
+    class LispViewListener(sublime_plugin.ViewEventListener):
+        """Handles the events of a view on the worker thread.
 
-        def no_strings_and_comments(scope):
-            return ("comment" not in scope) and ("string" not in scope)
+        Fields:
+            canvas - the RegionCanvas of the view, which the pipeline renders
+                     the regions on
+        """
+        def __init__(self, view):
+            sublime_plugin.ViewEventListener.__init__(self, view)
+            self.canvas = RegionCanvas(view)
 
-        for region, cursors in examined_regions:
+        def on_selection_modified_async(self):
+            with pipeline_lock:
+                selection_modified(self.view, self.canvas)
+                self.canvas.flush()
 
-            brackets = locate_brackets(view, region, supported_brackets, no_strings_and_comments)
-            #print("b: ", brackets)
+        def on_post_save_async(self):
+            with pipeline_lock:
+                view_saved(self.view)
 
-            per_cursor_indices = [index_brackets(brackets, cursor) for cursor in cursors]
-            #print("pci: ", per_cursor_indices)
+        def on_close(self):
+            # The pipeline may hold the lock for long, the state is forgotten
+            # on its thread instead of waiting for it here.
+            view_id, buffer_id = self.view.id(), self.view.buffer_id()
+            set_timeout_background(lambda: view_closed(view_id, buffer_id), 0)
 
-            merged_indices = merge_bracket_indices(per_cursor_indices)
-            #print("mi: ", merged_indices)
 
-            indexed_bracket_scopes = compute_bracket_scopes(brackets, merged_indices)
-            #print("ibs: ", indexed_bracket_scopes)
+if exact_edits:
 
-            config = Configuration({
-                'primary_mode': ColorMode.EXPRESSION,
-                'secondary_mode': ColorMode.EXPRESSION,
-                'offside_mode': ColorMode.BRACKETS,
-                'offside_limit': 2,
-                'adjacent_mode': ColorMode.EXPRESSION,
-                'adjacent_side': AdjacentMode.BOTH,
-                'invalid_mode': ColorMode.NONE,
-                'inconsistent_mode': ColorMode.NONE,
+    class LispTextChangeListener(sublime_plugin.TextChangeListener):
+        """Records the edits of the buffers into their balances, on the main
+        thread, so that the balances apply them instead of comparing the
+        whole texts.
+        """
+        def on_text_changed(self, changes):
+            balance = balances.get(self.buffer.id())
+            if balance is None:
+                return
 
-                'background_color': (None, 0x123456),
-                'current_line_color': (None, 0x789ABC),
+            change_count = self.buffer.primary_view().change_count()
+            for change in changes:
+                balance.record_edit(change.a.pt, change.b.pt, change.str, change_count)
 
-                'primary_color': (0x110000, None),
-                'secondary_colors': [(0x220000, None), (0x330000, None)],
-                'offside_colors': [(0x440000, 0x004400), (0x550000, 0x005500), (0x660000, 0x006600)],
-                'adjacent_color': (0x770000, 0x007700),
-                'inconsistent_color': (0x880000, 0x008800)
-            })
 
-            rgc = color_scopes(indexed_bracket_scopes, config, cursors, supported_brackets)
-            #print("rgc:", rgc)
+def plugin_unloaded():
+    if region_pool is not None:
+        region_pool.close()
 
-            lines = current_lines_of_view(view, cursors)
-            #print("l:  ", lines)
 
-            dj = split_into_disjoint(rgc, lines)
-            #print("dj: ", dj)
+#
+# Structural commands
+#
 
-            fu = prepend_background(dj, lines)
-            #print("fu: ", fu)
+# These answer from the bracket balance of the view (see bracket_structure),
+# which the highlighting keeps up to date anyway, so they never rescan the
+# text. Other plugins may query it the same way:
+#
+#     lisp_highlight.with_balance(view, lambda balance:
+#         bracket_structure.enclosing_scope(balance, point))
 
-            colored_regions = {}
-            for region in fu:
-                color = compute_span_color(region, config)
+# Actions waiting for the balances of their views, keyed by view ids.
+balance_waiters = {}
 
-                regions = colored_regions.get(color, [])
-                regions.append(region.extent)
 
-                colored_regions[color] = regions
-            #print("cr: ", colored_regions)
+def with_balance(view, action):
+    """Calls the action with the complete balance of the buffer of the view,
+    on the thread the pipeline runs on and holding the pipeline_lock, so that
+    the main thread never waits for the pipeline. The rest of the balance of
+    a large buffer is built first, a slice at a time between the events. The
+    actions of a view run in the order they have been given.
 
-            altogether = []
-            for color, regions in colored_regions.iteritems():
-                altogether.extend(map(Region.as_sublime_region, regions))
+    Args:
+        view - the sublime.View to query the balance of
+
+        action - a function of the BracketBalance to call
+    """
+    def run():
+        # Makes the balance, if the buffer has none yet.
+        balance_of(view)
+        balance = balances[view.buffer_id()]
+        if not advance_balance(view, balance, balance_build_slice):
+            work_queue.submit(view, 'command', run, instrumentation)
+            return
+
+        for waiter in balance_waiters.pop(view.id(), []):
+            waiter(balance)
+
+    # The commands run on the main thread, the waiters and the work_queue
+    # are only touched on the thread of the pipeline.
+    def wait():
+        balance_waiters.setdefault(view.id(), []).append(action)
+        work_queue.submit(view, 'command', run, instrumentation)
+
+    set_timeout_background(wait, 0)
+
+
+def replace_selection(view, regions):
+    selection = view.sel()
+    selection.clear()
+    for region in regions:
+        selection.add(region)
+
+
+class LispHighlightSelectEnclosingFormCommand(sublime_plugin.TextCommand):
+    """Extends the selections to the expressions enclosing them."""
+
+    def run(self, edit):
+        with_balance(self.view, self.select)
+
+    def select(self, balance):
+        regions = []
+        for region in self.view.sel():
+            for scope in enclosing_scopes(balance, region.begin()):
+                extent = scope.expression_region()
+                if (extent.end >= region.end()) and \
+                   ((extent.begin, extent.end) != (region.begin(), region.end())):
+                    region = extent.as_sublime_region()
+                    break
+            regions.append(region)
+
+        replace_selection(self.view, regions)
+
+
+class LispHighlightGotoMatchingBracketCommand(sublime_plugin.TextCommand):
+    """Moves the cursors over the expressions they are at the brackets of:
+    from before a left bracket to after its right one, and back.
+    """
+
+    def run(self, edit):
+        with_balance(self.view, self.move)
+
+    def move(self, balance):
+        regions = []
+        for region in self.view.sel():
+            bracket = bracket_at(balance, region.b)
+            match = None
+            if bracket is not None:
+                match = matching_bracket(balance, bracket)
+
+            if match is None:
+                regions.append(region)
+            elif match.is_right():
+                regions.append(sublime.Region(match.point + len(match.kind)))
+            else:
+                regions.append(sublime.Region(match.point))
+
+        replace_selection(self.view, regions)
+
+
+class LispHighlightSelectSiblingFormCommand(sublime_plugin.TextCommand):
+    """Selects the next (or previous) expressions alongside the selections."""
+
+    def run(self, edit, forward=True):
+        def select(balance):
+            regions = []
+            for region in self.view.sel():
+                if forward:
+                    scope = next_sibling(balance, region.end())
+                else:
+                    scope = previous_sibling(balance, region.begin())
+
+                if scope is not None:
+                    region = scope.expression_region().as_sublime_region()
+                regions.append(region)
+
+            replace_selection(self.view, regions)
+
+        with_balance(self.view, select)
+
+
+class LispHighlightShowDepthCommand(sublime_plugin.TextCommand):
+    """Shows the number of the expressions enclosing the first cursor."""
+
+    def run(self, edit):
+        with_balance(self.view, self.show)
+
+    def show(self, balance):
+        if len(self.view.sel()) == 0:
+            return
+
+        point = self.view.sel()[0].b
+        sublime.status_message("LispBracketHighlighter: depth %d at %d" %
+            (depth_at(balance, point), point))
+
+
+class LispHighlightToggleInstrumentationCommand(sublime_plugin.WindowCommand):
+    """Turns the measurement of the selection events on and off."""
+
+    def run(self):
+        instrumentation.enabled = not instrumentation.enabled
+        sublime.status_message("LispBracketHighlighter instrumentation %s" %
+            ("enabled" if instrumentation.enabled else "disabled"))
+
+
+class LispHighlightToggleTraceCommand(sublime_plugin.WindowCommand):
+    """Starts and stops recording the selection events into a trace."""
+
+    def run(self):
+        global trace_path, trace_recorder
+        if trace_path is None:
+            trace_path = default_trace_path()
+            sublime.status_message("LispBracketHighlighter is recording a trace into %s" %
+                trace_path)
+            return
+
+        events = 0
+        if trace_recorder is not None:
+            events = trace_recorder.events
+            trace_recorder.close()
+        sublime.status_message("LispBracketHighlighter has recorded %d events into %s" %
+            (events, trace_path))
+        trace_path = trace_recorder = None
+
+
+class LispHighlightDumpInstrumentationCommand(sublime_plugin.WindowCommand):
+    """Dumps the collected histograms as JSON into a new scratch view."""
+
+    def run(self, reset=False):
+        report = instrumentation.as_json()
+        if reset:
+            instrumentation.reset()
 
-            scope_name = scope_name_for_color(0xEE8888, 0x88EE88)
+        view = self.window.new_file()
+        view.set_name("LispBracketHighlighter instrumentation")
+        view.set_scratch(True)
 
-            view.erase_regions(scope_name)
-            view.add_regions(scope_name, altogether, scope_name)
+        if async_events:
+            view.run_command('append', {'characters': report})
+        else:
+            edit = view.begin_edit()
+            view.insert(edit, 0, report)
+            view.end_edit(edit)
@@ -1,4 +1,9 @@
-from utils import make_enum
+import copy
+
+if __package__:
+    from .utils import make_enum
+else:
+    from utils import make_enum
 
 ColorMode = make_enum('NONE', 'BRACKETS', 'EXPRESSION')
 
@@ -9,7 +14,7 @@ class AdjacentMode: # flags
     BOTH  = 3
 
 RegionColor = make_enum('PRIMARY', 'SECONDARY', 'OFFSIDE', 'ADJACENT',
-    'INCONSISTENT', 'BACKGROUND', 'CURRENT_LINE')
+    'INCONSISTENT', 'BACKGROUND', 'CURRENT_LINE', 'RAINBOW')
 
 class Configuration:
 
@@ -21,6 +26,7 @@ class Configuration:
         self.mode[RegionColor.OFFSIDE] = config['offside_mode']
         self.mode[RegionColor.ADJACENT] = config['adjacent_mode']
         self.mode[RegionColor.INCONSISTENT] = config['inconsistent_mode']
+        self.mode[RegionColor.RAINBOW] = config['rainbow_mode']
 
         self.offside_limit = config['offside_limit']
 
@@ -36,3 +42,79 @@ class Configuration:
         self.color[RegionColor.INCONSISTENT] = config['inconsistent_color']
         self.color[RegionColor.BACKGROUND] = config['background_color']
         self.color[RegionColor.CURRENT_LINE] = config['current_line_color']
+        self.color[RegionColor.RAINBOW] = config['rainbow_colors']
+
+    def inner_index_limit(self):
+        """Returns the greatest inner index of a scope that may get colored.
+
+        Scopes nested deeper than this are never visible and there is no need
+        to build them at all. Inconsistent scopes are colored regardless of
+        their nesting depth, so the limit is None if they are to be shown.
+        """
+        if self.mode[RegionColor.INCONSISTENT] is not ColorMode.NONE:
+            return None
+
+        limit = -1
+
+        if (self.mode[RegionColor.PRIMARY] is not ColorMode.NONE) or \
+           (self.mode[RegionColor.SECONDARY] is not ColorMode.NONE):
+            limit = 0
+
+        # Adjacent scopes are always the nearest ones to some cursor.
+        if (self.mode[RegionColor.ADJACENT] is not ColorMode.NONE) and \
+           (self.adjacent_left or self.adjacent_right):
+            limit = max(limit, 1)
+
+        if self.mode[RegionColor.OFFSIDE] is not ColorMode.NONE:
+            limit = max(limit, self.offside_limit)
+
+        return limit
+
+    def with_modes(self, modes):
+        """Returns a copy of the configuration with some of the modes changed.
+
+        Args:
+            {RegionColor: ColorMode} - the modes to change
+        """
+        changed = copy.copy(self)
+        changed.mode = dict(self.mode)
+        changed.mode.update(modes)
+        return changed
+
+    def as_settings(self):
+        """Returns the dictionary the configuration is made of, with the
+        modes given by their names, so that it can be dumped as JSON.
+        """
+        adjacent_side = AdjacentMode.NONE
+        if self.adjacent_left: adjacent_side |= AdjacentMode.LEFT
+        if self.adjacent_right: adjacent_side |= AdjacentMode.RIGHT
+
+        return {
+            'primary_mode': str(self.mode[RegionColor.PRIMARY]),
+            'secondary_mode': str(self.mode[RegionColor.SECONDARY]),
+            'offside_mode': str(self.mode[RegionColor.OFFSIDE]),
+            'adjacent_mode': str(self.mode[RegionColor.ADJACENT]),
+            'inconsistent_mode': str(self.mode[RegionColor.INCONSISTENT]),
+            'rainbow_mode': str(self.mode[RegionColor.RAINBOW]),
+
+            'offside_limit': self.offside_limit,
+            'adjacent_side': adjacent_side,
+
+            'primary_color': self.color[RegionColor.PRIMARY],
+            'secondary_colors': self.color[RegionColor.SECONDARY],
+            'offside_colors': self.color[RegionColor.OFFSIDE],
+            'adjacent_color': self.color[RegionColor.ADJACENT],
+            'inconsistent_color': self.color[RegionColor.INCONSISTENT],
+            'background_color': self.color[RegionColor.BACKGROUND],
+            'current_line_color': self.color[RegionColor.CURRENT_LINE],
+            'rainbow_colors': self.color[RegionColor.RAINBOW],
+        }
+
+
+def configuration_from_settings(settings):
+    """Makes a Configuration of the dictionary given by its as_settings."""
+    config = dict(settings)
+    for key in ['primary_mode', 'secondary_mode', 'offside_mode', 'adjacent_mode',
+                'inconsistent_mode', 'rainbow_mode']:
+        config[key] = getattr(ColorMode, config[key])
+    return Configuration(config)
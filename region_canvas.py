@@ -0,0 +1,85 @@
+import sublime
+
+#
+# Region canvas
+#
+
+class RegionCanvas:
+    """A stand-in for a view, which the pipeline renders on off the main thread.
+
+    The pipeline renders on the canvas as it does on the view: the regions
+    added and erased are kept by the canvas, everything else is passed to the
+    view. Once rendered, the regions are compared with the ones the view shows
+    and only the keys which have changed are set on the view, all at once on
+    the main thread. Regions erased and added back unchanged never reach the
+    view, nor do the ones added twice with the same contents.
+
+    The changes are flushed when the event is done, or else after the current
+    task of the worker thread, for the rendering done in the background. The
+    canvas is used on the worker thread only.
+
+    Fields:
+        view - the sublime.View to highlight
+
+        flushes - the number of times the changes have been passed to the
+                  main thread
+    """
+    def __init__(self, view):
+        self.view = view
+        self.flushes = 0
+
+        # key -> ([(a, b)], scope, [args]) of the regions the view shows
+        self._shown = {}
+        # key -> the same of the regions rendered since the last flush, or
+        # None if they have been erased
+        self._rendered = {}
+        self._flush_scheduled = False
+
+    def __getattr__(self, name):
+        return getattr(self.view, name)
+
+    def add_regions(self, key, regions, scope, *args):
+        self._render(key, ([(region.a, region.b) for region in regions], scope, args))
+
+    def erase_regions(self, key):
+        self._render(key, None)
+
+    def get_regions(self, key):
+        regions = self._rendered.get(key, self._shown.get(key))
+        if regions is None:
+            return []
+        return [sublime.Region(a, b) for a, b in regions[0]]
+
+    def _render(self, key, regions):
+        self._rendered[key] = regions
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            sublime.set_timeout_async(self.flush, 0)
+
+    def flush(self):
+        """Passes the regions which have changed to the main thread."""
+        self._flush_scheduled = False
+
+        changes = []
+        for key, regions in self._rendered.items():
+            if self._shown.get(key) == regions:
+                continue
+            changes.append((key, regions))
+            if regions is None:
+                del self._shown[key]
+            else:
+                self._shown[key] = regions
+        self._rendered = {}
+
+        if changes:
+            self.flushes += 1
+            sublime.set_timeout(lambda: self._apply(changes), 0)
+
+    def _apply(self, changes):
+        view = self.view
+        for key, regions in changes:
+            if regions is None:
+                view.erase_regions(key)
+            else:
+                points, scope, args = regions
+                view.add_regions(key, [sublime.Region(a, b) for a, b in points], scope, *args)
@@ -0,0 +1,129 @@
+import os
+
+try:
+    import multiprocessing
+except ImportError:
+    # The Python embedded into some builds of Sublime Text lacks it.
+    multiprocessing = None
+
+#
+# Process pool
+#
+
+class RegionPool:
+    """A pool of processes to color the examined regions of large events in.
+
+    The examined regions of an event are independent of each other, so with
+    thousands of cursors scattered over a file they may be colored in several
+    processes at once. Only plain values cross the processes: the caller
+    takes everything it needs out of the view beforehand, and gets back
+    plain values as well. The regions are split into one batch per process
+    in order, and the results come back in the same order.
+
+    Only the events with at least `min_cursors` cursors in at least two
+    examined regions go to the pool. The smaller ones are colored in-process
+    by the caller, they would not pay for passing the data around.
+
+    The processes are forked when the first such event comes, so that they
+    have the plugin loaded without importing it. Where processes cannot be
+    forked, or fail to start, every event is colored in-process.
+
+    Fields:
+        processes - the number of processes
+
+        min_cursors - the number of cursors which makes an event worth
+                      coloring in the pool
+
+        batches - the number of batches colored in the pool so far
+    """
+    def __init__(self, processes, min_cursors):
+        self.processes = processes
+        self.min_cursors = min_cursors
+        self.batches = 0
+
+        self._pool = None
+        self._failed = False
+
+    def wants(self, examined_regions):
+        """Tells whether the examined regions are to be colored in the pool,
+        starting the pool if they are.
+
+        Args:
+            [(region, [cursors])] - the examined regions of an event
+        """
+        if self._failed or (len(examined_regions) < 2):
+            return False
+
+        cursors = 0
+        for _, region_cursors in examined_regions:
+            cursors += len(region_cursors)
+        if cursors < self.min_cursors:
+            return False
+
+        return self._start()
+
+    def map(self, function, common, items):
+        """Calls the function in the processes for batches of the items.
+
+        Args:
+            function - a module-level function of (common, [item]) which
+                       returns a list of results, one per item
+
+            common - the argument passed along with every batch
+
+            [items] - the items to split into batches
+
+        Returns:
+            [result] - the results of all the items, in order
+        """
+        size = -(-len(items) // self.processes)
+        tasks = [(function, common, items[begin:begin + size])
+                 for begin in range(0, len(items), size)]
+
+        results = []
+        for batch_results in self._pool.map(_run_batch, tasks):
+            results.extend(batch_results)
+
+        self.batches += len(tasks)
+        return results
+
+    def close(self):
+        """Stops the processes, they are started again when needed."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _start(self):
+        if self._pool is not None:
+            return True
+
+        context = _fork_context()
+        if context is None:
+            self._failed = True
+            return False
+
+        try:
+            self._pool = context.Pool(self.processes)
+        except (OSError, ImportError):
+            self._failed = True
+            return False
+        return True
+
+
+def _fork_context():
+    if (multiprocessing is None) or not hasattr(os, 'fork'):
+        return None
+
+    # Python 2 always forks where it can, Python 3 has to be asked to.
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        return multiprocessing
+    try:
+        return get_context('fork')
+    except ValueError:
+        return None
+
+
+def _run_batch(task):
+    function, common, items = task
+    return function(common, items)
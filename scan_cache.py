@@ -0,0 +1,131 @@
+from array import array
+
+if __package__:
+    from .types import LeftBracket, RightBracket
+else:
+    from types import LeftBracket, RightBracket
+
+#
+# Scan cache
+#
+
+# Every entry costs this much besides its text and brackets, roughly.
+_ENTRY_OVERHEAD = 200
+
+
+class ScanCache:
+    """A content-addressed cache of the brackets located in pieces of text.
+
+    Entries are keyed by the text scanned, the length of the part of it the
+    brackets may begin in, and the scope it begins in, which decides whether
+    its brackets are in a string or comment, and begins with the base scope
+    of the syntax, which decides the dialect of the brackets.
+    So they stay valid for as long as the text does, wherever it is. The
+    cache is made with all the brackets of the dialects. Undoing an edit,
+    redoing it, or editing elsewhere in the buffer makes the same texts come
+    back and their brackets are taken from the cache instead of scanning the
+    text again, even though the change count of the view has moved on.
+
+    The keys are hashed by the dictionary, which is fast, and compared as
+    a whole on a hit, so two texts never share an entry, nor do two parts
+    of the same text scanned for brackets. The brackets are
+    kept relative to the beginning of the text, as arrays of their offsets
+    and kinds. When the entries take more than `size_limit` bytes, the least
+    recently used quarter of them is evicted.
+
+    Fields:
+        size_limit - the maximum size of the entries, in bytes, roughly
+
+        size - the current size of the entries
+
+        hits, misses, evictions - the number of lookups which have found an
+                                  entry, have had to scan the text, and the
+                                  number of entries evicted
+    """
+    def __init__(self, supported_brackets, size_limit):
+        self.size_limit = size_limit
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Kinds of the brackets are numbered: left ones first, then right ones.
+        self._kinds = [(left, True) for left, _ in supported_brackets] + \
+                      [(right, False) for _, right in supported_brackets]
+        self._kind_numbers = dict((kind, number)
+                                  for number, kind in enumerate(self._kinds))
+
+        # (start scope, text, length) -> [last use, [offset], [kind number], size]
+        self._entries = {}
+        self._uses = 0
+
+    def brackets(self, text, start_scope, begin, scan, length=None):
+        """Returns the brackets of the text, from the cache if it is there.
+
+        Args:
+            text - the text to locate the brackets in
+
+            start_scope - the scope name the text begins in
+
+            begin - the point where the text begins in the view
+
+            scan - a function of no arguments which locates the brackets
+                   of the text in the view, called on a miss
+
+            length - the length of the part of the text the brackets begin
+                     in, the rest is where they may extend into, all of the
+                     text if None. The text is cut short at the end of the
+                     view, so the same text may be scanned for different
+                     lengths.
+
+        Returns:
+            [bracket] - the brackets of the text, in order
+        """
+        self._uses += 1
+        key = start_scope, text, length
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            entry[0] = self._uses
+
+            kinds = self._kinds
+            brackets = []
+            for offset, number in zip(entry[1], entry[2]):
+                kind, is_left = kinds[number]
+                if is_left:
+                    brackets.append(LeftBracket(begin + offset, kind))
+                else:
+                    brackets.append(RightBracket(begin + offset, kind))
+            return brackets
+
+        self.misses += 1
+        brackets = list(scan())
+
+        size = _ENTRY_OVERHEAD + len(text) * 2 + len(brackets) * 5
+        if size * 4 > self.size_limit:
+            return brackets
+
+        offsets = array('i', [bracket.point - begin for bracket in brackets])
+        numbers = array('b', [self._kind_numbers[bracket.kind, bracket.is_left()]
+                              for bracket in brackets])
+        self._entries[key] = [self._uses, offsets, numbers, size]
+        self.size += size
+
+        if self.size > self.size_limit:
+            self._evict()
+        return brackets
+
+    def clear(self):
+        self._entries = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        by_use = sorted((entry[0], key) for key, entry in self._entries.items())
+        for _, key in by_use[:max(1, len(by_use) // 4)]:
+            self.size -= self._entries.pop(key)[3]
+            self.evictions += 1
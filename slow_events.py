@@ -0,0 +1,194 @@
+import sublime
+
+import json
+import os
+import random
+import shutil
+import traceback
+
+from time import time, strftime, localtime
+
+if __package__:
+    from .balance_cache import default_cache_directory
+else:
+    from balance_cache import default_cache_directory
+
+try:
+    import cProfile
+except ImportError:
+    # Some embedded Pythons lack the C profiler, the pure one is slower but
+    # has the same interface.
+    import profile as cProfile
+
+#
+# Slow-event watchdog
+#
+
+_PREFIX = 'event-'
+
+
+def default_capture_directory():
+    """Returns the directory in the user cache directory to keep captures in."""
+    return os.path.join(default_cache_directory(), 'slow-events')
+
+
+class SlowEventWatchdog:
+    """Keeps the evidence of slow selection events.
+
+    An event which has taken at least `threshold` milliseconds is run once
+    more under the profiler, outside of the event itself, and the profile is
+    written into a directory of its own along with everything needed to
+    reproduce the event:
+
+        profile.pstats - the profile, to be read with the pstats module
+        window.txt     - the text from the first examined region to the last
+        event.json     - the cursors, the examined regions, the timings, the
+                         Configuration (see Configuration.as_settings) and
+                         other details of the event
+
+    A `sample` fraction of the other events is captured as well. After a
+    capture the watchdog stays quiet for `cooldown` seconds, so that a slow
+    stretch of editing does not get twice as slow. Only the last `keep`
+    captures are kept. Failures of the file system are never reported, the
+    event is simply not captured.
+
+    Fields:
+        directory - the directory to keep the captures in
+
+        threshold - the latency of the events to capture, in milliseconds
+
+        keep - how many captures to keep
+
+        cooldown - how long to stay quiet after a capture, in seconds
+
+        sample - the fraction of the events to capture regardless of their
+                 latency, from 0.0 to 1.0
+
+        captured - the number of captures written so far
+    """
+    def __init__(self, directory, threshold, keep, cooldown=60, sample=0.0):
+        self.directory = directory
+        self.threshold = threshold
+        self.keep = keep
+        self.cooldown = cooldown
+        self.sample = sample
+        self.captured = 0
+
+        self._quiet_until = 0.0
+
+    def wants(self, elapsed):
+        """Tells whether the event which has taken `elapsed` milliseconds is
+        to be captured.
+
+        Returns:
+            'slow' or 'sampled' if it is, None otherwise
+        """
+        if time() < self._quiet_until:
+            return None
+        if elapsed >= self.threshold:
+            return 'slow'
+        if (self.sample > 0) and (random.random() < self.sample):
+            return 'sampled'
+        return None
+
+    def capture(self, view, cursors, regions, config, rerun, details):
+        """Runs the event again under the profiler and writes the capture.
+
+        Args:
+            view - the sublime.View of the event
+
+            [cursors] - the cursors of the event
+
+            [Region] regions - the examined regions of the event
+
+            config - the Configuration the event has been highlighted with
+
+            rerun - a function of no arguments which runs the event again,
+                    without rendering on the view (see ScratchView)
+
+            details - a JSON-serializable dictionary to put into event.json
+
+        Returns:
+            the path of the capture, or None if it has not been written
+        """
+        self._quiet_until = time() + self.cooldown
+
+        error = None
+        profiler = cProfile.Profile()
+        started = time()
+        try:
+            profiler.runcall(rerun)
+        except Exception:
+            error = traceback.format_exc()
+        profiled = (time() - started) * 1000.0
+
+        begin = min(region.begin for region in regions) if regions else 0
+        end = max(region.end for region in regions) if regions else 0
+        window = view.substr(sublime.Region(begin, end)) if regions else ''
+
+        event = {
+            'time': time(),
+            'view': view.id(),
+            'buffer': view.buffer_id(),
+            'change': view.change_count(),
+            'file': view.file_name(),
+            'size': view.size(),
+            'cursors': list(cursors),
+            'regions': [[region.begin, region.end] for region in regions],
+            'window': [begin, end],
+            'profiled_ms': profiled,
+            'settings': config.as_settings(),
+            'error': error,
+        }
+        event.update(details)
+
+        name = '%s%s-%03d-%d' % (_PREFIX, strftime('%Y%m%d-%H%M%S', localtime(started)),
+                                 int(started * 1000) % 1000, view.id())
+        path = os.path.join(self.directory, name)
+        try:
+            os.makedirs(path)
+            profiler.dump_stats(os.path.join(path, 'profile.pstats'))
+            with open(os.path.join(path, 'window.txt'), 'wb') as output:
+                output.write(window.encode('utf-8'))
+            with open(os.path.join(path, 'event.json'), 'w') as output:
+                json.dump(event, output, indent=2, sort_keys=True)
+        except (IOError, OSError):
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        self.captured += 1
+        self._rotate()
+        return path
+
+    def _rotate(self):
+        try:
+            names = sorted(name for name in os.listdir(self.directory)
+                           if name.startswith(_PREFIX))
+        except OSError:
+            return
+
+        for name in names[:max(0, len(names) - self.keep)]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+
+class ScratchView:
+    """A proxy of sublime.View which keeps the regions added to it instead of
+    showing them, so that an event run again does not repaint the view with
+    the highlights of its old cursors. All other attributes are passed
+    through to the view.
+    """
+    def __init__(self, view):
+        self._view = view
+        self._regions = {}
+
+    def __getattr__(self, name):
+        return getattr(self._view, name)
+
+    def add_regions(self, key, regions, scope, *args):
+        self._regions[key] = list(regions)
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def get_regions(self, key):
+        return self._regions.get(key, [])
@@ -0,0 +1,126 @@
+import sublime
+
+from time import time
+
+#
+# Idle-time speculation
+#
+
+class Speculator:
+    """Locates the brackets around the caret while the editor is idle.
+
+    Every selection event schedules a run which starts once there have been
+    no events for `delay` milliseconds. The run locates the brackets of the
+    lines of the top-level expression around the caret and of the lines of
+    its neighbours, in slices of at most `slice` milliseconds of work with
+    the editor free to process events in between. A new event preempts the
+    run, and a run stops anyway after `budget` milliseconds of work.
+
+    The outcome is counted into the instrumentation: 'speculation.runs' that
+    have started, the ones which have been 'preempted', 'exhausted' their
+    budget, or 'finished' everything, the 'rows' located, and the 'events'
+    along with the 'hits' among them, which are the events that have used
+    some of the speculatively located lines.
+
+    The slices are queued into the WorkQueue if there is one, so that the
+    runs for the views out of focus wait for the more important work.
+
+    Fields:
+        delay - the time without events to start speculating after, in ms
+
+        budget - the time a run may work for at most, in ms
+
+        slice - the time a run may work for without a break, in ms
+
+        radius - how many lines around the top-level expression to locate
+
+        queue - the WorkQueue to run the slices in, or None
+
+        set_timeout - the function to run the runs and slices with after
+                      a delay, which takes the same arguments as
+                      sublime.set_timeout
+    """
+    def __init__(self, delay, budget, slice, radius, queue=None,
+                 set_timeout=sublime.set_timeout):
+        self.delay = delay
+        self.budget = budget
+        self.slice = slice
+        self.radius = radius
+        self.queue = queue
+        self.set_timeout = set_timeout
+
+        # Every event bumps the generation, runs of older ones give up.
+        self._generation = 0
+        # The rows of the current run, see BracketBalance.speculate.
+        self._rows = None
+
+    def preempt(self):
+        """Stops the runs of the previous events."""
+        self._generation += 1
+        if self._rows is not None:
+            self._rows.close()
+            self._rows = None
+
+    def schedule(self, view, balance, point, instrumentation):
+        """Preempts the previous runs and schedules a run around the point,
+        which counts its outcome into the instrumentation.
+        """
+        self.preempt()
+        generation = self._generation
+
+        def start():
+            if generation != self._generation:
+                return
+            instrumentation.count('speculation.runs')
+
+            balance.refresh(view)
+            self._rows = balance.speculate(point, self.radius)
+            self._continue(view, generation, self.budget, instrumentation)
+
+        self.set_timeout(lambda: self._submit(view, start, instrumentation), self.delay)
+
+    def _submit(self, view, task, instrumentation):
+        if self.queue is None:
+            self.set_timeout(task, 0)
+        else:
+            self.queue.submit(view, 'speculation', task, instrumentation)
+
+    def _continue(self, view, generation, budget, instrumentation):
+        if generation != self._generation:
+            instrumentation.count('speculation.preempted')
+            return
+
+        started = time()
+        deadline = started + min(self.slice, budget) / 1000.0
+
+        located = 0
+        finished = True
+        for _ in self._rows:
+            located += 1
+            if time() >= deadline:
+                finished = False
+                break
+
+        instrumentation.count('speculation.rows', located)
+
+        if finished:
+            instrumentation.count('speculation.finished')
+            self._rows = None
+            return
+
+        budget -= (time() - started) * 1000.0
+        if budget <= 0:
+            instrumentation.count('speculation.exhausted')
+            self._rows = None
+            return
+
+        self._submit(view, lambda:
+            self._continue(view, generation, budget, instrumentation), instrumentation)
+
+    def record(self, balance, used_before, instrumentation):
+        """Counts an event, which is a hit if it has used more speculatively
+        located lines of the balance than `used_before` of them.
+        """
+        instrumentation.count('speculation.events')
+        if balance.speculative_rows_used > used_before:
+            instrumentation.count('speculation.hits')
@@ -1,5 +1,7 @@
 import sublime
 
+from bisect import bisect_left
+
 #
 # Regions
 #
@@ -36,7 +38,11 @@ class Region:
         return (self.begin <= other.begin) and (other.end <= self.end)
 
     def __lt__(self, other):
-        return (self.begin < other.begin)
+        # The same ordering as the one of __le__ below, as heaps rely on it.
+        if (self.begin == other.begin):
+            return (self.end < other.end)
+        else:
+            return (self.begin < other.begin)
 
     def __le__(self, other):
         # Such peculiar ordering is required to correctly handle nested ranges.
@@ -206,21 +212,71 @@ class Scope:
         """True is this scope is an offside scope."""
         return self.inner_index > 0
 
-    def is_adjacent_to(self, cursors):
-        """True is this scope is adjacent to any of the given cursors.
+    def is_adjacent_to(self, positions):
+        """True is this scope is adjacent to any of the cursors.
 
         Args:
-            [cursors] - a list of cursor points for adjacency test
+            positions - the PositionIndex of the cursors
         """
-        def is_an_endpoint(cursor):
-            return self.left_bracket.contains(cursor) or \
-                   self.right_bracket.contains(cursor)
+        return positions.has_cursor_inside(self.left_bracket) or \
+               positions.has_cursor_inside(self.right_bracket)
 
-        for cursor in cursors:
-            if is_an_endpoint(cursor):
-                return True
-        else:
-            return False
+#
+# Positions
+#
+
+class PositionIndex:
+    """Sorted positions of the cursors and the brackets of an examined region.
+
+    The index is built once for the region and shared by the stages, so that
+    looking up the brackets around a cursor or the cursors inside a bracket
+    is a binary search instead of a scan.
+
+    Fields:
+        cursors - a sorted list of the cursor points
+
+        inside_points - a sorted list of the inside points of the brackets
+                        (see Bracket.inside_point)
+    """
+    def __init__(self, cursors, brackets=()):
+        self.cursors = cursors
+        self.inside_points = [bracket.inside_point() for bracket in brackets]
+
+    def insertion_index(self, cursor):
+        """Returns the index of the bracket immediately following the cursor."""
+        # The bracket with the index returned will the first bracket that is
+        # located to the right of the cursor's point. Multicharacter left
+        # brackets are bisected by their inside points to ensure that they
+        # are treated as 'located to the left' only when they are _entirely_
+        # located to the left of the cursor.
+        return bisect_left(self.inside_points, cursor)
+
+    def insertion_indices(self):
+        """Returns the distinct insertion indices of all the cursors, sorted.
+
+        The cursors and the brackets are both sorted, so they are swept
+        together instead of bisecting for every cursor.
+        """
+        indices = []
+        index, count = 0, len(self.inside_points)
+        for cursor in self.cursors:
+            while (index < count) and (self.inside_points[index] < cursor):
+                index += 1
+            if not indices or (indices[-1] != index):
+                indices.append(index)
+        return indices
+
+    def has_cursor_inside(self, bracket):
+        """True if any of the cursors is inside the bracket.
+
+        See Bracket.contains for what 'inside' means.
+        """
+        begin, end = bracket.point, bracket.point + len(bracket.kind)
+        if bracket.is_right():
+            begin, end = begin + 1, end + 1
+
+        index = bisect_left(self.cursors, begin)
+        return (index < len(self.cursors)) and (self.cursors[index] < end)
 
 #
 # Colorable spans
@@ -243,7 +299,10 @@ class ColorableSpan:
         foreground - a color tuple of the main color of the scope
 
         background_stack - a stack of color tuples of the background (parent)
-                           scopes of this one; the last one is the topmost one
+                           scopes of this one; the last one is the topmost one;
+                           the stacks may be shared between the spans, and
+                           the backgrounds hidden under an opaque one may be
+                           left out of them
     """
     def __init__(self, extent, foreground, background_stack):
         self.extent = extent
@@ -1,3 +1,14 @@
+try:
+    xrange = xrange
+except NameError:
+    xrange = range # Python 3
+
+try:
+    from itertools import imap, izip
+except ImportError:
+    imap, izip = map, zip # Python 3
+
+
 def make_enum(*names):
     class enum_type:
         def __init__(self, name): self.name = name
@@ -6,3 +17,27 @@ def make_enum(*names):
 
     enums = dict(zip(names, map(enum_type, names)))
     return type('Enum', (), enums)
+
+
+def common_prefix_length(a, b):
+    """Returns the length of the common prefix of two strings."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix_length(a, b, limit):
+    """Returns the length of the common suffix of two strings, up to limit."""
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
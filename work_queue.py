@@ -0,0 +1,134 @@
+import sublime
+
+from itertools import count
+
+if __package__:
+    from .utils import xrange
+else:
+    from utils import xrange
+
+#
+# Priorities
+#
+
+class Priority:
+    ACTIVE  = 0 # the view the user works in
+    VISIBLE = 1 # views shown in the other groups and windows
+    HIDDEN  = 2 # views in the background tabs
+
+
+def priority_of(view):
+    """Tells how important the work for the view is, from its focus."""
+    window = view.window()
+    if window is None:
+        return Priority.HIDDEN
+
+    active_window = sublime.active_window()
+    active_view = window.active_view()
+    if (active_window is not None) and (active_window.id() == window.id()) and \
+       (active_view is not None) and (active_view.id() == view.id()):
+        return Priority.ACTIVE
+
+    for group in xrange(window.num_groups()):
+        shown_view = window.active_view_in_group(group)
+        if (shown_view is not None) and (shown_view.id() == view.id()):
+            return Priority.VISIBLE
+
+    return Priority.HIDDEN
+
+#
+# Work queue
+#
+
+class WorkQueue:
+    """Background work of all the views, run most important first.
+
+    Tasks are queued under names, a view has at most one task of every name:
+    a newer task supersedes the queued one. The queue runs at most `limit`
+    tasks at once, then lets the editor process the events before the next
+    ones. The priorities of the views are looked up right before running,
+    so the view that has just got the focus goes first. Tasks of the same
+    priority run in the order they have been queued.
+
+    The outcome is counted into the instrumentation of the task: the tasks
+    'queue.ran', 'queue.superseded' by newer ones, or 'queue.cancelled' for
+    closed views.
+
+    The queue is not thread-safe, it is to be used on the thread which
+    `set_timeout` runs it on.
+
+    Fields:
+        limit - how many tasks may run before the editor gets control back
+
+        set_timeout - the function to run the queue with after a delay, which
+                      takes the same arguments as sublime.set_timeout
+    """
+    def __init__(self, limit, set_timeout=sublime.set_timeout):
+        self.limit = limit
+        self.set_timeout = set_timeout
+
+        # (view id, name) -> (serial number, view, task, instrumentation)
+        self._tasks = {}
+        self._serial_numbers = count()
+        self._scheduled = False
+
+    def submit(self, view, name, task, instrumentation):
+        """Queues the task for the view, superseding the queued one of the
+        same name.
+
+        Args:
+            view - the sublime.View the task works for
+
+            name - the name of the task
+
+            task - a function of no arguments to call
+
+            instrumentation - the Instrumentation to count the outcome into
+        """
+        key = view.id(), name
+        if key in self._tasks:
+            instrumentation.count('queue.superseded')
+
+        self._tasks[key] = next(self._serial_numbers), view, task, instrumentation
+        self._schedule()
+
+    def discard(self, view, name):
+        """Drops the queued task of the view with the name, if any.
+
+        Returns:
+            True if there has been such a task
+        """
+        return self._tasks.pop((view.id(), name), None) is not None
+
+    def cancel(self, view_id):
+        """Drops all queued tasks of the view with the id."""
+        for key in list(self._tasks):
+            if key[0] == view_id:
+                _, _, _, instrumentation = self._tasks.pop(key)
+                instrumentation.count('queue.cancelled')
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def _schedule(self):
+        if not self._scheduled:
+            self._scheduled = True
+            self.set_timeout(self._run, 0)
+
+    def _run(self):
+        self._scheduled = False
+
+        try:
+            queued = sorted((priority_of(view), serial, key)
+                            for key, (serial, view, _, _) in list(self._tasks.items()))
+
+            for _, _, key in queued[:self.limit]:
+                # A task may have dropped the ones after it.
+                if key not in self._tasks:
+                    continue
+                _, _, task, instrumentation = self._tasks.pop(key)
+                instrumentation.count('queue.ran')
+                task()
+        finally:
+            if self._tasks:
+                self._schedule()